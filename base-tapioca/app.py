@@ -11,6 +11,7 @@ from opentapioca.wikidatagraph import WikidataGraph
 from opentapioca.languagemodel import BOWLanguageModel
 from opentapioca.tagger import Tagger
 from opentapioca.classifier import SimpleTagClassifier
+from opentapioca.coordinates import CoordinateStore
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
@@ -20,16 +21,22 @@ tapioca_dir = os.path.dirname(__file__)
 bow = BOWLanguageModel()
 if settings.LANGUAGE_MODEL_PATH:
     bow.load(settings.LANGUAGE_MODEL_PATH)
+# Name of the indexing profile whose personalized pagerank should be used, if any
+PAGERANK_PROFILE = getattr(settings, 'PAGERANK_PROFILE', None)
 graph = WikidataGraph()
 if settings.PAGERANK_PATH:
-    graph.load_pagerank(settings.PAGERANK_PATH)
+    graph.load_pagerank(settings.PAGERANK_PATH, profiles=[PAGERANK_PROFILE] if PAGERANK_PROFILE else [])
+# Path of the coordinates of the items, for classifiers trained with them
+COORDINATES_PATH = getattr(settings, 'COORDINATES_PATH', None)
 tagger = None
 classifier = None
 if settings.SOLR_COLLECTION:
-    tagger = Tagger(settings.SOLR_COLLECTION, bow, graph)
+    tagger = Tagger(settings.SOLR_COLLECTION, bow, graph, profile=PAGERANK_PROFILE)
     classifier = SimpleTagClassifier(tagger)
     if settings.CLASSIFIER_PATH:
         classifier.load(settings.CLASSIFIER_PATH)
+    if COORDINATES_PATH:
+        classifier.set_coordinates(CoordinateStore.load(COORDINATES_PATH))
 
 def jsonp(view):
     """
@@ -7,6 +7,8 @@ from sklearn.pipeline import Pipeline
 from .similarities import EdgeRatioSimilarity
 from .similarities import OneStepSimilarity
 from .similarities import DirectLinkSimilarity
+from .similarities import GeoProximitySimilarity
+from .coordinates import pairwise_distances
 import pickle
 
 logger = logging.getLogger(__name__)
@@ -15,26 +17,59 @@ class SimpleTagClassifier(object):
     """
     A linear support vector classifier to predict the validity of a tag in a mention.
     """
-    def __init__(self, tagger, beta=0.85, nb_steps=2, C=0.001, max_similarity_distance=100, similarity_smoothing=0.1, similarity="direct_link"):
+    def __init__(self, tagger, beta=0.85, nb_steps=2, C=0.001, max_similarity_distance=100, similarity_smoothing=0.1, similarity="direct_link", coordinates=None, geo_scale=50.):
+        """
+        :param similarity: the similarity measure between tags: "direct_link",
+            "edge_ratio", "one_step" or "geo_proximity" (which needs coordinates)
+        :param coordinates: a CoordinateStore, to add a geographic coherence
+            feature (see geo_coherence_features). It is not saved with the
+            classifier and must be restored with set_coordinates, like the tagger.
+        :param geo_scale: the distance (in km) at which the geographic
+            coherence of two candidates is 1/e
+        """
         self.tagger = tagger
+        self.coordinates = coordinates
+        self.geo_feature = coordinates is not None
+        self.geo_scale = geo_scale
         self.beta = beta
         self.nb_steps = nb_steps
         self.C = C
         self.identifier_space = 'http://www.wikidata.org/entity/'
         self.similarity = similarity
         self.max_similarity_distance = max_similarity_distance
-        if similarity == "direct_link":
-            self.similarity_method = DirectLinkSimilarity()
-        elif similarity == "edge_ratio":
-            self.similarity_method = EdgeRatioSimilarity()
-        else:
-            self.similarity_method = OneStepSimilarity(beta)
+        self.similarity_method = self.make_similarity_method()
         self.similarity_smoothing = similarity_smoothing
 
-    def feature_vectors_from_mention(self, mention):
+    def make_similarity_method(self):
+        """
+        Creates the similarity measure selected by the similarity parameter.
+        """
+        if self.similarity == "direct_link":
+            return DirectLinkSimilarity()
+        elif self.similarity == "edge_ratio":
+            return EdgeRatioSimilarity()
+        elif self.similarity == "geo_proximity":
+            if self.coordinates is None:
+                raise ValueError('The geo_proximity similarity requires coordinates')
+            return GeoProximitySimilarity(self.coordinates, self.geo_scale)
+        else:
+            return OneStepSimilarity(self.beta)
+
+    def set_coordinates(self, coordinates):
+        """
+        Restores the coordinate store after loading the classifier.
+        """
+        self.coordinates = coordinates
+        if isinstance(self.similarity_method, GeoProximitySimilarity):
+            self.similarity_method.coordinates = coordinates
+
+    def feature_vectors_from_mention(self, mention, geo_features=None):
         """
         Returns a dictionary of tag keys to feature vectors
         in a mention
+
+        :param geo_features: the geographic coherence of the tags
+            of the document, if the classifier uses it
         """
         dct = {}
         for tag in mention.tags:
@@ -46,9 +81,41 @@ class SimpleTagClassifier(object):
                 1,
             ]
             tag_key = mention.tag_key(tag.id)
+            if self.geo_feature:
+                feature_vector.append(geo_features.get(tag_key, 0.) if geo_features else 0.)
             dct[tag_key] = feature_vector
         return dct
 
+    def geo_coherence_features(self, mentions):
+        """
+        Returns a dictionary of tag keys to the geographic coherence of
+        the tags of a document: how close (as exp(-distance/geo_scale))
+        each candidate is to the closest candidate of another mention.
+        Tags without coordinates get 0.
+
+        The distances between all candidates are computed at once
+        from the coordinate store.
+        """
+        if self.coordinates is None:
+            raise ValueError('The coordinate store of the classifier must be restored to compute its features')
+        tag_keys = []
+        qids = []
+        mention_ids = []
+        for idx, mention in enumerate(mentions):
+            for tag in mention.tags:
+                tag_keys.append(mention.tag_key(tag.id))
+                qids.append(tag.id)
+                mention_ids.append(idx)
+        if not tag_keys:
+            return {}
+        distances = pairwise_distances(self.coordinates.get_coords(qids))
+        mention_ids = numpy.array(mention_ids)
+        # candidates of the same mention are alternatives, not context
+        distances[mention_ids[:, None] == mention_ids[None, :]] = numpy.nan
+        with numpy.errstate(invalid='ignore'):
+            coherence = numpy.nan_to_num(numpy.exp(-distances / self.geo_scale), nan=0.)
+        return dict(zip(tag_keys, coherence.max(axis=1).tolist()))
+
 
     def load(self, fname):
         """
@@ -59,6 +126,9 @@ class SimpleTagClassifier(object):
             dct = pickle.load(f)
         if 'tagger' in dct:
             del dct['tagger']
+        dct.pop('coordinates', None)
+        # classifiers saved before the geographic feature do not use it
+        dct.setdefault('geo_feature', False)
         self.__dict__.update(dct)
 
     def save(self, fname):
@@ -68,6 +138,7 @@ class SimpleTagClassifier(object):
         with open(fname, 'wb') as f:
             dct = dict(self.__dict__.items())
             del dct['tagger']
+            dct.pop('coordinates', None)
             pickle.dump(dct, f)
 
     def create_mentions(self, phrase):
@@ -122,6 +193,7 @@ class SimpleTagClassifier(object):
             # Set the parameters
             for param, val in param_setting.items():
                 setattr(self, param, val)
+            self.similarity_method = self.make_similarity_method()
 
             # Recompute similarities
             for uri, mentions in docid_to_mentions.items():
@@ -151,6 +223,10 @@ class SimpleTagClassifier(object):
                 self.save('data/latest_classifier.pkl')
 
 
+        # the features must be computed as for the best classifier
+        for param, val in best_params.items():
+            setattr(self, param, val)
+        self.similarity_method = self.make_similarity_method()
         self.fit = best_classifier
         return best_params, best_f1
 
@@ -265,8 +341,9 @@ class SimpleTagClassifier(object):
         """
         # Build matrix of raw feature vectors
         all_feature_vectors = {}
+        geo_features = self.geo_coherence_features(mentions) if self.geo_feature else None
         for mention in mentions:
-            all_feature_vectors.update(self.feature_vectors_from_mention(mention))
+            all_feature_vectors.update(self.feature_vectors_from_mention(mention, geo_features))
 
         if not all_feature_vectors:
             return [], {}
@@ -341,25 +418,32 @@ class SimpleTagClassifier(object):
         """
         start = mention.start
         end = mention.end
-        for tag in mention.tags:
+        # the tags of the neighbouring mentions, weighed by their distance in the text
+        other_tags = []
+        other_tag_ids = []
+        weights = []
+        for other_mention in all_mentions:
+            other_start = other_mention.start
+            other_end = other_mention.end
+            distance = max(start - other_end, other_start - end)
+            # distance = abs((other_end + other_start - end - start) / 2)
+            if (other_start == start and other_end == end) or distance > self.max_similarity_distance:
+                continue
+            for other_tag in other_mention.tags:
+                other_tags.append(other_tag)
+                other_tag_ids.append(other_mention.tag_key(other_tag.id))
+                weights.append(float(self.max_similarity_distance - distance) / self.max_similarity_distance)
+
+        # all the similarities of the tags of the mention at once
+        scores = self.similarity_method.similarity_matrix(mention.tags, other_tags)
+        for tag, tag_scores in zip(mention.tags, scores):
             similarities = [{'tag':mention.tag_key(tag.id), 'score':self.similarity_smoothing}]
-            other_tag_ids = []
-            for other_mention in all_mentions:
-                other_start = other_mention.start
-                other_end = other_mention.end
-                distance = max(start - other_end, other_start - end)
-                # distance = abs((other_end + other_start - end - start) / 2)
-                if (other_start == start and other_end == end) or distance > self.max_similarity_distance:
-                    continue
-                for other_tag in other_mention.tags:
-                    other_tag_id = other_mention.tag_key(other_tag.id)
-                    similarity = self.similarity_smoothing + self.similarity_method.compute_similarity(tag, other_tag)
-                    similarity *= float(self.max_similarity_distance - distance) / self.max_similarity_distance
-                    other_tag_ids.append(other_tag_id)
-                    if similarity > 0.:
-                        similarities.append(
-                                {'tag': other_tag_id,
-                                 'score': similarity })
+            for other_tag_id, score, weight in zip(other_tag_ids, tag_scores, weights):
+                similarity = (self.similarity_smoothing + float(score)) * weight
+                if similarity > 0.:
+                    similarities.append(
+                            {'tag': other_tag_id,
+                             'score': similarity })
 
             # Normalize
             weight_sum = sum(similarity['score'] for similarity in similarities)
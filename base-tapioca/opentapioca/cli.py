@@ -1,37 +1,55 @@
 
 import click
 import logging
+import numpy
 import dateutil.parser
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from opentapioca.wikidatagraph import WikidataGraph
+from opentapioca.wikidatagraph import IncrementalPageRank
 from opentapioca.languagemodel import BOWLanguageModel
 from opentapioca.taggerfactory import TaggerFactory
 from opentapioca.taggerfactory import CollectionAlreadyExists
+from opentapioca.taggerfactory import Checkpoint
 from opentapioca.tagger import Tagger
 from opentapioca.classifier import SimpleTagClassifier
 from opentapioca.indexingprofile import IndexingProfile
+from opentapioca.typematcher import TypeMatcher
+from opentapioca.typematcher import SubclassIndex
+from opentapioca.revisioncache import RevisionCache
+from opentapioca.coordinates import CoordinateStore
+from opentapioca.utils import to_q
+from opentapioca import httpcache
 from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.readers.snapshot import SnapshotWriter
+from opentapioca.readers.snapshot import SnapshotReader
+from opentapioca.readers.snapshot import open_dump
 from opentapioca.readers.streamreader import WikidataStreamReader
 from opentapioca.readers.sparqlreader import SparqlReader
 from pynif import NIFCollection
 
 @click.group()
-def cli():
+@click.option('--http-cache', default=None, envvar='TAPIOCA_HTTP_CACHE', help='Path of a cache (SQLite database) for the requests to the Wikidata API and Query Service')
+@click.option('--offline', is_flag=True, envvar='TAPIOCA_HTTP_OFFLINE', help='Only use the responses in the HTTP cache')
+def cli(http_cache, offline):
     logging.basicConfig(level=os.environ.get('TAPIOCA_LOGLEVEL', 'INFO'), format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-    pass
+    if offline and not http_cache:
+        raise click.UsageError('--offline requires --http-cache')
+    httpcache.configure(cache_name=http_cache, offline=offline)
 
 @click.command()
 @click.argument('filename')
 @click.option('-o', '--outfile', default=None, help='Output file to save the language model to.')
-def train_bow(filename, outfile):
+@click.option('-j', '--decompressors', default=1, help='Number of processes decompressing the dump (bzip2 only)')
+def train_bow(filename, outfile, decompressors):
     """
     Trains a bag of words language model from the terms of the entities in a dump.
     """
     if outfile is None:
-        offset = 2 if filename.endswith('.json.bz2') else 1
+        offset = 2 if filename.endswith(('.json.bz2', '.json.gz', '.json.zst')) else 1
         outfile = '.'.join(filename.split('.')[:-offset]+['bow.pkl'])
-    bow = BOWLanguageModel.train_from_dump(filename)
+    bow = BOWLanguageModel.train_from_dump(filename, processes=decompressors)
     print('\nTop words log likelihoods')
     print(sorted(bow.word_count,
                  key=lambda x: bow._word_log_likelihood(x[0]),
@@ -68,14 +86,77 @@ def bow_shell(filename):
 @click.command()
 @click.argument('filename')
 @click.option('-o', '--outfile', default=None, help='Output file to save the preprocessed graph to.')
-def preprocess(filename, outfile):
+@click.option('-s', '--subclasses', default=None, help='Output file to save the subclass of (P279) edges to.')
+@click.option('-c', '--coordinates', default=None, help='Output file to save the coordinates (P625) of the items to.')
+@click.option('-i', '--instances', default=None, help='Output file to save the instance of (P31) edges to.')
+@click.option('-j', '--decompressors', default=1, help='Number of processes decompressing the dump (bzip2 only)')
+def preprocess(filename, outfile, subclasses, coordinates, instances, decompressors):
     """
     Preprocesses a Wikidata .json.bz2 dump into a TSV format representing its adjacency matrix.
+    The subclass of (P279) edges are saved as well, to be compiled with compile-subclasses,
+    the instance of (P31) edges, for the personalized pageranks of compute-pagerank,
+    and the coordinates of the items.
     """
     if outfile is None:
         outfile = '.'.join(filename.split('.')[:-2]+["unsorted.tsv"])
+    if subclasses is None:
+        subclasses = '.'.join(filename.split('.')[:-2]+["subclasses.npy"])
+    if coordinates is None:
+        coordinates = '.'.join(filename.split('.')[:-2]+["coords.npy"])
+    if instances is None:
+        instances = '.'.join(filename.split('.')[:-2]+["instances.npy"])
     g = WikidataGraph()
-    g.preprocess_dump(filename, outfile)
+    g.preprocess_dump(filename, outfile, subclass_fname=subclasses, processes=decompressors,
+                      coords_fname=coordinates, instances_fname=instances)
+
+@click.command()
+@click.argument('filename')
+@click.option('-p', '--profile', multiple=True, help='Indexing profile whose types should be precomputed.')
+@click.option('-r', '--root', multiple=True, help='Class (QID) whose subclasses should be precomputed.')
+@click.option('-o', '--outfile', default=None, help='Output file to save the subclass index to.')
+def compile_subclasses(filename, profile, root, outfile):
+    """
+    Compiles the subclass of (P279) edges extracted by preprocess into a
+    subclass index (.npz), used by the indexing commands instead of SPARQL.
+    """
+    if outfile is None:
+        outfile = '.'.join(filename.split('.')[:-1]+['npz'])
+    roots = list(root)
+    for profile_fname in profile:
+        indexing_profile = IndexingProfile.load(profile_fname)
+        roots += [constraint.qid for constraint in indexing_profile.restrict_types or []]
+    index = SubclassIndex.load(filename)
+    index.save(outfile, roots=sorted(set(roots)))
+
+@click.command()
+@click.argument('filename')
+@click.option('-o', '--outdir', default=None, help='Directory to write the snapshot to.')
+@click.option('-p', '--profile', multiple=True, help='Indexing profile whose language and properties should be kept.')
+@click.option('-l', '--language', multiple=True, help='Language to keep the descriptions in.')
+@click.option('--property', multiple=True, help='Property (PID) to keep the claims of.')
+@click.option('-j', '--decompressors', default=1, help='Number of processes decompressing the dump (bzip2 only)')
+def snapshot(filename, outdir, profile, language, property, decompressors):
+    """
+    Writes the fields of the items of a dump used by the other commands to
+    a snapshot directory, which they can read instead of the dump.
+    """
+    if outdir is None:
+        outdir = '.'.join(filename.split('.')[:-2]+['snapshot'])
+    languages = list(language)
+    # coordinates, extracted by preprocess
+    properties = ['P625'] + list(property)
+    for profile_fname in profile:
+        indexing_profile = IndexingProfile.load(profile_fname)
+        languages.append(indexing_profile.language)
+        properties += [constraint.pid for constraint in indexing_profile.restrict_types or []]
+        properties += indexing_profile.restrict_properties or []
+        properties += [extractor.property for extractor in indexing_profile.alias_properties]
+    with WikidataDumpReader(filename, processes=decompressors, lazy=True) as reader, \
+            SnapshotWriter(outdir, languages=languages, properties=properties) as writer:
+        for idx, item in enumerate(reader):
+            if idx % 10000 == 0:
+                print('\rstep : ' + str(idx), end='', flush=True)
+            writer.add(item)
 
 @click.command()
 @click.argument('filename')
@@ -93,15 +174,45 @@ def compile(filename, outfile):
 @click.command()
 @click.argument('filename')
 @click.option('-o', '--outfile', default=None, help='Output file to save the pagerank vector to.')
-def compute_pagerank(filename, outfile):
+@click.option('-m', '--max-iter', default=16, help='Maximum number of power iterations.')
+@click.option('-t', '--tol', default=1e-6, help='Stop when the L1 norm of the update (of a vector summing to 1) falls below this value.')
+@click.option('--threads', default=None, type=int, help='Number of threads for the sparse products (defaults to the number of CPUs).')
+@click.option('--float32', is_flag=True, help='Compute in single precision, halving the memory needed.')
+@click.option('-p', '--profile', multiple=True, help='Indexing profile for which a personalized pagerank should be computed, teleporting to the items of its types.')
+@click.option('--teleport', multiple=True, help='File listing the QIDs (one per line) of the teleport set of a personalized pagerank, named after the file.')
+@click.option('-d', '--damping', default=0.85, help='Damping factor of the personalized pageranks.')
+@click.option('--subclass-index', default=None, help='Subclass index (.npz file) built with compile-subclasses, used instead of SPARQL queries')
+@click.option('--instances', default=None, help='Instance of (P31) edges (.npy file) saved by preprocess, required by --profile')
+def compute_pagerank(filename, outfile, max_iter, tol, threads, float32, profile, teleport, damping, subclass_index, instances):
     """
     Computes the pagerank of a Wikidata adjacency matrix as represented by a Numpy sparse matrix in NPZ format.
+    Personalized pageranks are saved next to the pagerank, as <outfile>.<name>.npy.
     """
+    if profile and instances is None:
+        raise click.UsageError('--profile requires --instances')
     if outfile is None:
         outfile = '.'.join(filename.split('.')[:-1] + ['pgrank.npy'])
     g = WikidataGraph()
     g.load_from_matrix(filename)
-    g.compute_pagerank()
+
+    teleport_sets = {}
+    type_matcher = TypeMatcher(subclass_index=subclass_index)
+    for profile_fname in profile:
+        indexing_profile = IndexingProfile.load(profile_fname)
+        class_ids = [numpy.zeros(0, dtype=numpy.int64)]
+        for constraint in indexing_profile.restrict_types or []:
+            type_matcher.prefetch_children(constraint.qid)
+            class_ids.append(type_matcher.sets[constraint.qid].to_array())
+        teleport_sets[indexing_profile.name] = g.instances_of(numpy.unique(numpy.concatenate(class_ids)), instances)
+    for teleport_fname in teleport:
+        with open(teleport_fname, 'r') as f:
+            qids = [to_q(line) for line in f]
+        name = os.path.basename(teleport_fname).split('.')[0]
+        teleport_sets[name] = numpy.array([int(qid[1:]) for qid in qids if qid], dtype=numpy.int64)
+
+    g.compute_pagerank(max_iterations=max_iter, tol=tol, num_threads=threads,
+                       dtype=numpy.float32 if float32 else numpy.float64,
+                       teleport_sets=teleport_sets, personalized_damping=damping)
     g.save_pagerank(outfile)
 
 @click.command()
@@ -122,33 +233,121 @@ def pagerank_shell(filename):
 @click.argument('filename')
 @click.option('-p', '--profile', help='Filename of the indexing profile to use')
 @click.option('-s', '--shards', default=1, help='Number of shards to use when creating the collection, if needed')
-@click.option('-k', '--skip', default=0, help='Number of documents to skip because they are already indexed')
-def index_dump(collection_name, filename, profile, shards, skip, solr='http://localhost:8983/solr/'):
+@click.option('-k', '--skip', default=0, help='Number of items of the dump to skip because they are already indexed (see also --checkpoint)')
+@click.option('--subclass-index', default=None, help='Subclass index (.npz file) built with compile-subclasses, used instead of SPARQL queries')
+@click.option('-w', '--workers', default=1, help='Number of processes converting items to documents (more than 1 runs the multiprocess pipeline)')
+@click.option('-u', '--uploaders', default=2, help='Number of threads sending documents to Solr')
+@click.option('-c', '--checkpoint', default=None, help='File where the position in the dump is saved after each commit, and where indexing resumes from if it exists')
+@click.option('-j', '--decompressors', default=1, help='Number of processes decompressing the dump (bzip2 only)')
+@click.option('--compress', is_flag=True, help='Send gzip-compressed updates to Solr')
+@click.option('--dead-letter', default=None, help='File where the updates still failing after retries are written, to be replayed with replay-dead-letters')
+def index_dump(collection_name, filename, profile, shards, skip, subclass_index, workers, uploaders, checkpoint, decompressors, compress, dead_letter, solr='http://localhost:8983/solr/'):
     """
-    Indexes a Wikidata dump in a new Solr collection with the given name.
+    Indexes a Wikidata dump (or a snapshot) in a new Solr collection with the given name.
     Example CLI-command :
     tapioca index-dump frenchtapioca data/latest-all.json.bz2 --profile profiles/human_organization_location.json
     """
-    tagger = TaggerFactory(solr)
+    tagger = TaggerFactory(solr, type_matcher=TypeMatcher(subclass_index=subclass_index),
+                           compress=compress, dead_letter=dead_letter)
     indexing_profile = IndexingProfile.load(profile)
     try:
         tagger.create_collection(collection_name, num_shards=shards, configset=indexing_profile.solrconfig)
     except CollectionAlreadyExists:
         pass
-    dump = WikidataDumpReader(filename)
-    tagger.index_stream(collection_name, dump, indexing_profile,
-                        batch_size=2000, commit_time=10, delete_excluded=False, skip_docs=skip)
+    position = None
+    if checkpoint is not None:
+        position = Checkpoint(checkpoint).load()
+        if position is not None:
+            print('Resuming indexing from position {}'.format(position))
+    # restrictive profiles reject most items after only decoding their types
+    prefilter = indexing_profile.raw_prefilter()
+    lazy = prefilter is not None
+    # items are skipped by the reader, so that they are counted before the prefilter
+    dump = open_dump(filename, position=position, skip=skip, seekable=checkpoint is not None,
+                     processes=decompressors, prefilter=prefilter, lazy=lazy)
+    if isinstance(dump, SnapshotReader):
+        dump.check_profile(indexing_profile)
+    if workers > 1:
+        tagger.index_stream_parallel(collection_name, dump, indexing_profile,
+                            batch_size=2000, commit_time=10, delete_excluded=False,
+                            workers=workers, uploaders=uploaders, checkpoint=checkpoint, lazy=lazy)
+    else:
+        tagger.index_stream(collection_name, dump, indexing_profile,
+                            batch_size=2000, commit_time=10, delete_excluded=False,
+                            checkpoint=checkpoint)
+
+@click.command()
+@click.argument('filename')
+@click.argument('outdir')
+@click.option('-p', '--profile', help='Filename of the indexing profile to use')
+@click.option('-n', '--shards', default=None, type=int, help='Number of parts of the dump exported in parallel, each to its own file (defaults to the number of CPUs, bzip2 dumps and snapshots only)')
+@click.option('-f', '--format', 'fmt', default='jsonl', type=click.Choice(['jsonl', 'csv']), help='Format of the exported documents')
+@click.option('--subclass-index', default=None, help='Subclass index (.npz file) built with compile-subclasses, used instead of SPARQL queries')
+def export_docs(filename, outdir, profile, shards, fmt, subclass_index):
+    """
+    Converts a Wikidata dump (or a snapshot) to Solr documents, written to
+    compressed files in OUTDIR which can be loaded with ingest-docs.
+    """
+    tagger = TaggerFactory(type_matcher=TypeMatcher(subclass_index=subclass_index))
+    indexing_profile = IndexingProfile.load(profile)
+    if shards is None:
+        shardable = os.path.isdir(filename) or filename.endswith('.bz2')
+        shards = os.cpu_count() if shardable else 1
+    prefilter = indexing_profile.raw_prefilter()
+    if os.path.isdir(filename):
+        SnapshotReader(filename).check_profile(indexing_profile)
+    fnames = tagger.export_documents(filename, outdir, indexing_profile, shards=shards, fmt=fmt,
+                                     prefilter=prefilter, lazy=prefilter is not None)
+    print('Exported {} files to {}'.format(len(fnames), outdir))
+
+@click.command()
+@click.argument('collection_name')
+@click.argument('fnames', nargs=-1)
+@click.option('-p', '--profile', help='Filename of the indexing profile to use')
+@click.option('-s', '--shards', default=1, help='Number of shards to use when creating the collection, if needed')
+@click.option('-u', '--uploaders', default=2, help='Number of files sent to Solr at the same time')
+@click.option('-m', '--merge', default=0, help='Load the files in this number of temporary collections in parallel, then merge them into the collection (which must have a single shard)')
+@click.option('--compress', is_flag=True, help='Send the files gzip-compressed, as they are, instead of decompressing them while uploading')
+def ingest_docs(collection_name, fnames, profile, shards, uploaders, merge, compress, solr='http://localhost:8983/solr/'):
+    """
+    Loads the documents exported by export-docs in a Solr collection.
+    """
+    tagger = TaggerFactory(solr, compress=compress)
+    indexing_profile = IndexingProfile.load(profile)
+    try:
+        tagger.create_collection(collection_name, num_shards=shards, configset=indexing_profile.solrconfig)
+    except CollectionAlreadyExists:
+        pass
+    if not merge:
+        tagger.ingest_documents(collection_name, fnames, uploaders=uploaders)
+        return
+    parts = ['{}_part{}'.format(collection_name, i) for i in range(merge)]
+    for part in parts:
+        try:
+            tagger.create_collection(part, configset=indexing_profile.solrconfig)
+        except CollectionAlreadyExists:
+            # left over by an interrupted run: start again from an empty collection
+            tagger.delete_collection(part)
+            tagger.create_collection(part, configset=indexing_profile.solrconfig)
+    with ThreadPoolExecutor(merge) as executor:
+        list(executor.map(lambda i: tagger.ingest_documents(parts[i], fnames[i::merge], uploaders=1), range(merge)))
+    tagger.merge_collections(collection_name, parts)
 
 @click.command()
 @click.argument('collection_name')
 @click.argument('sparql_query_file')
 @click.option('-p', '--profile', help='Filename of the indexing profile to use')
 @click.option('-s', '--shards', default=1, help='Number of shards to use when creating the collection, if needed')
-def index_sparql(collection_name, sparql_query_file, profile, shards, solr='http://localhost:8983/solr/'):
+@click.option('--subclass-index', default=None, help='Subclass index (.npz file) built with compile-subclasses, used instead of SPARQL queries')
+@click.option('--fetchers', default=4, help='Number of concurrent requests fetching the items')
+@click.option('--dead-letter', default=None, help='File where the updates still failing after retries are written, to be replayed with replay-dead-letters (defaults to COLLECTION_NAME.failed.jsonl, such updates are not skipped any more)')
+def index_sparql(collection_name, sparql_query_file, profile, shards, subclass_index, fetchers, dead_letter, solr='http://localhost:8983/solr/'):
     """
     Indexes the results of a SPARQL query which contains an "item" variable pointing to items to index
     """
-    tagger = TaggerFactory(solr)
+    if dead_letter is None:
+        dead_letter = collection_name + '.failed.jsonl'
+    tagger = TaggerFactory(solr, type_matcher=TypeMatcher(subclass_index=subclass_index), dead_letter=dead_letter)
     indexing_profile = IndexingProfile.load(profile)
     try:
         tagger.create_collection(collection_name, num_shards=shards, configset=indexing_profile.solrconfig)
@@ -156,7 +355,7 @@ def index_sparql(collection_name, sparql_query_file, profile, shards, solr='http
         pass
     with open(sparql_query_file, 'r') as f:
         query = f.read()
-    query_results = SparqlReader(query)
+    query_results = SparqlReader(query, workers=fetchers)
     tagger.index_stream(collection_name, query_results, indexing_profile, batch_size=50, commit_time=10, delete_excluded=False)
 
 @click.command()
@@ -164,12 +363,28 @@ def index_sparql(collection_name, sparql_query_file, profile, shards, solr='http
 @click.option('-p', '--profile', help='Filename of the indexing profile to use')
 @click.option('-s', '--shards', default=1, help='Number of shards to use when creating the collection, if needed')
 @click.option('-a', '--after', default=None, help='Start indexing the stream after the given point in time (in the past)')
-def index_stream(collection_name, profile, shards, after, solr='http://localhost:8983/solr/'):
+@click.option('-g', '--graph', default=None, help='Adjacency matrix (.npz file) used to update the pagerank incrementally')
+@click.option('--pagerank', default=None, help='Pagerank (.npy file) to update incrementally with the edges of edited items')
+@click.option('--pagerank-interval', default=600, help='Number of seconds between two refreshes of the pagerank')
+@click.option('--subclass-index', default=None, help='Subclass index (.npz file) built with compile-subclasses, used instead of SPARQL queries')
+@click.option('--compress', is_flag=True, help='Send gzip-compressed updates to Solr')
+@click.option('--dead-letter', default=None, help='File where the updates still failing after retries are written, to be replayed with replay-dead-letters (defaults to COLLECTION_NAME.failed.jsonl, such updates are not skipped any more)')
+@click.option('--coalesce-window', default=0, help='Number of seconds during which edits are collected, so that repeated edits of an item are only fetched once')
+@click.option('--revision-cache-size', default=1000000, help='Number of indexed items whose revision is remembered, to skip edits already indexed and unchanged documents')
+@click.option('--fetchers', default=4, help='Number of concurrent requests fetching the edited items')
+@click.option('--max-rate', default=None, type=float, help='Maximum number of requests per second to the Wikidata API')
+@click.option('-l', '--log-dir', default=None, help='Directory where the edits are recorded before being indexed, and where indexing resumes from')
+@click.option('--replay', is_flag=True, help='Only index the edits already recorded in the log directory, without reading the stream')
+def index_stream(collection_name, profile, shards, after, graph, pagerank, pagerank_interval, subclass_index, compress, dead_letter, coalesce_window, revision_cache_size, fetchers, max_rate, log_dir, replay, solr='http://localhost:8983/solr/'):
     """
     Listens to the Wikidata edit stream and updates a collection according to
-    the given indexing profile.
+    the given indexing profile. If a graph and its pagerank are given, the
+    pagerank is also kept up to date with the edits.
     """
-    tagger = TaggerFactory(solr)
+    if dead_letter is None:
+        dead_letter = collection_name + '.failed.jsonl'
+    tagger = TaggerFactory(solr, type_matcher=TypeMatcher(subclass_index=subclass_index),
+                           compress=compress, dead_letter=dead_letter)
     indexing_profile = IndexingProfile.load(profile)
     try:
         tagger.create_collection(collection_name, num_shards=shards, configset=indexing_profile.solrconfig)
@@ -177,9 +392,55 @@ def index_stream(collection_name, profile, shards, after, solr='http://localhost
         pass
     if after is not None:
         after = dateutil.parser.parse(after)
-    stream = WikidataStreamReader(from_time=after)
+    if replay and log_dir is None:
+        raise click.UsageError('--replay requires --log-dir')
+    checkpoint = None
+    position = None
+    if log_dir is not None:
+        checkpoint = os.path.join(log_dir, 'checkpoint.json')
+        position = Checkpoint(checkpoint).load()
+    revision_cache = RevisionCache(revision_cache_size)
+    stream = WikidataStreamReader(from_time=after, revision_cache=revision_cache, coalesce_window=coalesce_window,
+                                  workers=fetchers, max_rate=max_rate, log_dir=log_dir, position=position,
+                                  follow=not replay)
+    if graph is not None and pagerank is not None:
+        g = WikidataGraph()
+        updated_graph = IncrementalPageRank.matrix_filename(pagerank)
+        if os.path.exists(updated_graph) and os.path.getmtime(updated_graph) > os.path.getmtime(graph):
+            # the matrix updated with the edits indexed before
+            graph = updated_graph
+        g.load_from_matrix(graph)
+        g.load_pagerank(pagerank, mmap=False)
+        stream = IncrementalPageRank(g, pagerank, refresh_interval=pagerank_interval).wrap(stream)
     tagger.index_stream(collection_name, stream, indexing_profile,
-                        batch_size=50, commit_time=1, delete_excluded=True)
+                        batch_size=50, commit_time=1, delete_excluded=True,
+                        revision_cache=revision_cache, checkpoint=checkpoint)
+
+@click.command()
+@click.argument('log_dir')
+@click.option('-a', '--after', default=None, help='Start recording the stream after the given point in time (in the past), if the log is empty')
+def record_stream(log_dir, after):
+    """
+    Records the edits of the Wikidata edit stream in a log directory,
+    to be indexed later with index-stream --log-dir LOG_DIR --replay.
+    """
+    if after is not None:
+        after = dateutil.parser.parse(after)
+    stream = WikidataStreamReader(from_time=after, log_dir=log_dir)
+    with stream:
+        stream.join_recorder()
+
+@click.command()
+@click.argument('filename')
+@click.option('--compress', is_flag=True, help='Send gzip-compressed updates to Solr')
+@click.option('--dead-letter', default=None, help='File where the updates failing again are written')
+def replay_dead_letters(filename, compress, dead_letter, solr='http://localhost:8983/solr/'):
+    """
+    Sends again the updates written to a dead-letter file by index-dump or index-stream.
+    """
+    tagger = TaggerFactory(solr, compress=compress, dead_letter=dead_letter)
+    count = tagger.replay_dead_letters(filename)
+    print('Replayed {} updates'.format(count))
 
 @click.command()
 @click.argument('collection_name')
@@ -194,7 +455,9 @@ def delete_collection(collection_name, solr='http://localhost:8983/solr/'):
 @click.option('-d', '--dataset', default=None, help='Path to the NIF dataset to use as training dataset.')
 @click.option('-o', '--output', default=None, help='Path where the trained classifier should be written.')
 @click.option('-m', '--max-iter', default=500, help='Maximum number of iterations for SVM training.')
-def train_classifier(collection, bow, pagerank, dataset, output, max_iter):
+@click.option('--pagerank-profile', default=None, help='Name of the personalized pagerank to use instead of the global one.')
+@click.option('--coordinates', default=None, help='Path of the coordinates of the items (.coords.npy file, from "tapioca preprocess"), to add a geographic coherence feature.')
+def train_classifier(collection, bow, pagerank, dataset, output, max_iter, pagerank_profile, coordinates):
     """
     Trains a tag classifier on a NIF dataset.
     """
@@ -203,15 +466,19 @@ def train_classifier(collection, bow, pagerank, dataset, output, max_iter):
     b = BOWLanguageModel()
     b.load(bow)
     graph = WikidataGraph()
-    graph.load_pagerank(pagerank)
-    tagger = Tagger(collection, b, graph)
+    graph.load_pagerank(pagerank, profiles=[pagerank_profile] if pagerank_profile else [])
+    tagger = Tagger(collection, b, graph, profile=pagerank_profile)
     d = NIFCollection.load(dataset)
-    clf = SimpleTagClassifier(tagger)
+    store = CoordinateStore.load(coordinates) if coordinates else None
+    clf = SimpleTagClassifier(tagger, coordinates=store)
     max_iter = int(max_iter)
 
+    similarities = [('one_step', 0.2), ('one_step', 0.1), ('one_step',0.3)]
+    if store is not None:
+        similarities.append(('geo_proximity', 0.2))
     parameter_grid = []
     for max_distance in [50, 75, 150, 200]:
-        for similarity, beta in [('one_step', 0.2), ('one_step', 0.1), ('one_step',0.3)]:
+        for similarity, beta in similarities:
             for C in [10.0, 1.0, 0.1]:
                 for smoothing in [0.8, 0.6, 0.5, 0.4, 0.3]:
                     parameter_grid.append({
@@ -232,12 +499,18 @@ cli.add_command(train_bow)
 cli.add_command(train_minibow)
 cli.add_command(bow_shell)
 cli.add_command(preprocess)
+cli.add_command(snapshot)
 cli.add_command(compile)
+cli.add_command(compile_subclasses)
 cli.add_command(compute_pagerank)
 cli.add_command(pagerank_shell)
 cli.add_command(index_dump)
+cli.add_command(export_docs)
+cli.add_command(ingest_docs)
 cli.add_command(index_sparql)
 cli.add_command(index_stream)
+cli.add_command(record_stream)
+cli.add_command(replay_dead_letters)
 cli.add_command(delete_collection)
 cli.add_command(train_classifier)
 
@@ -0,0 +1,181 @@
+import os
+import numpy
+from scipy.spatial import cKDTree
+
+from opentapioca.wikidatagraph import QID_DTYPE
+from opentapioca.wikidatagraph import save_atomically
+
+# mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0088
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distances (in km) between points given by their latitudes
+    and longitudes in degrees, as arrays which are broadcast together.
+    """
+    lat1, lon1, lat2, lon2 = (numpy.radians(numpy.asarray(x, dtype=numpy.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+         numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0., 1.)))
+
+def pairwise_distances(coords):
+    """
+    The matrix of the distances (in km) between all pairs of points
+    of an array of (latitude, longitude) rows. Rows with NaN
+    coordinates have NaN distances.
+    """
+    coords = numpy.asarray(coords).reshape(-1, 2)
+    lat = coords[:, 0]
+    lon = coords[:, 1]
+    return haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+def _to_cartesian(coords):
+    """
+    Points on the unit sphere for (latitude, longitude) rows.
+    """
+    lat = numpy.radians(numpy.asarray(coords, dtype=numpy.float64)[:, 0])
+    lon = numpy.radians(numpy.asarray(coords, dtype=numpy.float64)[:, 1])
+    return numpy.stack([numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)], axis=1)
+
+class CoordinateStore(object):
+    """
+    The coordinates (P625) of the items of a dump, as a float32 array of
+    (latitude, longitude) rows aligned with the sorted array of their QIDs,
+    so that the coordinates of many items are looked up at once.
+
+    A store is saved as two .npy files, which can be memory-mapped:
+    wikidata.coords.npy for the coordinates and wikidata.coords.qids.npy
+    for the QIDs.
+    """
+
+    def __init__(self, qids=None, coords=None):
+        """
+        :param qids: the sorted numeric ids of the items
+        :param coords: the (latitude, longitude) of each item
+        """
+        self.qids = qids if qids is not None else numpy.zeros(0, dtype=QID_DTYPE)
+        self.coords = coords if coords is not None else numpy.zeros((0, 2), dtype=numpy.float32)
+
+    @classmethod
+    def from_pairs(cls, qids, coords):
+        """
+        Builds a store from unsorted numeric ids and their coordinates.
+        """
+        qids = numpy.asarray(qids, dtype=QID_DTYPE)
+        coords = numpy.asarray(coords, dtype=numpy.float32).reshape(-1, 2)
+        order = numpy.argsort(qids, kind='stable')
+        return cls(qids[order], coords[order])
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Builds a store from the coordinates of some items (WikidataItemDocument).
+        """
+        qids = []
+        coords = []
+        for item in items:
+            coordinates = item.get_coordinates()
+            if coordinates is not None:
+                qids.append(int(item.get('id')[1:]))
+                coords.append(coordinates)
+        return cls.from_pairs(qids, coords)
+
+    @staticmethod
+    def qids_filename(fname):
+        """
+        wikidata.coords.npy -> wikidata.coords.qids.npy
+        """
+        return os.path.splitext(fname)[0] + '.qids.npy'
+
+    def save(self, fname):
+        save_atomically(self.qids_filename(fname), self.qids)
+        save_atomically(fname, self.coords)
+
+    @classmethod
+    def load(cls, fname, mmap=True):
+        """
+        :param mmap: map the files in memory (read-only) instead of reading them
+        """
+        mmap_mode = 'r' if mmap else None
+        return cls(numpy.load(cls.qids_filename(fname), mmap_mode=mmap_mode),
+                   numpy.load(fname, mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.qids)
+
+    def __contains__(self, qid):
+        return self.indices([qid])[0] != -1
+
+    def indices(self, qids):
+        """
+        The positions of some items (QIDs or numeric ids) in the store,
+        or -1 for those without coordinates.
+        """
+        ids = numpy.array([int(qid[1:]) if isinstance(qid, str) else qid for qid in qids], dtype=numpy.int64)
+        if not len(self.qids):
+            return numpy.full(len(ids), -1, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.qids, ids).clip(0, len(self.qids) - 1)
+        return numpy.where(self.qids[positions] == ids, positions, -1)
+
+    def get_coords(self, qids):
+        """
+        The coordinates of some items, as an array of (latitude, longitude)
+        rows, which are NaN for the items without coordinates.
+        """
+        positions = self.indices(qids)
+        coords = numpy.full((len(positions), 2), numpy.nan, dtype=numpy.float32)
+        found = positions != -1
+        coords[found] = self.coords[positions[found]]
+        return coords
+
+    def get_coord(self, qid):
+        """
+        :returns: the (latitude, longitude) of an item, or None
+        """
+        latitude, longitude = self.get_coords([qid])[0]
+        if numpy.isnan(latitude):
+            return None
+        return float(latitude), float(longitude)
+
+class SpatialIndex(object):
+    """
+    A KD-tree over the items of a CoordinateStore, to find the
+    items within some distance of a point. Points are placed on the
+    unit sphere, where great-circle distances are monotonic in the
+    straight-line (chord) distances used by the tree.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.tree = cKDTree(_to_cartesian(store.coords)) if len(store) else None
+
+    @staticmethod
+    def _chord(radius):
+        return 2 * numpy.sin(min(radius / EARTH_RADIUS, numpy.pi) / 2)
+
+    def query_radius(self, latitude, longitude, radius):
+        """
+        The numeric ids of the items within a radius (in km) of a point,
+        and their distances to it, sorted by distance.
+        """
+        if self.tree is None:
+            return numpy.zeros(0, dtype=QID_DTYPE), numpy.zeros(0)
+        point = _to_cartesian([[latitude, longitude]])[0]
+        positions = numpy.array(self.tree.query_ball_point(point, self._chord(radius)), dtype=numpy.int64)
+        coords = self.store.coords[positions].reshape(-1, 2)
+        distances = haversine(latitude, longitude, coords[:, 0], coords[:, 1])
+        order = numpy.argsort(distances, kind='stable')
+        return numpy.asarray(self.store.qids[positions[order]]), distances[order]
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        The numeric ids of the k items closest to a point, and their distances to it.
+        """
+        if self.tree is None:
+            return numpy.zeros(0, dtype=QID_DTYPE), numpy.zeros(0)
+        k = min(k, len(self.store))
+        point = _to_cartesian([[latitude, longitude]])[0]
+        _, positions = self.tree.query(point, k=k)
+        positions = numpy.atleast_1d(positions)
+        coords = self.store.coords[positions].reshape(-1, 2)
+        return numpy.asarray(self.store.qids[positions]), haversine(latitude, longitude, coords[:, 0], coords[:, 1])
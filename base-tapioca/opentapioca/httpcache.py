@@ -0,0 +1,82 @@
+import os
+import logging
+import threading
+import requests
+import requests_cache
+
+logger = logging.getLogger(__name__)
+
+# How long the responses of each endpoint are kept (in seconds).
+# Items are also fetched again when a more recent revision is known
+# (see APIReaderBase.fetch_items).
+DEFAULT_EXPIRE_AFTER = {
+    'query.wikidata.org/*': 7 * 24 * 3600,
+    'www.wikidata.org/w/api.php': 24 * 3600,
+    'www.wikidata.org/wiki/Special:EntityData/*': 24 * 3600,
+}
+
+_config = {
+    'cache_name': os.environ.get('TAPIOCA_HTTP_CACHE'),
+    'backend': os.environ.get('TAPIOCA_HTTP_CACHE_BACKEND', 'sqlite'),
+    'expire_after': None,
+    'offline': os.environ.get('TAPIOCA_HTTP_OFFLINE', '') not in ('', '0'),
+}
+_session = None
+_lock = threading.Lock()
+
+def configure(cache_name=None, backend=None, expire_after=None, offline=False):
+    """
+    Configures the cache of the requests made to Wikidata (the Wikidata API,
+    the Wikidata Query Service and entity data), which is used by the sessions
+    created afterwards. By default, it is configured from the TAPIOCA_HTTP_CACHE,
+    TAPIOCA_HTTP_CACHE_BACKEND and TAPIOCA_HTTP_OFFLINE environment variables.
+
+    :param cache_name: the path of the cache (without extension for the
+        'sqlite' backend, a directory for the 'filesystem' one), or None
+        to disable caching
+    :param backend: a requests-cache backend name (TAPIOCA_HTTP_CACHE_BACKEND,
+        or 'sqlite', by default)
+    :param expire_after: a dict from URL patterns to the number of seconds
+        their responses are kept (DEFAULT_EXPIRE_AFTER by default)
+    :param offline: only use the responses in the cache, whatever their age
+        (so that tests can run from a recorded cache)
+    """
+    global _session
+    with _lock:
+        _config.update({
+            'cache_name': cache_name,
+            'backend': backend or os.environ.get('TAPIOCA_HTTP_CACHE_BACKEND', 'sqlite'),
+            'expire_after': expire_after,
+            'offline': offline,
+        })
+        _session = None
+
+def new_session():
+    """
+    Returns a new session, which goes through the cache if it is configured.
+    """
+    if not _config['cache_name']:
+        return requests.Session()
+    if _config['offline']:
+        return requests_cache.CachedSession(_config['cache_name'], backend=_config['backend'],
+                                            expire_after=-1, only_if_cached=True)
+    return requests_cache.CachedSession(_config['cache_name'], backend=_config['backend'],
+                                        urls_expire_after=_config['expire_after'] or DEFAULT_EXPIRE_AFTER,
+                                        expire_after=requests_cache.DO_NOT_CACHE, stale_if_error=True)
+
+def get_session():
+    """
+    Returns the session shared by the calls to Wikidata which do not
+    need their own (see new_session).
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+def is_cached(response):
+    """
+    Was this response read from the cache?
+    """
+    return getattr(response, 'from_cache', False)
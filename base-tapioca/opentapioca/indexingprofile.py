@@ -1,4 +1,6 @@
 import json
+import numpy
+from opentapioca.readers.dumpreader import RawLineFilter
 
 class AliasProperty(object):
     """
@@ -73,6 +75,22 @@ class TypeConstraint(object):
         return any(type_matcher.is_subclass(qid, self.qid)
                           for qid in valid_type_qids)
 
+    def satisfied_many(self, items, type_matcher):
+        """
+        Batched version of satisfied: the types of all items
+        are checked against the target type at once.
+
+        :returns: a boolean array, one value per item
+        """
+        type_ids = []
+        owners = []
+        for idx, item in enumerate(items):
+            for qid in item.get_types(self.pid):
+                type_ids.append(int(qid[1:]))
+                owners.append(idx)
+        matches = type_matcher.are_subclasses(numpy.array(type_ids, dtype=numpy.int64), self.qid)
+        return numpy.bincount(numpy.array(owners, dtype=numpy.int64)[matches], minlength=len(items)) > 0
+
 class IndexingProfile(object):
     """
     Represents a configuration of Tapioca to index
@@ -103,18 +121,49 @@ class IndexingProfile(object):
         self.restrict_properties = restrict_properties
         self.alias_properties = alias_properties or []
 
+    def raw_prefilter(self):
+        """
+        Returns a RawLineFilter which skips the items of a dump which cannot
+        satisfy the restrictions of this profile (because they do not mention
+        any of the restricted properties), without decoding them.
+        :returns: None if all items can be indexed
+        """
+        if not self.restrict_types and not self.restrict_properties:
+            return None
+        pids = [constraint.pid for constraint in self.restrict_types or []]
+        pids += self.restrict_properties or []
+        return RawLineFilter(any_of=['"{}"'.format(pid) for pid in sorted(set(pids))])
+
     def entity_to_document(self, item, type_matcher):
         """
         Given a Wikibase entity, translate it to a Solr document for indexing.
         :param type_matcher: a TypeMatcher to check subclass inclusion
         :returns: None if the entity should be skipped
         """
-        valid_type_qids = item.get_types()
+        return self.entities_to_documents([item], type_matcher)[0]
 
-        type_features = {
-            constraint.qid: constraint.satisfied(item, type_matcher)
+    def entities_to_documents(self, items, type_matcher):
+        """
+        Translates a batch of Wikibase entities to Solr documents,
+        checking the type constraints for all of them at once.
+        :param type_matcher: a TypeMatcher to check subclass inclusion
+        :returns: a list of documents, with None for skipped entities
+        """
+        satisfied = {
+            constraint.qid: constraint.satisfied_many(items, type_matcher)
             for constraint in self.restrict_types or []
         }
+        return [
+            self._to_document(item, {qid: bool(values[idx]) for qid, values in satisfied.items()})
+            for idx, item in enumerate(items)
+        ]
+
+    def _to_document(self, item, type_features):
+        """
+        Builds the Solr document of an item, given which type constraints it satisfies.
+        :returns: None if the entity should be skipped
+        """
+        type_features = dict(type_features)
         type_features.update({
             pid: item.get_identifiers(pid) != []
             for pid in self.restrict_properties or []
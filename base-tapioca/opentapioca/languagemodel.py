@@ -1,10 +1,12 @@
 import pickle
+import os
 
 import re
 from unidecode import unidecode
 from collections import defaultdict
 from math import log
-from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.readers.snapshot import open_dump
+from opentapioca.readers.dumpreader import RawLineFilter
 import json
 from opentapioca.wditem import WikidataItemDocument
 
@@ -104,11 +106,14 @@ class BOWLanguageModel(object):
 
 
     @classmethod
-    def train_from_dump(cls, filename):
+    def train_from_dump(cls, filename, processes=None):
         """
         Trains a bag of words language model from either a .txt
         file (in which case it is read as plain text) or a .json.bz2
-        file (in which case it is read as a wikidata dump).
+        (or .json.gz, .json.zst) file (in which case it is read as a
+        wikidata dump), or a snapshot directory.
+
+        :param processes: the number of processes decompressing the dump
         """
         bow = BOWLanguageModel()
         if filename.endswith('.txt'):
@@ -116,8 +121,10 @@ class BOWLanguageModel(object):
                 for line in f:
                     bow.ingest_phrases([line.strip()])
 
-        elif filename.endswith('.json.bz2'):
-            with WikidataDumpReader(filename) as reader:
+        elif filename.endswith(('.json.bz2', '.json.gz', '.json.zst')) or os.path.isdir(filename):
+            # only items with French terms are used
+            prefilter = RawLineFilter(any_of=['"fr"'])
+            with open_dump(filename, processes=processes, prefilter=prefilter, lazy=True) as reader:
                 for idx, item in enumerate(reader):
                     if idx % 10== 0:
                     #if idx % 10000 == 0:
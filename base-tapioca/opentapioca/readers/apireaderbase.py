@@ -1,46 +1,182 @@
 import logging
+import threading
 import requests
+import email.utils
 
 from time import sleep
+from time import monotonic
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from opentapioca.wditem import WikidataItemDocument
+from opentapioca.httpcache import new_session
+from opentapioca.httpcache import is_cached
 
 logger = logging.getLogger(__name__)
 
+class RateLimiter(object):
+    """
+    Spaces out the requests made by multiple threads so that
+    at most max_rate of them start every second.
+    """
+
+    def __init__(self, max_rate=None):
+        self.interval = 1. / max_rate if max_rate else 0
+        self.next_slot = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+    def pause(self, seconds):
+        """
+        Delays all the following requests (when the server asks to slow down).
+        """
+        with self.lock:
+            self.next_slot = max(self.next_slot, monotonic() + seconds)
+
 class APIReaderBase(object):
     """
     Base class for a reader that relies on the MediaWiki API to fetch
     item contents.
     """
 
-    def __init__(self, mediawiki_api):
+    # maximum number of ids in a wbgetentities request
+    ids_per_request = 50
+
+    def __init__(self, mediawiki_api, workers=4, max_rate=None):
+        """
+        :param workers: the number of wbgetentities requests made concurrently
+        :param max_rate: the maximum number of requests per second (unlimited by default)
+        """
         self.mediawiki_api = mediawiki_api
         self.retries = 5
         self.delay = 5
+        self.workers = workers
+        self.rate_limiter = RateLimiter(max_rate)
+        self.session = new_session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executors = {}
+        self.executor_lock = threading.Lock()
 
-    def fetch_items(self, qids):
+    def _executor(self, name='fetch', workers=None):
+        """
+        Returns a thread pool, created the first time it is needed.
+        """
+        with self.executor_lock:
+            if name not in self.executors:
+                self.executors[name] = ThreadPoolExecutor(workers or self.workers)
+            return self.executors[name]
+
+    def close(self):
+        """
+        Shuts down the thread pools, cancelling the fetches which
+        have not started, and closes the HTTP session.
+        """
+        with self.executor_lock:
+            executors = list(self.executors.values())
+            self.executors.clear()
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+        self.session.close()
+
+    def fetch_items(self, qids, revisions=None):
         """
         Given a list of qids, fetch the corresponding documents via the Wikidata API.
+        Lists of more than 50 qids are fetched by concurrent requests.
+
+        :param revisions: a dict from qids to the minimum revision id to fetch
+            for them (cached responses with older revisions are refreshed)
         """
+        qids = list(qids)
         if not qids:
             return []
+        batches = [qids[i:i+self.ids_per_request] for i in range(0, len(qids), self.ids_per_request)]
+        if len(batches) == 1:
+            return self._fetch_batch(batches[0], revisions)
+        items = []
+        for batch_items in self._executor().map(lambda batch: self._fetch_batch(batch, revisions), batches):
+            items += batch_items
+        return items
+
+    def fetch_items_async(self, qids, revisions=None):
+        """
+        Same as fetch_items, in a background thread. Up to `workers`
+        calls run concurrently.
+
+        :returns: a Future of the list of documents
+        """
+        # not in the pool of fetch_items, which would wait for itself
+        if revisions is None:
+            return self._executor('prefetch').submit(self.fetch_items, qids)
+        return self._executor('prefetch').submit(self.fetch_items, qids, revisions)
+
+    def _fetch_batch(self, qids, revisions=None):
+        """
+        Fetches at most 50 qids, retrying if the request fails.
+        """
+        params = {
+            'format':'json',
+            'action':'wbgetentities',
+            'ids':'|'.join(qids)}
         for retries in range(self.retries):
+            self.rate_limiter.wait()
             try:
-                req = requests.get(self.mediawiki_api, {
-                    'format':'json',
-                    'action':'wbgetentities',
-                    'ids':'|'.join(qids)})
+                req = self.session.get(self.mediawiki_api, params=params)
                 req.raise_for_status()
                 result = req.json().get('entities').values()
+                if is_cached(req) and self._outdated(result, revisions):
+                    req = self.session.get(self.mediawiki_api, params=params, force_refresh=True)
+                    req.raise_for_status()
+                    result = req.json().get('entities').values()
                 return [WikidataItemDocument(payload) for payload in result if 'missing' not in payload]
             except (requests.exceptions.RequestException, ValueError, TypeError, AttributeError) as e:
                 logger.warning(e)
                 if retries < self.retries-1:
-                    sleep_time = (1+retries)*self.delay
+                    sleep_time = self._retry_after(getattr(e, 'response', None))
+                    if sleep_time is not None:
+                        self.rate_limiter.pause(sleep_time)
+                    else:
+                        sleep_time = (1+retries)*self.delay
                     logger.info('Retrying wbgetentities in {}'.format(sleep_time))
                     sleep(sleep_time)
                 else:
-                    logger.error('Failed to fetch entities')
-                    logger.error(req.url)
+                    logger.error('Failed to fetch entities {}'.format('|'.join(qids)))
                     raise
 
+    def _outdated(self, entities, revisions):
+        """
+        Is any of the entities older than the revision required for it?
+        """
+        if not revisions:
+            return False
+        for payload in entities:
+            revid = revisions.get(payload.get('id'))
+            if revid is not None and payload.get('lastrevid', 0) < revid:
+                return True
+        return False
 
+    def _retry_after(self, response):
+        """
+        The number of seconds to wait before retrying, as requested by
+        the Retry-After header of a response (if any).
+        """
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0., float(value))
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0., date.timestamp() - time())
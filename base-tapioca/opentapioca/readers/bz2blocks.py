@@ -0,0 +1,275 @@
+import os
+import bz2
+import mmap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Magic numbers (48 bits each) starting a compressed block and ending
+# a bzip2 stream. They are not byte-aligned in the compressed file.
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+
+def _shifted_patterns(magic):
+    """
+    For each of the 8 possible bit alignments of a 48-bit magic number,
+    the 5 bytes which are fully determined by it (searched for with
+    `find`) and the masked bytes before and after them.
+    """
+    patterns = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, 'big')
+        first_mask = 0xff >> shift
+        last_mask = (0xff << (8 - shift)) & 0xff
+        patterns.append((shift, window[1:6], window[0], first_mask, window[6], last_mask))
+    return patterns
+
+_PATTERNS = {
+    BLOCK_MAGIC: _shifted_patterns(BLOCK_MAGIC),
+    EOS_MAGIC: _shifted_patterns(EOS_MAGIC),
+}
+
+# Upper bound on the size of a compressed block (of at most 900kB)
+MAX_BLOCK_BYTES = 1 << 21
+
+def find_magic(data, magic, start_bit=0, end_bit=None):
+    """
+    Finds the first occurrence of a magic number in the data
+    at a bit offset between start_bit and end_bit (by default,
+    the maximum size of a block after start_bit).
+
+    :returns: the bit offset, or None if it was not found
+    """
+    if end_bit is None:
+        end_bit = start_bit + 8 * MAX_BLOCK_BYTES
+    best = None
+    for shift, key, first, first_mask, last, last_mask in _PATTERNS[magic]:
+        limit = (best if best is not None else end_bit) // 8 + 7
+        pos = data.find(key, max(1, start_bit // 8), limit)
+        while pos != -1:
+            bit_offset = (pos - 1) * 8 + shift
+            if bit_offset >= end_bit or (best is not None and bit_offset >= best):
+                break
+            if (bit_offset >= start_bit and
+                    (data[pos - 1] & first_mask) == (first & first_mask) and
+                    (last_mask == 0 or
+                     (pos + 5 < len(data) and (data[pos + 5] & last_mask) == last))):
+                best = bit_offset
+                break
+            pos = data.find(key, pos + 1, limit)
+    return best
+
+def _read_bits(data, start_bit, end_bit):
+    """
+    Reads the bits between two offsets as an integer.
+    """
+    chunk = data[start_bit // 8:(end_bit + 7) // 8]
+    value = int.from_bytes(chunk, 'big')
+    value >>= len(chunk) * 8 - (end_bit - start_bit) - start_bit % 8
+    return value & ((1 << (end_bit - start_bit)) - 1)
+
+def decompress_block(data, start_bit, end_bit):
+    """
+    Decompresses a single block, which starts with a block magic at
+    start_bit and ends at end_bit, by wrapping it in a bzip2 stream
+    of its own. The stream CRC of a single-block stream is the CRC of
+    its block, which follows the block magic.
+
+    :raises OSError: if this is not a valid block
+    """
+    nb_bits = end_bit - start_bit
+    block = _read_bits(data, start_bit, end_bit)
+    crc = _read_bits(data, start_bit + 48, start_bit + 80)
+    stream = (block << 80) | (EOS_MAGIC << 32) | crc
+    nb_bits += 80
+    padding = -nb_bits % 8
+    stream = b'BZh9' + (stream << padding).to_bytes((nb_bits + padding) // 8, 'big')
+    return bz2.decompress(stream)
+
+def block_boundaries(data, start_bit=0):
+    """
+    Generates the (start, end) bit offsets of the compressed blocks of a
+    bzip2 file, starting from the block at start_bit. Concatenated streams
+    (as produced by parallel compressors) are supported.
+    """
+    start = find_magic(data, BLOCK_MAGIC, start_bit)
+    while start is not None:
+        next_block = find_magic(data, BLOCK_MAGIC, start + 48)
+        # the stream can only end before the next block
+        end = find_magic(data, EOS_MAGIC, start + 48, next_block)
+        if end is None:
+            end = next_block
+        if end is None:
+            return
+        yield start, end
+        start = next_block
+
+def iter_blocks(data, start_bit=0):
+    """
+    Generates the (bit offset, decompressed data) of each block
+    of a bzip2 file, from the block at start_bit.
+
+    Since the magic numbers are not escaped in the compressed data,
+    they can appear by chance in a block: such a block fails to
+    decompress, in which case it is merged with the following one.
+    """
+    pending = None
+    for start, end in block_boundaries(data, start_bit):
+        if pending is not None:
+            start = pending
+        try:
+            yield start, decompress_block(data, start, end)
+            pending = None
+        except (OSError, ValueError):
+            pending = start
+    if pending is not None:
+        raise OSError('Invalid bzip2 block at bit offset {}'.format(pending))
+
+# memory maps of the files read by each decompression process
+_mapped_files = {}
+
+def _decompress_file_block(fname, start_bit, end_bit):
+    if fname not in _mapped_files:
+        with open(fname, 'rb') as f:
+            _mapped_files[fname] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return decompress_block(_mapped_files[fname], start_bit, end_bit)
+
+def iter_blocks_parallel(fname, data, start_bit=0, processes=None):
+    """
+    Same as iter_blocks, except that the blocks are decompressed
+    ahead by a pool of processes. The blocks are still generated
+    in order.
+
+    :param fname: the name of the file mapped in data
+    """
+    processes = processes or os.cpu_count()
+    executor = ProcessPoolExecutor(processes)
+    try:
+        boundaries = block_boundaries(data, start_bit)
+        in_flight = deque()
+        pending = None
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < 2 * processes:
+                try:
+                    start, end = next(boundaries)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight.append((start, end, executor.submit(_decompress_file_block, fname, start, end)))
+            if not in_flight:
+                break
+            start, end, future = in_flight.popleft()
+            try:
+                if pending is None:
+                    block = future.result()
+                else:
+                    # a magic number appeared by chance in the previous block
+                    future.cancel()
+                    block = decompress_block(data, pending, end)
+                    start = pending
+                yield start, block
+                pending = None
+            except (OSError, ValueError):
+                if pending is None:
+                    pending = start
+        if pending is not None:
+            raise OSError('Invalid bzip2 block at bit offset {}'.format(pending))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+class Bz2BlockFile(object):
+    """
+    Reads the lines of a bzip2 file block by block, so that
+    the position of each line can be recorded and jumped to
+    without decompressing the file from the beginning,
+    blocks can be decompressed in parallel and the file can
+    be split in shards read independently.
+
+    Positions are (bit offset of a block, byte offset in the
+    decompressed block) pairs.
+    """
+
+    def __init__(self, fname, position=None, processes=None):
+        """
+        :param position: the position to start reading from, as returned by tell()
+        :param processes: the number of processes decompressing blocks
+            (by default, blocks are decompressed in this process)
+        """
+        self.fname = fname
+        self.f = open(fname, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.position = tuple(position) if position is not None else (0, 0)
+        self.processes = processes
+
+    def tell(self):
+        """
+        The position of the next line to be read.
+        """
+        return self.position
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+    def _blocks(self, start_bit):
+        if self.processes is not None and self.processes > 1:
+            return iter_blocks_parallel(self.fname, self.data, start_bit, self.processes)
+        return iter_blocks(self.data, start_bit)
+
+    def __iter__(self):
+        start_bit, skip = self.position
+        return self._lines(start_bit, skip)
+
+    def shard(self, index, nb_shards):
+        """
+        Generates the lines of one of nb_shards shards of the file,
+        which can be read independently. Shards are contiguous byte
+        ranges of the compressed file. Each line belongs to the shard
+        where its first block starts, except the first line of each block
+        starting a shard, which belongs to the previous shard.
+        """
+        nb_bits = 8 * len(self.data)
+        start_bit = find_magic(self.data, BLOCK_MAGIC, index * nb_bits // nb_shards)
+        stop_bit = None
+        if index < nb_shards - 1:
+            stop_bit = find_magic(self.data, BLOCK_MAGIC, (index + 1) * nb_bits // nb_shards)
+        if start_bit is None or start_bit == stop_bit:
+            return iter([])
+        return self._lines(start_bit, 0, stop_bit=stop_bit, skip_first_line=index > 0)
+
+    def _lines(self, start_bit, skip, stop_bit=None, skip_first_line=False):
+        """
+        Generates the lines from a position, up to the end of the line
+        running over the block at stop_bit.
+        """
+        carry = b''
+        started = not skip_first_line
+        for offset, block in self._blocks(start_bit):
+            begin = 0
+            if skip:
+                begin, skip = skip, 0
+            if stop_bit is not None and offset >= stop_bit:
+                # only finish the last line
+                end = block.find(b'\n')
+                if end == -1:
+                    carry += block
+                    continue
+                self.position = (offset, end + 1)
+                if started:
+                    yield (carry + block[:end]).decode('utf-8')
+                return
+            while True:
+                end = block.find(b'\n', begin)
+                if end == -1:
+                    carry += block[begin:]
+                    break
+                line = carry + block[begin:end]
+                carry = b''
+                begin = end + 1
+                self.position = (offset, begin)
+                if started:
+                    yield line.decode('utf-8')
+                started = True
+        if carry and started:
+            self.position = (offset, len(block))
+            yield carry.decode('utf-8')
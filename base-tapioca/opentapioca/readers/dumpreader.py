@@ -1,21 +1,97 @@
 import bz2
-import json
+import gzip
+import io
+import re
 import sys
 from opentapioca.wditem import WikidataItemDocument
+from opentapioca.wditem import LazyWikidataItemDocument
+from opentapioca.readers.bz2blocks import Bz2BlockFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# orjson decodes items much faster, when it is installed
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+id_re = re.compile(r'"id"\s*:\s*"([A-Z])')
+
+class RawLineFilter(object):
+    """
+    A filter on the raw JSON representation of items, to skip
+    items without decoding them. It must only reject items which
+    would be discarded anyway after decoding.
+    """
+
+    def __init__(self, any_of=(), id_prefixes=None):
+        """
+        :param any_of: keep items containing one of these strings,
+            such as '"P31"' for items with a P31 claim
+        :param id_prefixes: keep items whose id starts with one of these
+            letters (such as 'Q'). This relies on the id of the item being
+            the first one in its representation, as in Wikidata dumps.
+        """
+        self.any_of = list(any_of)
+        self.id_prefixes = id_prefixes
+
+    def __call__(self, line):
+        if self.id_prefixes is not None:
+            match = id_re.search(line)
+            if match is None or match.group(1) not in self.id_prefixes:
+                return False
+        return not self.any_of or any(substring in line for substring in self.any_of)
 
 class WikidataDumpReader(object):
     """
     Generates a stream of `WikidataItemDocument` from
-    a Wikidata dump.
+    a Wikidata dump, compressed with bzip2, gzip (.gz)
+    or zstd (.zst, which requires the zstandard package).
     """
     
-    def __init__(self, fname):
+    def __init__(self, fname, position=None, seekable=False, processes=None, prefilter=None, lazy=False, skip=0):
+        """
+        :param position: resume reading at this position, as returned by tell()
+        :param seekable: read the dump block by block, so that tell() can be used
+        :param processes: the number of processes decompressing the dump (bzip2 only)
+        :param prefilter: a function (such as a RawLineFilter) which is given the
+            raw JSON representation of each item, which is skipped if it returns False
+        :param lazy: generate LazyWikidataItemDocument objects, which only decode
+            the fields which are used
+        :param skip: the number of items to skip at the beginning of the dump
+            (or after the position), counted before the prefilter
+        """
         self.fname = fname
+        self.prefilter = prefilter
+        self.lazy = lazy
+        self.skip = skip
         if fname == '-':
             self.f = sys.stdin
+        elif fname.endswith('.gz'):
+            self.f = gzip.open(fname, mode='rt', encoding='utf-8')
+        elif fname.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError('Reading .zst dumps requires the zstandard package')
+            self.f = io.TextIOWrapper(
+                zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), read_across_frames=True, closefd=True),
+                encoding='utf-8')
+        elif seekable or position is not None or (processes or 1) > 1:
+            self.f = Bz2BlockFile(fname, position=position, processes=processes)
         else:
             self.f = bz2.open(fname, mode='rt', encoding='utf-8')
 
+    def tell(self):
+        """
+        The position of the next item to be read, which can be passed
+        to the constructor to resume reading there (for seekable readers only).
+        """
+        if not isinstance(self.f, Bz2BlockFile):
+            return None
+        return self.f.tell()
+
     def __enter__(self):
         return self
 
@@ -23,16 +99,53 @@ class WikidataDumpReader(object):
         if self.fname != '-':
             self.f.close()
 
+    def lines(self):
+        """
+        Generates the raw JSON representation of each item in the
+        dump, without parsing it (so that it can be parsed elsewhere).
+        """
+        return self._strip(self.f)
+
+    def _strip(self, lines):
+        for line in lines:
+            line = line.rstrip()
+            # remove the trailing comma
+            if line.endswith(','):
+                line = line[:-1]
+            # skip the beginning and end of dumps with '[', ']'
+            if not line.startswith('{'):
+                continue
+            if self.skip > 0:
+                self.skip -= 1
+                continue
+            if self.prefilter is None or self.prefilter(line):
+                yield line
+
     def __iter__(self):
-        for line in self.f:
+        return self._items(self.lines())
+
+    def iter_shard(self, index, nb_shards):
+        """
+        Generates the items of one of nb_shards disjoint parts of
+        the dump, which can be read by independent workers (bzip2
+        dumps only). Together, the shards cover the entire dump.
+        """
+        if self.fname == '-' or not self.fname.endswith('.bz2'):
+            raise ValueError('Only bzip2 dumps can be split in shards')
+        if not isinstance(self.f, Bz2BlockFile):
+            self.f.close()
+            self.f = Bz2BlockFile(self.fname)
+        return self._items(self._strip(self.f.shard(index, nb_shards)))
+
+    def _items(self, lines):
+        for line in lines:
+            if self.lazy:
+                yield LazyWikidataItemDocument(line)
+                continue
             try:
-                # remove the trailing comma
-                if line.rstrip().endswith(','):
-                    line = line[:-2]
-                item = json.loads(line)
+                item = loads(line)
                 yield WikidataItemDocument(item)
             except ValueError as e:
-                # Happens at the beginning or end of dumps with '[', ']'
                 continue
 
 
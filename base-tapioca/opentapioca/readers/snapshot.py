@@ -0,0 +1,343 @@
+import os
+import json
+import numpy
+from array import array
+from collections import Counter
+
+from opentapioca.wditem import WikidataItemDocument
+from opentapioca.readers.dumpreader import WikidataDumpReader
+
+SNAPSHOT_VERSION = 1
+
+# columns of integers, one value per item
+SCALAR_COLUMNS = {
+    'lastrevid': numpy.int64,
+    'nb_statements': numpy.int32,
+    'nb_sitelinks': numpy.int32,
+}
+# columns of lists of numeric ids
+ID_LIST_COLUMNS = ['P31', 'P279', 'edges', 'p31_edges']
+# columns of strings (JSON for the structured ones)
+STRING_COLUMNS = ['id', 'labels', 'aliases', 'descriptions', 'claims']
+
+class SnapshotWriter(object):
+    """
+    Writes the fields of Wikidata items used by OpenTapioca to a
+    snapshot: a directory of flat binary files (one or two per column)
+    which can be memory-mapped by a SnapshotReader. All columns are
+    written to disk as items are added, so that writing a snapshot of
+    a full dump only needs a small buffer per column.
+
+    For each item, the snapshot stores its id, revision, number of
+    statements and sitelinks, labels and aliases in all languages,
+    descriptions in the given languages, the values of its P31 and P279
+    claims, its outgoing edges and its claims for the given properties.
+    """
+
+    # the number of integers buffered per column before they are written
+    buffer_size = 1 << 16
+
+    def __init__(self, dirname, languages=(), properties=()):
+        """
+        :param languages: the languages to keep descriptions for
+        :param properties: the properties to keep claims for (such as
+            the identifiers used in indexing profiles)
+        """
+        self.dirname = dirname
+        self.languages = sorted(set(languages))
+        self.properties = sorted(set(properties))
+        os.makedirs(dirname, exist_ok=True)
+        self.count = 0
+        self.files = {}
+        # integer columns, written to raw files converted to .npy files on close
+        self.int_columns = {}
+        for column, dtype in SCALAR_COLUMNS.items():
+            self._add_int_column(column, column + '.npy', dtype)
+        self.ends = {}
+        for column in ID_LIST_COLUMNS + STRING_COLUMNS:
+            self.files[column] = open(self._values_fname(column), 'wb')
+            self._add_int_column(column + '.offsets', column + '.offsets.npy', numpy.int64)
+            self.ends[column] = 0
+            self._append_int(column + '.offsets', 0)
+
+    def _values_fname(self, column):
+        return os.path.join(self.dirname, column + '.values')
+
+    def _add_int_column(self, name, npy_fname, dtype):
+        raw_fname = os.path.join(self.dirname, name + '.tmp')
+        self.int_columns[name] = (open(raw_fname, 'wb'), array('q'), raw_fname, npy_fname, dtype)
+
+    def _append_int(self, name, value):
+        f, buf, _, _, dtype = self.int_columns[name]
+        buf.append(value)
+        if len(buf) >= self.buffer_size:
+            self._flush_int(name)
+
+    def _flush_int(self, name):
+        f, buf, _, _, dtype = self.int_columns[name]
+        numpy.array(buf, dtype=dtype).tofile(f)
+        del buf[:]
+
+    def _save_int_column(self, name):
+        """
+        Converts the raw file of an integer column to a .npy file,
+        chunk by chunk.
+        """
+        self._flush_int(name)
+        f, _, raw_fname, npy_fname, dtype = self.int_columns[name]
+        f.close()
+        length = os.path.getsize(raw_fname) // numpy.dtype(dtype).itemsize
+        out = numpy.lib.format.open_memmap(os.path.join(self.dirname, npy_fname),
+                                           mode='w+', dtype=dtype, shape=(length,))
+        with open(raw_fname, 'rb') as f:
+            for start in range(0, length, self.buffer_size):
+                chunk = numpy.fromfile(f, dtype=dtype, count=self.buffer_size)
+                out[start:start+len(chunk)] = chunk
+        out.flush()
+        del out
+        os.remove(raw_fname)
+
+    def _append(self, column, values):
+        """
+        Appends the value of a column for the next item (offsets of
+        string columns are in bytes, and in ids for the other ones).
+        """
+        data = values.encode('utf-8') if isinstance(values, str) else numpy.array(values, dtype=numpy.int64)
+        self.files[column].write(data if isinstance(data, bytes) else data.tobytes())
+        self.ends[column] += len(data)
+        self._append_int(column + '.offsets', self.ends[column])
+
+    def add(self, item):
+        """
+        Adds an item (a WikidataItemDocument) to the snapshot.
+        """
+        self._append_int('lastrevid', item.get('lastrevid') or 0)
+        self._append_int('nb_statements', item.get_nb_statements())
+        self._append_int('nb_sitelinks', item.get_nb_sitelinks())
+
+        self._append('P31', [int(qid[1:]) for qid in item.get_types('P31')])
+        self._append('P279', [int(qid[1:]) for qid in item.get_types('P279')])
+        edges = item.get_outgoing_edges(include_p31=False)
+        self._append('edges', edges)
+        # the edges of the P31 claims (including their qualifiers)
+        p31_edges = Counter(item.get_outgoing_edges(include_p31=True)) - Counter(edges)
+        self._append('p31_edges', list(p31_edges.elements()))
+
+        self._append('id', item.get('id'))
+        self._append('labels', json.dumps({
+            lang: label['value'] for lang, label in item.get('labels', {}).items()
+        }, ensure_ascii=False))
+        self._append('aliases', json.dumps({
+            lang: [alias['value'] for alias in aliases]
+            for lang, aliases in item.get('aliases', {}).items()
+        }, ensure_ascii=False))
+        descriptions = item.get('descriptions', {})
+        self._append('descriptions', json.dumps({
+            lang: descriptions[lang]['value'] for lang in self.languages if lang in descriptions
+        }, ensure_ascii=False))
+        claims = {}
+        for pid in self.properties:
+            values = [
+                claim['mainsnak']['datavalue']['value']
+                for claim in item.get_claims(pid)
+                if 'datavalue' in claim.get('mainsnak', {})
+            ]
+            if values:
+                claims[pid] = values
+        self._append('claims', json.dumps(claims, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        """
+        Writes the remaining columns and the metadata of the snapshot.
+        """
+        for column, f in self.files.items():
+            f.close()
+        for name in self.int_columns:
+            self._save_int_column(name)
+        with open(os.path.join(self.dirname, 'snapshot.json'), 'w') as f:
+            json.dump({
+                'version': SNAPSHOT_VERSION,
+                'count': self.count,
+                'languages': self.languages,
+                'properties': self.properties,
+            }, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+class SnapshotItemDocument(WikidataItemDocument):
+    """
+    An item read from a snapshot. It supports the same accessors
+    as WikidataItemDocument, restricted to the fields in the snapshot.
+    """
+
+    def __init__(self, row, properties):
+        """
+        :param row: a dict from column names to the values for this item
+        :param properties: the properties whose claims are in the snapshot
+        """
+        self.row = row
+        self.properties = properties
+        self.fields = {}
+
+    @property
+    def json(self):
+        return {field: self.get(field) for field in ['id', 'lastrevid', 'labels', 'aliases', 'descriptions']}
+
+    def _decoded(self, column):
+        if column not in self.fields:
+            self.fields[column] = json.loads(self.row[column])
+        return self.fields[column]
+
+    def get(self, field, default_value=None):
+        if field in ('id', 'lastrevid'):
+            return self.row[field]
+        elif field == 'labels' or field == 'descriptions':
+            return {
+                lang: {'language': lang, 'value': value}
+                for lang, value in self._decoded(field).items()
+            }
+        elif field == 'aliases':
+            return {
+                lang: [{'language': lang, 'value': value} for value in values]
+                for lang, values in self._decoded(field).items()
+            }
+        elif field == 'claims':
+            raise ValueError('Snapshots do not store entire claims, use get_claims instead')
+        return default_value
+
+    def get_claims(self, pid):
+        if pid in ('P31', 'P279'):
+            values = [
+                {'entity-type': 'item', 'numeric-id': int(id), 'id': 'Q{}'.format(id)}
+                for id in self.row[pid]
+            ]
+        elif pid in self.properties:
+            values = self._decoded('claims').get(pid, [])
+        else:
+            raise ValueError('The claims for {} are not stored in the snapshot'.format(pid))
+        return [{'mainsnak': {'datavalue': {'value': value}}} for value in values]
+
+    def get_outgoing_edges(self, include_p31=True, numeric=True):
+        if not numeric:
+            raise ValueError('Snapshots only store numeric ids')
+        edges = list(self.row['edges'])
+        if include_p31:
+            edges += self.row['p31_edges']
+        return edges
+
+    def get_nb_statements(self):
+        return self.row['nb_statements']
+
+    def get_nb_sitelinks(self):
+        return self.row['nb_sitelinks']
+
+class SnapshotReader(object):
+    """
+    Generates the items stored in a snapshot (as SnapshotItemDocument
+    objects). The snapshot is memory-mapped, so that multiple readers
+    can read it in parallel, for instance each on its own shard.
+    """
+
+    def __init__(self, dirname, position=None):
+        """
+        :param position: the index of the item to start reading from,
+            as returned by tell()
+        """
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'snapshot.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: {}'.format(meta.get('version')))
+        self.count = meta['count']
+        self.languages = meta['languages']
+        self.properties = frozenset(meta['properties'])
+        self.position = position or 0
+
+        self.columns = {}
+        for column in SCALAR_COLUMNS:
+            self.columns[column] = numpy.load(os.path.join(dirname, column + '.npy'), mmap_mode='r')
+        for column in ID_LIST_COLUMNS + STRING_COLUMNS:
+            offsets = numpy.load(os.path.join(dirname, column + '.offsets.npy'), mmap_mode='r')
+            dtype = numpy.uint8 if column in STRING_COLUMNS else numpy.int64
+            fname = os.path.join(dirname, column + '.values')
+            if os.path.getsize(fname):
+                values = numpy.memmap(fname, dtype=dtype, mode='r')
+            else:
+                values = numpy.zeros(0, dtype=dtype)
+            self.columns[column] = (offsets, values)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+    def tell(self):
+        """
+        The index of the next item to be read.
+        """
+        return self.position
+
+    def check_profile(self, profile):
+        """
+        Checks that the snapshot stores the fields needed by an indexing profile.
+
+        :raises ValueError: if it does not
+        """
+        pids = [constraint.pid for constraint in profile.restrict_types or []]
+        pids += profile.restrict_properties or []
+        pids += [extractor.property for extractor in profile.alias_properties]
+        missing = set(pids) - self.properties - {'P31', 'P279'}
+        if missing:
+            raise ValueError('The snapshot does not store the claims for {}'.format(', '.join(sorted(missing))))
+        if profile.language not in self.languages:
+            raise ValueError('The snapshot does not store descriptions in {}'.format(profile.language))
+
+    def item(self, idx):
+        """
+        Returns the item at a given index in the snapshot.
+        """
+        row = {}
+        for column in SCALAR_COLUMNS:
+            row[column] = int(self.columns[column][idx])
+        for column in ID_LIST_COLUMNS + STRING_COLUMNS:
+            offsets, values = self.columns[column]
+            value = values[offsets[idx]:offsets[idx+1]]
+            if column in STRING_COLUMNS:
+                row[column] = value.tobytes().decode('utf-8')
+            else:
+                row[column] = value.tolist()
+        return SnapshotItemDocument(row, self.properties)
+
+    def _items(self, start, stop):
+        for idx in range(start, stop):
+            self.position = idx + 1
+            yield self.item(idx)
+
+    def __iter__(self):
+        return self._items(self.position, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def iter_shard(self, index, nb_shards):
+        """
+        Generates the items of one of nb_shards disjoint parts of the snapshot.
+        """
+        return self._items(index * self.count // nb_shards, (index + 1) * self.count // nb_shards)
+
+def open_dump(fname, position=None, skip=0, **kwargs):
+    """
+    Opens a Wikidata dump, or a snapshot if the filename is a directory.
+    The other arguments are passed to WikidataDumpReader.
+
+    :param skip: the number of items to skip after the position
+    """
+    if os.path.isdir(fname):
+        return SnapshotReader(fname, position=(position or 0) + skip)
+    return WikidataDumpReader(fname, position=position, skip=skip, **kwargs)
@@ -1,9 +1,8 @@
-import json
-import re
 import logging
+from collections import deque
 
 from .apireaderbase import APIReaderBase
-from opentapioca.sparqlwikidata import sparql_wikidata
+from opentapioca.sparqlwikidata import sparql_wikidata_bindings
 from opentapioca.utils import to_q
 
 logger = logging.getLogger(__name__)
@@ -17,31 +16,50 @@ class SparqlReader(APIReaderBase):
     def __init__(self,
                  query,
                  endpoint='https://query.wikidata.org/sparql',
-                 mediawiki_api='https://www.wikidata.org/w/api.php'):
-        super(SparqlReader, self).__init__(mediawiki_api)
+                 mediawiki_api='https://www.wikidata.org/w/api.php',
+                 workers=4):
+        """
+        :param workers: the number of batches of items fetched concurrently
+        """
+        super(SparqlReader, self).__init__(mediawiki_api, workers=workers)
         self.endpoint = endpoint
         self.query = query
         self.batch_size = 50
         self.query_results = None
 
     def __enter__(self):
-        self.query_results = sparql_wikidata(self.query, endpoint=self.endpoint)['bindings']
+        self.query_results = sparql_wikidata_bindings(self.query, endpoint=self.endpoint)
         return self
 
     def __exit__(self, *args, **kwargs):
+        if self.query_results is not None:
+            self.query_results.close()
+        self.close()
         return None
 
+    def _batches(self):
+        """
+        Generates the lists of qids of the results, by batches.
+        """
+        batch = []
+        for result in self.query_results:
+            qid = to_q(result['item']['value']) if 'item' in result else None
+            if qid:
+                batch.append(qid)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def __iter__(self):
         if self.query_results is None:
             raise ValueError('Query results have not been fetched.')
-        while self.query_results:
-            batch = self.query_results[:self.batch_size]
-            self.query_results = self.query_results[self.batch_size:]
-
-            qids = [to_q(result['item']['value']) for result in batch if 'item' in result]
-            qids_without_none = [qid for qid in qids if qid]
-
-            # Fetch item contents
-            for item in self.fetch_items(qids_without_none):
-                yield item
-
+        # Fetch item contents, a few batches ahead
+        in_flight = deque()
+        for qids in self._batches():
+            in_flight.append(self._executor().submit(self.fetch_items, qids))
+            if len(in_flight) >= self.workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
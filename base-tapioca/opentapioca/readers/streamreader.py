@@ -1,12 +1,116 @@
+import os
 import json
 import re
+import time
 import logging
+import threading
+from collections import deque
 
 from sseclient import SSEClient
 from .apireaderbase import APIReaderBase
 
 logger = logging.getLogger(__name__)
 
+class StreamLog(object):
+    """
+    A local append-only log of the edits read from the edit stream,
+    stored in a directory along with the id and time of the last event
+    recorded, so that the stream can be resumed exactly where it stopped.
+
+    Each line of the log is an edited qid and its new revision id
+    (empty if unknown), separated by a tab. Positions in the log are
+    byte offsets.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        self.log_fname = os.path.join(dirname, 'edits.log')
+        self.state_fname = os.path.join(dirname, 'state.json')
+
+    def load_state(self):
+        """
+        :returns: a dict with the id and time of the last event recorded
+            ('last_event_id' and 'timestamp'), empty if no event was recorded
+        """
+        if not os.path.exists(self.state_fname):
+            return {}
+        with open(self.state_fname, 'r') as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        """
+        Saves the id and time of the last event recorded, atomically.
+        """
+        tmp_fname = self.state_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_fname, self.state_fname)
+
+    def record(self, events, parse_change, flush_interval=1):
+        """
+        Appends the edits of a stream of events to the log. The id of the
+        last event is saved after the edits before it are flushed to the log.
+
+        :param parse_change: a function returning the (qid, revid) pair of
+            the edit of an event, or None if it should be ignored
+        :param flush_interval: the number of seconds between two flushes
+        """
+        state = self.load_state()
+        last_flush = time.monotonic()
+        with open(self.log_fname, 'a') as f:
+            for event in events:
+                if event.event != 'message':
+                    continue
+                change = parse_change(event)
+                if change is not None:
+                    qid, revid = change
+                    f.write('{}\t{}\n'.format(qid, revid if revid is not None else ''))
+                state['last_event_id'] = getattr(event, 'id', None) or state.get('last_event_id')
+                try:
+                    state['timestamp'] = json.loads(event.data).get('timestamp', state.get('timestamp'))
+                except ValueError:
+                    pass
+                if time.monotonic() - last_flush >= flush_interval:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.save_state(state)
+                    last_flush = time.monotonic()
+            f.flush()
+            self.save_state(state)
+
+    def changes(self, position=0, follow=False, poll_interval=0.5, is_recording=None):
+        """
+        Generates the (qid, revid, position after the edit) triples of
+        the edits in the log, from a position.
+
+        :param follow: wait for new edits at the end of the log,
+            instead of stopping there
+        :param is_recording: when following, a function called at the end of
+            the log, returning False once no more edits will be recorded
+        """
+        if not os.path.exists(self.log_fname):
+            open(self.log_fname, 'a').close()
+        stopping = False
+        with open(self.log_fname, 'rb') as f:
+            f.seek(position)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # the end of the log, or an edit being written
+                    f.seek(position)
+                    if not follow or stopping:
+                        return
+                    if is_recording is not None and not is_recording():
+                        # read the edits recorded in the meantime, then stop
+                        stopping = True
+                        continue
+                    time.sleep(poll_interval)
+                    continue
+                position += len(line)
+                qid, revid = line.decode('utf-8').rstrip('\n').split('\t')
+                yield qid, int(revid) if revid else None, position
+
 class WikidataStreamReader(APIReaderBase):
     """
     Generates a stream of `WikidataItemDocument` from
@@ -17,11 +121,44 @@ class WikidataStreamReader(APIReaderBase):
                  endpoint='https://stream.wikimedia.org/v2/stream/recentchange',
                  wiki='wikidatawiki',
                  mediawiki_api='https://www.wikidata.org/w/api.php',
-                 from_time=None):
-        super(WikidataStreamReader, self).__init__(mediawiki_api)
+                 from_time=None,
+                 revision_cache=None,
+                 coalesce_window=0,
+                 workers=4,
+                 max_rate=None,
+                 log_dir=None,
+                 position=None,
+                 follow=True):
+        """
+        :param from_time: the point in time to start reading the stream from
+        :param revision_cache: a RevisionCache of the items already indexed:
+            the edits whose revision is already indexed are not fetched
+        :param coalesce_window: the number of seconds during which the edits
+            are collected before fetching the edited items, so that repeated
+            edits of an item are fetched only once
+        :param workers: the number of concurrent requests fetching items
+        :param max_rate: the maximum number of requests per second to the API
+        :param log_dir: a directory where the edits are recorded (see StreamLog)
+            before being read. The stream is then resumed after the last event
+            recorded, and the items are generated from the log.
+        :param position: the position in the log to start reading from,
+            as returned by tell()
+        :param follow: read the edit stream while reading the log. Otherwise,
+            only the edits already in the log are read.
+        """
+        super(WikidataStreamReader, self).__init__(mediawiki_api, workers=workers, max_rate=max_rate)
         self.endpoint = endpoint
         self.wiki = wiki
         self.from_time = from_time
+        self.revision_cache = revision_cache
+        self.coalesce_window = coalesce_window
+        self.log = StreamLog(log_dir) if log_dir is not None else None
+        self.position = position or 0
+        self.follow = follow
+        self.recorder = None
+        self.record_error = None
+        # set when the reader is closed, to stop recording the stream
+        self.closing = threading.Event()
         self.stream = None
         self.item_buffer = []
         self.batch_size = 50
@@ -30,43 +167,185 @@ class WikidataStreamReader(APIReaderBase):
 
     def __enter__(self):
         url = self.endpoint
-        if self.from_time is not None:
-             url += '?since='+self.from_time.isoformat().replace('+00:00', 'Z')
-        self.stream = SSEClient(url, timeout=30)
+        last_id = None
+        from_time = self.from_time.isoformat().replace('+00:00', 'Z') if self.from_time is not None else None
+        if self.log is not None:
+            state = self.log.load_state()
+            last_id = state.get('last_event_id')
+            if from_time is None and last_id is None and state.get('timestamp'):
+                from_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(state['timestamp']))
+        if from_time is not None and last_id is None:
+             url += '?since='+from_time
+        if self.log is None or self.follow:
+            self.stream = SSEClient(url, last_id=last_id, timeout=30)
+        if self.log is not None and self.follow:
+            self.recorder = threading.Thread(target=self.record, daemon=True)
+            self.recorder.start()
         return self
 
     def __exit__(self, *args, **kwargs):
+        self.closing.set()
+        # SSEClient keeps the response of the stream
+        response = getattr(self.stream, 'resp', None)
+        if response is not None:
+            response.close()
+        self.close()
         return None
 
+    def _events(self):
+        """
+        The events of the stream, until the reader is closed.
+        """
+        for event in self.stream:
+            if self.closing.is_set():
+                return
+            yield event
+
+    def record(self):
+        """
+        Records the edits of the stream in the log, until the stream
+        ends or the reader is closed.
+        """
+        try:
+            self.log.record(self._events(), self.parse_change)
+        except Exception as e:
+            if self.closing.is_set():
+                return
+            logger.error('Recording the edit stream failed: {}'.format(e))
+            # raised again once the edits recorded are read (see __iter__)
+            self.record_error = e
+
+    def is_recording(self):
+        """
+        Is the edit stream still being recorded in the log?
+        """
+        return self.recorder is not None and self.recorder.is_alive()
+
+    def join_recorder(self):
+        """
+        Waits until the recording of the edit stream stops.
+
+        :raises: the error which stopped it, if any
+        """
+        self.recorder.join()
+        if self.record_error is not None:
+            raise self.record_error
+
+    def tell(self):
+        """
+        The position in the log of the edits of the items generated so far
+        (the beginning of the current batch until all its items are generated).
+        """
+        return self.position
+
+    def _changes(self):
+        """
+        Generates (qid, revid, position) triples for the edits to read.
+        """
+        if self.log is not None:
+            yield from self.log.changes(self.position, follow=self.follow,
+                                        is_recording=self.is_recording if self.follow else None)
+            return
+        while True:
+            change = self.fetch_next_change()
+            if change is None:
+                return
+            yield change[0], change[1], None
+
     def __iter__(self):
-        if not self.stream:
+        if not self.stream and self.log is None:
             raise ValueError('Stream has not been started.')
+        changes = self._changes()
         stream_ended = False
+        in_flight = deque()
         while not stream_ended:
-            # Fetch new batch of events
-            qids = [self.fetch_next_qid() for _ in range(self.batch_size)]
+            # Fetch new batch of events, keeping the latest revision of each item
+            revisions = {}
+            nb_events = 0
+            end = self.position
+            started = time.monotonic()
+            while True:
+                change = next(changes, None)
+                if change is None:
+                    stream_ended = True
+                    break
+                qid, revid, end = change
+                previous = revisions.get(qid, 0)
+                # an edit without revision id can only be fetched
+                if previous is not None:
+                    revisions[qid] = None if revid is None else max(previous, revid)
+                nb_events += 1
+                if self.coalesce_window:
+                    if (len(revisions) >= self.batch_size or
+                            time.monotonic() - started >= self.coalesce_window):
+                        break
+                elif nb_events >= self.batch_size:
+                    break
+
+            if self.revision_cache is not None:
+                qids = {qid for qid, revid in revisions.items()
+                        if not self.revision_cache.is_indexed(qid, revid)}
+                logger.debug('Skipping {} items already indexed'.format(len(revisions) - len(qids)))
+            else:
+                qids = set(revisions)
 
-            stream_ended = None in qids
-            qids_without_none = {qid for qid in qids if qid}
+            # Fetch item contents while the next events are read,
+            # with up to `workers` batches being fetched at once
+            # (known revisions, so that outdated cached responses are refreshed)
+            known_revisions = {qid: revisions[qid] for qid in qids if revisions[qid] is not None}
+            in_flight.append((self.fetch_items_async(qids, known_revisions or None), end))
+            if len(in_flight) > self.workers:
+                yield from self._batch_items(*in_flight.popleft())
+        while in_flight:
+            yield from self._batch_items(*in_flight.popleft())
+        if self.record_error is not None:
+            raise self.record_error
 
-            # Fetch item contents
-            for item in self.fetch_items(qids_without_none):
-                yield item
+    def _batch_items(self, future, end):
+        """
+        Generates the items of a batch, moving the position
+        to its end with the last one.
+        """
+        items = future.result()
+        for idx, item in enumerate(items):
+            if idx == len(items) - 1:
+                self.position = end
+            yield item
+        if not items:
+            self.position = end
 
     def fetch_next_qid(self):
         """
         Fetches the next Qid in the Wikidata edit stream
         """
+        change = self.fetch_next_change()
+        return change[0] if change is not None else None
+
+    def fetch_next_change(self):
+        """
+        Fetches the next edit of an item in the Wikidata edit stream.
+
+        :returns: a (qid, new revision id) pair (the revision id is None
+            if the event does not have one), or None if the stream ended
+        """
         for event in self.stream:
             if event.event == 'message':
-                try:
-                    change = json.loads(event.data)
-                    if (change.get('wiki') == self.wiki and
-                        change.get('namespace') in self.namespaces and
-                        change.get('title') and
-                        self.id_re.match(change['title'])):
-                        return change['title']
-                except ValueError:
-                    pass
-
+                change = self.parse_change(event)
+                if change is not None:
+                    return change
 
+    def parse_change(self, event):
+        """
+        :returns: the (qid, new revision id) pair of the edit of an event,
+            or None if it is not the edit of an item
+        """
+        try:
+            change = json.loads(event.data)
+            if (change.get('wiki') == self.wiki and
+                change.get('namespace') in self.namespaces and
+                change.get('title') and
+                self.id_re.match(change['title'])):
+                revid = (change.get('revision') or {}).get('new')
+                return change['title'], revid
+        except ValueError:
+            pass
@@ -0,0 +1,62 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+class RevisionCache(object):
+    """
+    Remembers, for the most recently indexed items, the revision
+    and a fingerprint of the last document sent to Solr for them.
+
+    This makes it possible to skip fetching items whose edits have
+    already been indexed, and sending documents which did not change
+    (when an edit does not touch any indexed field).
+    """
+
+    def __init__(self, max_size=1000000):
+        """
+        :param max_size: the number of items to remember (the least
+            recently indexed ones are forgotten first)
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def fingerprint(doc):
+        """
+        A digest of the fields of a document, except its revision.
+        Excluded items (None documents) have a None fingerprint.
+        """
+        if doc is None:
+            return None
+        fields = {key: value for key, value in doc.items() if key != 'revid'}
+        serialized = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(serialized.encode('utf-8'), digest_size=16).digest()
+
+    def is_indexed(self, qid, revid):
+        """
+        Is the given revision of an item (or a later one) already indexed?
+        """
+        entry = self.entries.get(qid)
+        return entry is not None and entry[0] is not None and revid is not None and entry[0] >= revid
+
+    def update(self, qid, doc, revid=None):
+        """
+        Records the document indexed for an item.
+
+        :param revid: the revision of the item, if the document is None
+        :returns: False if the same document was already indexed for it
+        """
+        if doc is not None:
+            revid = doc.get('revid')
+        fingerprint = self.fingerprint(doc)
+        with self.lock:
+            previous = self.entries.pop(qid, None)
+            self.entries[qid] = (revid, fingerprint)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return previous is None or previous[1] != fingerprint
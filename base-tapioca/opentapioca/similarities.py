@@ -3,8 +3,18 @@
 A collection of similarity measures between
 items
 """
+import numpy
+
+from .coordinates import haversine
 
 class EdgeSimilarityMeasure(object):
+    def similarity_matrix(self, tags_a, tags_b):
+        """
+        Computes the similarities between two lists of tags,
+        as a matrix with a row for each tag of tags_a.
+        """
+        return numpy.array([[self.compute_similarity(a, b) for b in tags_b] for a in tags_a]).reshape(len(tags_a), len(tags_b))
+
     def compute_similarity(self, a, b):
         """
         Computes the similarity between two tags.
@@ -67,3 +77,40 @@ class OneStepSimilarity(EdgeSimilarityMeasure):
             proba += (1-beta)*(1-beta)*(len_common/len(edges_a))*(len_common/len(edges_b))
 
         return proba
+
+class GeoProximitySimilarity(object):
+    """
+    Nearby places are likely to be mentioned together: the similarity
+    of two items with coordinates is exp(-distance/scale), and 0 if
+    any of them has no coordinates.
+
+    The coordinates are read from a CoordinateStore, which is not
+    pickled with the measure and must be restored afterwards.
+    """
+    def __init__(self, coordinates, scale=50.):
+        """
+        :param coordinates: the CoordinateStore of the items
+        :param scale: the distance (in km) at which the similarity is 1/e
+        """
+        self.coordinates = coordinates
+        self.scale = scale
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['coordinates'] = None
+        return state
+
+    def compute_similarity(self, a, b):
+        return float(self.similarity_matrix([a], [b])[0, 0])
+
+    def similarity_matrix(self, tags_a, tags_b):
+        """
+        Computes the similarities between two lists of tags at once.
+        """
+        if self.coordinates is None:
+            raise ValueError('The coordinate store of the similarity measure must be restored')
+        coords = self.coordinates.get_coords([tag.id for tag in tags_a] + [tag.id for tag in tags_b])
+        coords_a = coords[:len(tags_a)]
+        coords_b = coords[len(tags_a):]
+        distances = haversine(coords_a[:, 0, None], coords_a[:, 1, None], coords_b[None, :, 0], coords_b[None, :, 1])
+        return numpy.nan_to_num(numpy.exp(-distances / self.scale), nan=0.)
@@ -1,5 +1,80 @@
-import requests
+import re
+import json
+import codecs
+
+from opentapioca.httpcache import get_session
+
+# the start of the list of results in a SPARQL JSON response
+BINDINGS_RE = re.compile(r'"bindings"\s*:\s*\[')
 
 def sparql_wikidata(query_string, endpoint='https://query.wikidata.org/sparql'):
-    results = requests.get(endpoint, {'query': query_string, 'format': 'json'}).json()
+    results = get_session().get(endpoint, params={'query': query_string, 'format': 'json'}).json()
     return results['results']
+
+def sparql_wikidata_bindings(query_string, endpoint='https://query.wikidata.org/sparql', chunk_size=1 << 16):
+    """
+    Same as sparql_wikidata, but generates the bindings of the results
+    while they are downloaded, instead of loading them all in memory.
+    """
+    r = get_session().get(endpoint, params={'query': query_string, 'format': 'json'}, stream=True)
+    r.raise_for_status()
+    try:
+        yield from iter_bindings(r.iter_content(chunk_size))
+    finally:
+        r.close()
+
+def iter_bindings(chunks):
+    """
+    Generates the bindings of a SPARQL JSON response, given as
+    chunks of bytes, by decoding them one by one.
+
+    :raises ValueError: if the response is not valid
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    ended = False
+
+    def read_more():
+        nonlocal buf, ended
+        chunk = next(chunks, None)
+        if chunk is None:
+            ended = True
+            buf += text_decoder.decode(b'', final=True)
+        else:
+            buf += text_decoder.decode(chunk)
+
+    match = BINDINGS_RE.search(buf)
+    while match is None:
+        if ended:
+            raise ValueError('No bindings in the SPARQL results')
+        read_more()
+        match = BINDINGS_RE.search(buf)
+    pos = match.end()
+
+    while True:
+        # skip the separators between bindings
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+            pos += 1
+        if pos == len(buf):
+            if ended:
+                raise ValueError('Truncated SPARQL results')
+            buf = ''
+            pos = 0
+            read_more()
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            binding, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # the binding is not entirely read yet
+            if ended:
+                raise
+            buf = buf[pos:]
+            pos = 0
+            read_more()
+            continue
+        yield binding
+        pos = end
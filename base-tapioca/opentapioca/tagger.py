@@ -2,7 +2,7 @@ import json
 import requests
 import logging
 import re
-from math import log
+import numpy
 
 from .languagemodel import BOWLanguageModel
 from .wikidatagraph import WikidataGraph
@@ -20,15 +20,18 @@ class Tagger(object):
     items in text.
     """
 
-    def __init__(self, solr_collection, bow, graph):
+    def __init__(self, solr_collection, bow, graph, profile=None):
         """
         Creates a tagger from:
         - a solr collection name, which has been adequately initialized with a compatible index and filled with documents
         - a bag of words language model, adequately trained, which will be used to evaluate the likelihood of phrases
         - a wikidata graph, adequately loaded, which will be used to compute the page rank and the edges between items
+        - optionally, the name of the indexing profile of the collection: if the graph has a personalized
+          pagerank for it, it is used instead of the global one
         """
         self.bow = bow
         self.graph = graph
+        self.profile = profile
         self.solr_endpoint = 'http://localhost:8983/solr/{}/tag'.format(solr_collection)
 
         #tokens or numbers up to 4 digits (years) :
@@ -43,6 +46,9 @@ class Tagger(object):
         Given some text, use the solr index to retrieve candidate items mentioned in the text.
         :param prune: if True, ignores lowercase mentions shorter than 3 characters
         """
+        # Pick up the pagerank if it has been updated
+        self.graph.reload_pagerank_if_changed()
+
         # Tag
         phrase = phrase[:self.max_length]
         logger.debug('Tagging text with solr (length {})'.format(len(phrase)))
@@ -69,8 +75,11 @@ class Tagger(object):
             for doc in resp.get('response', {}).get('docs', [])
         }
 
+        # Rank all the candidates of the document at once
+        log_ranks = self._log_ranks(docs.keys())
+
         mentions = [
-            self._create_mention(phrase, mention, docs, mentions_json)
+            self._create_mention(phrase, mention, docs, mentions_json, log_ranks)
             for mention in mentions_json
         ]
 
@@ -94,7 +103,20 @@ class Tagger(object):
         """
         return self.prune_re.match(phrase) is not None and phrase.lower() == phrase
 
-    def _create_mention(self, phrase, mention, docs, mentions):
+    def _log_ranks(self, qids):
+        """
+        Computes log(pagerank) - log(rank_shift) for the given qids,
+        in one vectorised operation.
+
+        :returns: a dictionary from qid to shifted log-rank
+        """
+        qids = list(qids)
+        if not qids:
+            return {}
+        ids = numpy.array([qid[1:] for qid in qids]).astype(numpy.int64)
+        return dict(zip(qids, self.graph.get_log_ranks(ids, profile=self.profile).tolist()))
+
+    def _create_mention(self, phrase, mention, docs, mentions, log_ranks=None):
         """
         Adds more info to the mentions returned from Solr, to prepare
         them for ranking by the classifier.
@@ -103,18 +125,22 @@ class Tagger(object):
         :param mention: the JSON mention to enhance with scores
         :param docs: dictionary from qid to item
         :param mentions: the list of all mentions in the document
+        :param log_ranks: dictionary from qid to shifted log-rank, computed
+            for the candidates of this mention if not provided
         :returns: the enhanced mention, as a Mention object
         """
         start = mention['startOffset']
         end = mention['endOffset']
         surface = phrase[start:end]
         surface_score = self.bow.log_likelihood(surface)
+        if log_ranks is None:
+            log_ranks = self._log_ranks(mention['ids'])
         ranked_tags = []
         for qid in mention['ids']:
             item = dict(docs[qid].items())
 
-            #log(pagerank) = log(pagerank) - log(rank_shift) with log(rank_shift) approx 23
-            item['rank'] = log(self.graph.get_pagerank(qid)) - log(self.rank_shift)
+            #log(pagerank) - log(rank_shift) with log(rank_shift) approx 23
+            item['rank'] = log_ranks[qid]
             
             item['label'] = item['label'][0] if item.get('label') else None
             ranked_tags.append(Tag(**item))
@@ -1,13 +1,198 @@
+import os
+import csv
+import gzip
 import json
+import time
+import zlib
+import queue
 import requests
 import logging
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from opentapioca.typematcher import TypeMatcher
+from opentapioca.wditem import WikidataItemDocument
+from opentapioca.wditem import LazyWikidataItemDocument
+from opentapioca.readers.dumpreader import loads
+from opentapioca.readers.snapshot import open_dump
 
 logger = logging.getLogger(__name__)
 
 class CollectionAlreadyExists(Exception):
     pass
 
+# state of the document conversion worker processes
+_worker_profile = None
+_worker_type_matcher = None
+_worker_lazy = False
+
+def _init_worker(profile, type_matcher, lazy):
+    global _worker_profile, _worker_type_matcher, _worker_lazy
+    _worker_profile = profile
+    _worker_type_matcher = type_matcher
+    _worker_lazy = lazy
+
+def _convert_chunk(chunk):
+    """
+    Translates a chunk of items (raw JSON lines or documents)
+    to Solr documents, in a worker process.
+
+    :returns: a list of (qid, document) pairs
+    """
+    items = []
+    for item in chunk:
+        if isinstance(item, str) and _worker_lazy:
+            item = LazyWikidataItemDocument(item)
+        elif isinstance(item, str):
+            try:
+                item = WikidataItemDocument(loads(item))
+            except ValueError:
+                continue
+        items.append(item)
+    docs = _worker_profile.entities_to_documents(items, _worker_type_matcher)
+    return [(item.get('id'), doc) for item, doc in zip(items, docs)]
+
+# fields of the documents, in the column order of the CSV exports
+CSV_FIELDS = ['id', 'revid', 'label', 'desc', 'edges', 'types', 'aliases',
+              'extra_aliases', 'nb_statements', 'nb_sitelinks']
+# multi-valued fields, whose values are joined by CSV_SEPARATOR in CSV exports
+CSV_LIST_FIELDS = ['edges', 'aliases', 'extra_aliases']
+CSV_SEPARATOR = '\x1f'
+
+def _export_shard(fname, outdir, index, nb_shards, fmt, profile, type_matcher,
+                  prefilter=None, lazy=False, chunk_size=1000):
+    """
+    Writes the Solr documents of one shard of a dump (or snapshot) to
+    a gzip-compressed file in outdir, in a worker process.
+
+    :returns: the name of the file and the number of documents in it
+    """
+    shard_fname = os.path.join(outdir, 'docs-{:05d}.{}.gz'.format(index, fmt))
+    count = 0
+    with open_dump(fname, prefilter=prefilter, lazy=lazy) as reader, \
+            gzip.open(shard_fname + '.tmp', 'wt', encoding='utf-8', newline='') as f:
+        items = iter(reader) if nb_shards == 1 else reader.iter_shard(index, nb_shards)
+        writer = None
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(CSV_FIELDS)
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            count += _write_documents(f, writer, profile.entities_to_documents(chunk, type_matcher))
+            chunk = []
+        count += _write_documents(f, writer, profile.entities_to_documents(chunk, type_matcher))
+    # so that incomplete shards are never ingested
+    os.replace(shard_fname + '.tmp', shard_fname)
+    return shard_fname, count
+
+def _read_decompressed(fname, chunk_size=1 << 20):
+    """
+    Yields the decompressed contents of a gzip file, chunk by chunk,
+    so that it can be streamed in a request body.
+    """
+    with gzip.open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _write_documents(f, csv_writer, docs):
+    count = 0
+    for doc in docs:
+        if doc is None:
+            continue
+        if csv_writer is None:
+            f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+        else:
+            csv_writer.writerow([
+                CSV_SEPARATOR.join(map(str, doc[field])) if field in CSV_LIST_FIELDS else doc[field]
+                for field in CSV_FIELDS
+            ])
+        count += 1
+    return count
+
+class Checkpoint(object):
+    """
+    Records in a JSON file the position of a stream (as returned
+    by its reader's `tell`) up to which all the documents are
+    committed to Solr, so that indexing can be resumed there.
+
+    Batches can be sent concurrently: their positions are registered
+    in stream order, and the position saved is the one of the last
+    batch such that it and all batches before it were sent.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.sent_batches = set()
+        self.next_batch = 0
+        self.last_sent = None
+        self.saved_batch = None
+
+    def load(self):
+        """
+        :returns: the position saved, or None if there is no checkpoint yet
+        """
+        if not os.path.exists(self.fname):
+            return None
+        with open(self.fname, 'r') as f:
+            return json.load(f).get('position')
+
+    def save(self, position, batch_id=None):
+        """
+        Saves a position, atomically.
+
+        :param batch_id: the id of the last batch before this position, if any.
+            Positions before the last one saved are then ignored, as uploaders
+            can commit out of order.
+        """
+        if position is None:
+            return
+        with self.lock:
+            if batch_id is not None:
+                if self.saved_batch is not None and batch_id <= self.saved_batch:
+                    return
+                self.saved_batch = batch_id
+            dirname, basename = os.path.split(os.path.abspath(self.fname))
+            fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix=basename, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'position': position}, f)
+            os.replace(tmp_fname, self.fname)
+
+    def last_sent_batch(self):
+        """
+        :returns: the id and the end position of the last batch such that
+            it and all the batches before it were sent (or None)
+        """
+        with self.lock:
+            return self.next_batch - 1 if self.next_batch else None, self.last_sent
+
+    def add(self, batch_id, position):
+        """
+        Registers a batch, which ends at the given position.
+        """
+        with self.lock:
+            self.positions[batch_id] = position
+
+    def sent(self, batch_id):
+        """
+        Marks a batch as sent to Solr.
+        """
+        with self.lock:
+            self.sent_batches.add(batch_id)
+            while self.next_batch in self.sent_batches:
+                self.sent_batches.remove(self.next_batch)
+                self.last_sent = self.positions.pop(self.next_batch)
+                self.next_batch += 1
+
 class TaggerFactory(object):
     """
     This helps creating and filling solr indices
@@ -17,13 +202,33 @@ class TaggerFactory(object):
 
     def __init__(self,
                  solr_endpoint='http://localhost:8983/solr/',
-                 type_matcher=None):
+                 type_matcher=None,
+                 compress=False,
+                 retries=3,
+                 retry_delay=1,
+                 dead_letter=None):
         """
         A type matcher can be provided to restrict the indexed
         items to particular classes.
+
+        :param compress: gzip the updates sent to Solr (which must be
+            configured to accept compressed requests)
+        :param retries: the number of times a failed update is sent again
+        :param retry_delay: the delay (in seconds) before the first retry,
+            doubled after each attempt
+        :param dead_letter: a file where the updates which still fail after
+            the retries are appended, to be replayed with replay_dead_letters.
+            Without it, such failures are raised.
         """
         self.solr_endpoint = solr_endpoint
         self.type_matcher = type_matcher or TypeMatcher()
+        self.compress = compress
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.dead_letter = dead_letter
+        self.dead_letter_lock = threading.Lock()
+        # one session (and connection pool) per uploader thread
+        self.sessions = threading.local()
 
     def create_collection(self, collection_name, num_shards=1, configset='tapioca'):
         """
@@ -54,7 +259,9 @@ class TaggerFactory(object):
           max_lines=None,
           commit_time=10,
           delete_excluded=False,
-          skip_docs=0):
+          skip_docs=0,
+          checkpoint=None,
+          revision_cache=None):
         """
         Given a stream of Wikidata items, index it in the given solr collection.
 
@@ -63,20 +270,23 @@ class TaggerFactory(object):
         :param max_lines: the maximum of items to read from the dump
         :param commit_time: commit the solr documents ever commit_time items.
         :param delete_excluded: delete excluded entities from the Solr index.
+        :param checkpoint: a file where the position of the stream is saved after
+            each commit, if its reader supports `tell` (see `WikidataDumpReader`)
+        :param revision_cache: a RevisionCache of the documents already indexed,
+            which are not sent again if they did not change
         """
+        if checkpoint is not None:
+            checkpoint = Checkpoint(checkpoint)
         batches_since_commit = 0
         with stream as reader:
 
             batch = {}
-            for idx, item in enumerate(reader):
-                if max_lines is not None and idx > max_lines:
-                    break
-                if skip_docs > 0 and idx < skip_docs:
-                    continue
-
-                doc = profile.entity_to_document(item, self.type_matcher)
+            position = None
+            for idx, item, doc, position in self._documents(reader, profile, max_lines, skip_docs):
                 qid = item.get('id')
-
+                # excluded items are recorded too, so that their next edits are not fetched
+                if revision_cache is not None and not revision_cache.update(qid, doc, item.get('lastrevid')):
+                    continue
                 if doc is None and not delete_excluded:
                     continue
 
@@ -89,10 +299,296 @@ class TaggerFactory(object):
                         commit = True
                         batches_since_commit = 0
                     self._push_documents(batch, collection_name, commit)
+                    if commit and checkpoint is not None:
+                        checkpoint.save(position)
                     batch = {}
 
             if batch or batches_since_commit:
                 self._push_documents(batch, collection_name, True)
+            if checkpoint is not None:
+                checkpoint.save(position)
+
+    def index_stream_parallel(self,
+          collection_name,
+          stream,
+          profile,
+          batch_size=5000,
+          max_lines=None,
+          commit_time=10,
+          delete_excluded=False,
+          skip_docs=0,
+          workers=4,
+          uploaders=2,
+          checkpoint=None,
+          lazy=False):
+        """
+        Pipelined version of index_stream: the stream is read in this process,
+        the items are converted to documents by a pool of worker processes and
+        the batches are sent to Solr by uploader threads. Bounded queues between
+        these stages make the reader wait when Solr or the workers lag behind.
+
+        The stream is read as raw JSON lines when it supports it (like
+        WikidataDumpReader), so that items are also parsed by the workers.
+
+        :param workers: the number of document conversion processes
+        :param uploaders: the number of threads sending batches to Solr
+        :param checkpoint: a file where the position of the stream is saved after
+            each commit, if its reader supports `tell`
+        :param lazy: decode the raw JSON lines as LazyWikidataItemDocument
+        """
+        for constraint in profile.restrict_types or []:
+            # so that the workers do not need to query the subclasses themselves
+            self.type_matcher.prefetch_children(constraint.qid)
+
+        if checkpoint is not None:
+            checkpoint = Checkpoint(checkpoint)
+        batches = queue.Queue(maxsize=2*uploaders)
+        errors = []
+        failed = threading.Event()
+        def upload():
+            while True:
+                task = batches.get()
+                if task is None:
+                    return
+                if failed.is_set():
+                    # the indexing is stopping: only drain the queue
+                    continue
+                batch_id, batch, commit = task
+                try:
+                    # only the batches sent before the commit are known to be committed
+                    committed_batch, committed = checkpoint.last_sent_batch() if checkpoint is not None else (None, None)
+                    self._push_documents(batch, collection_name, commit)
+                    if checkpoint is not None:
+                        checkpoint.sent(batch_id)
+                        if commit:
+                            checkpoint.save(committed, committed_batch)
+                except Exception as e:
+                    errors.append(e)
+                    failed.set()
+
+        in_flight = deque()
+        def check_uploads():
+            # stop reading the stream as soon as an upload fails
+            if failed.is_set():
+                for future, _ in in_flight:
+                    future.cancel()
+                raise errors[0]
+
+        threads = [threading.Thread(target=upload, daemon=True) for i in range(uploaders)]
+        for thread in threads:
+            thread.start()
+
+        batches_since_commit = 0
+        nb_batches = 0
+        def enqueue(converted, position):
+            nonlocal batches_since_commit, nb_batches
+            check_uploads()
+            batch_id = nb_batches
+            nb_batches += 1
+            batch = {qid: doc for qid, doc in converted if doc is not None or delete_excluded}
+            if checkpoint is not None:
+                checkpoint.add(batch_id, position)
+                if not batch:
+                    checkpoint.sent(batch_id)
+            if not batch:
+                return
+            batches_since_commit += 1
+            commit = False
+            if batches_since_commit >= commit_time:
+                commit = True
+                batches_since_commit = 0
+            batches.put((batch_id, batch, commit))
+
+        try:
+            with stream as reader, ProcessPoolExecutor(workers,
+                    initializer=_init_worker, initargs=(profile, self.type_matcher, lazy)) as executor:
+                lines = reader.lines() if hasattr(reader, 'lines') else reader
+                chunk = []
+                position = None
+                for idx, line in enumerate(lines):
+                    if max_lines is not None and idx > max_lines:
+                        break
+                    if skip_docs > 0 and idx < skip_docs:
+                        continue
+                    chunk.append(line)
+                    position = self._tell(reader)
+                    if len(chunk) >= batch_size:
+                        logger.info('Stream index: {}'.format(idx))
+                        check_uploads()
+                        in_flight.append((executor.submit(_convert_chunk, chunk), position))
+                        chunk = []
+                        # backpressure: wait for the oldest chunk, in order
+                        if len(in_flight) >= 2*workers:
+                            future, position = in_flight.popleft()
+                            enqueue(future.result(), position)
+                if chunk:
+                    in_flight.append((executor.submit(_convert_chunk, chunk), position))
+                end_position = position
+                while in_flight:
+                    future, position = in_flight.popleft()
+                    enqueue(future.result(), position)
+        finally:
+            for thread in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        # the batches may have been committed out of order, so commit once they all are sent
+        self._push_documents({}, collection_name, True)
+        if checkpoint is not None:
+            checkpoint.save(end_position)
+
+    def export_documents(self,
+          fname,
+          outdir,
+          profile,
+          shards=1,
+          workers=None,
+          fmt='jsonl',
+          prefilter=None,
+          lazy=False):
+        """
+        Converts the items of a dump (or snapshot) to Solr documents and
+        writes them to gzip-compressed files in outdir, one per shard of the
+        dump, which are exported in parallel. They can then be loaded with
+        ingest_documents, without converting the items during indexing.
+
+        :param shards: the number of parts the dump is split in (only bzip2
+            dumps and snapshots can be split)
+        :param workers: the number of processes exporting shards (one per shard by default)
+        :param fmt: 'jsonl' (one JSON document per line) or 'csv'
+        :returns: the list of the files written
+        """
+        if fmt not in ('jsonl', 'csv'):
+            raise ValueError('Unsupported export format: {}'.format(fmt))
+        for constraint in profile.restrict_types or []:
+            self.type_matcher.prefetch_children(constraint.qid)
+        os.makedirs(outdir, exist_ok=True)
+
+        with ProcessPoolExecutor(workers or shards) as executor:
+            futures = [
+                executor.submit(_export_shard, fname, outdir, index, shards, fmt,
+                                profile, self.type_matcher, prefilter, lazy)
+                for index in range(shards)
+            ]
+            fnames = []
+            for future in futures:
+                shard_fname, count = future.result()
+                logger.info('Exported {} documents to {}'.format(count, shard_fname))
+                fnames.append(shard_fname)
+        return fnames
+
+    def ingest_documents(self, collection, fnames, uploaders=2, commit=True):
+        """
+        Loads exported documents (see export_documents) in a collection,
+        several files at a time. The files are decompressed while they
+        are sent, unless the factory was created with compress=True, in
+        which case they are sent as they are (Solr must then be configured
+        to accept compressed requests).
+
+        :param fnames: the files to load
+        :param uploaders: the number of files sent at the same time
+        """
+        def ingest(fname):
+            if fname.endswith('.csv.gz'):
+                url = self._collection_update_endpoint(collection) + '/csv'
+                params = {'f.{}.split'.format(field): 'true' for field in CSV_LIST_FIELDS}
+                params.update({'f.{}.separator'.format(field): CSV_SEPARATOR for field in CSV_LIST_FIELDS})
+                content_type = 'application/csv'
+            else:
+                url = self._collection_update_endpoint(collection) + '/json/docs'
+                params = {}
+                content_type = 'application/json'
+            params['commit'] = 'false'
+            logger.info('Ingesting {}'.format(fname))
+            headers = {'Content-Type': content_type}
+            if self.compress:
+                headers['Content-Encoding'] = 'gzip'
+                with open(fname, 'rb') as f:
+                    r = requests.post(url, params=params, data=f, headers=headers)
+            else:
+                r = requests.post(url, params=params, data=_read_decompressed(fname), headers=headers)
+            r.raise_for_status()
+
+        with ThreadPoolExecutor(uploaders) as executor:
+            # raises the first failure
+            list(executor.map(ingest, fnames))
+        if commit:
+            self._push_documents({}, collection, True)
+
+    def merge_collections(self, collection, sources, delete_sources=True):
+        """
+        Merges the indices of collections (for instance filled in parallel
+        with ingest_documents) into another one. All these collections must
+        have a single shard, and be hosted by the same Solr node.
+
+        :param sources: the names of the collections to merge
+        :param delete_sources: drop the source collections once merged
+        """
+        cores = self._core_names([collection] + list(sources))
+        for source in sources:
+            # the source indices must be committed before being merged
+            self._push_documents({}, source, True)
+        r = requests.get(self.solr_endpoint + 'admin/cores', params={
+            'action': 'MERGEINDEXES',
+            'core': cores[collection],
+            'srcCore': [cores[source] for source in sources],
+        })
+        r.raise_for_status()
+        self._push_documents({}, collection, True)
+        if delete_sources:
+            for source in sources:
+                self.delete_collection(source)
+
+    def _core_names(self, collections):
+        """
+        Returns the name of the core of each of the given single-shard collections.
+        """
+        r = requests.get(self.solr_endpoint + 'admin/collections', params={'action': 'CLUSTERSTATUS', 'wt': 'json'})
+        r.raise_for_status()
+        status = r.json()['cluster']['collections']
+        cores = {}
+        for collection in collections:
+            shards = status[collection]['shards']
+            if len(shards) != 1:
+                raise ValueError('Collection "{}" has more than one shard'.format(collection))
+            replicas = list(shards.values())[0]['replicas']
+            cores[collection] = list(replicas.values())[0]['core']
+        return cores
+
+    def _documents(self, reader, profile, max_lines=None, skip_docs=0, chunk_size=1000):
+        """
+        Translates the items read from a stream to Solr documents,
+        by chunks, so that type constraints are checked for many
+        items at once.
+
+        :returns: a generator of (index in the stream, item, document, position)
+            tuples, where the position is the one of the reader after the item
+        """
+        chunk = []
+        for idx, item in enumerate(reader):
+            if max_lines is not None and idx > max_lines:
+                break
+            if skip_docs > 0 and idx < skip_docs:
+                continue
+            chunk.append((idx, item, self._tell(reader)))
+            if len(chunk) >= chunk_size:
+                yield from self._translate_chunk(chunk, profile)
+                chunk = []
+        yield from self._translate_chunk(chunk, profile)
+
+    def _translate_chunk(self, chunk, profile):
+        items = [item for idx, item, position in chunk]
+        docs = profile.entities_to_documents(items, self.type_matcher)
+        for (idx, item, position), doc in zip(chunk, docs):
+            yield idx, item, doc, position
+
+    def _tell(self, reader):
+        """
+        The position of a reader, if it supports it.
+        """
+        return reader.tell() if hasattr(reader, 'tell') else None
 
     def _collection_update_endpoint(self, collection):
         """
@@ -106,23 +602,96 @@ class TaggerFactory(object):
         If configured correctly, Solr will deal with the versioning on its
         own, so we do not need to check that we are pushing outdated results.
 
+        The update is retried on connection errors and server errors. If it
+        still fails, it is written to the dead-letter file.
+
         :param docs: map from ids to documents. None values will be interpreted as deletions.
         """
         docs_to_add = [doc for doc in docs.values() if doc is not None]
         ids_to_delete = [id for id, doc in docs.items() if doc is None]
         logger.info('Updating {} docs, deleting {} others'.format(len(docs_to_add), len(ids_to_delete)))
-        payload = {
-            'add': docs_to_add,
-            'delete': ids_to_delete,
-        }
-        r = requests.post(self._collection_update_endpoint(collection),
-            params={'commit': 'true' if commit else 'false'},
-            data=json.dumps(payload), headers={'Content-Type':'application/json'})
         try:
-            r.raise_for_status()
+            self._post_update(collection, docs_to_add, ids_to_delete, commit)
         except requests.exceptions.RequestException as e:
-            logger.warning('Skipping batch: {}'.format(e))
+            if self.dead_letter is None:
+                raise
+            logger.error('Writing failed batch to {}: {}'.format(self.dead_letter, e))
+            line = json.dumps({
+                'collection': collection,
+                'commit': commit,
+                'add': docs_to_add,
+                'delete': ids_to_delete,
+            })
+            with self.dead_letter_lock, open(self.dead_letter, 'a') as f:
+                f.write(line + '\n')
+
+    def _post_update(self, collection, docs_to_add, ids_to_delete, commit):
+        """
+        Posts an update to Solr, retrying with an exponential backoff
+        if it fails because of the connection or the server.
 
+        :raises requests.exceptions.RequestException: if the last attempt failed
+        """
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                r = session.post(self._collection_update_endpoint(collection),
+                    params={'commit': 'true' if commit else 'false'},
+                    data=self._update_body(docs_to_add, ids_to_delete), headers=headers)
+                r.raise_for_status()
+                return
+            except requests.exceptions.RequestException as e:
+                response = getattr(e, 'response', None)
+                # other client errors are caused by the batch itself
+                retriable = (response is None or response.status_code >= 500
+                             or response.status_code == 429)
+                if not retriable or attempt == self.retries:
+                    raise
+                logger.warning('Update failed ({}), retrying in {} seconds'.format(e, delay))
+                time.sleep(delay)
+                delay *= 2
 
+    def _update_body(self, docs_to_add, ids_to_delete):
+        """
+        Generates the JSON payload of an update by chunks of documents,
+        so that it is serialized (and compressed) while it is sent.
+        """
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        def chunks():
+            yield '{"add":['
+            for i, doc in enumerate(docs_to_add):
+                yield (',' if i else '') + json.dumps(doc)
+            yield '],"delete":' + json.dumps(ids_to_delete) + '}'
+        for chunk in chunks():
+            data = chunk.encode('utf-8')
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
 
+    def replay_dead_letters(self, fname):
+        """
+        Sends again the updates written to a dead-letter file. The updates
+        which fail again are written to the current dead-letter file.
 
+        :returns: the number of updates replayed
+        """
+        if self.dead_letter is not None and os.path.abspath(fname) == os.path.abspath(self.dead_letter):
+            raise ValueError('Cannot replay the dead-letter file being written to')
+        count = 0
+        with open(fname, 'r') as f:
+            for line in f:
+                update = json.loads(line)
+                docs = {doc['id']: doc for doc in update['add']}
+                docs.update({id: None for id in update['delete']})
+                self._push_documents(docs, update['collection'], update['commit'])
+                count += 1
+        return count
@@ -0,0 +1,60 @@
+import bz2
+import json
+import os
+import tempfile
+import pytest
+
+from opentapioca.readers.bz2blocks import Bz2BlockFile
+from opentapioca.readers.bz2blocks import iter_blocks
+
+@pytest.fixture
+def lines():
+    return [
+        json.dumps({'id': 'Q{}'.format(i), 'label': 'item {} é'.format(i) * (i % 50)})
+        for i in range(5000)
+    ]
+
+@pytest.fixture
+def multiblock_fname(lines):
+    """
+    A file made of two concatenated streams of multiple (100kB) blocks,
+    as produced by parallel compressors.
+    """
+    data = ('\n'.join(lines) + '\n').encode('utf-8')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'dump.json.bz2')
+        with open(fname, 'wb') as f:
+            f.write(bz2.compress(data[:500000], 1))
+            f.write(bz2.compress(data[500000:], 2))
+        yield fname
+
+def test_iter_blocks(multiblock_fname, lines):
+    with open(multiblock_fname, 'rb') as f:
+        data = f.read()
+    blocks = list(iter_blocks(data))
+    assert len(blocks) > 4
+    assert b''.join(block for offset, block in blocks).decode('utf-8') == '\n'.join(lines) + '\n'
+
+def test_resume(multiblock_fname, lines):
+    f = Bz2BlockFile(multiblock_fname)
+    positions = []
+    for line in f:
+        positions.append(f.tell())
+    f.close()
+    assert len(positions) == len(lines)
+    for idx in [0, 1, 1234, 3000, len(lines) - 2, len(lines) - 1]:
+        f = Bz2BlockFile(multiblock_fname, position=positions[idx])
+        assert list(f) == lines[idx+1:]
+        f.close()
+
+def test_parallel_decompression(multiblock_fname, lines):
+    f = Bz2BlockFile(multiblock_fname, processes=2)
+    assert list(f) == lines
+    f.close()
+
+@pytest.mark.parametrize('nb_shards', [1, 2, 3, 7, 50])
+def test_shards(multiblock_fname, lines, nb_shards):
+    f = Bz2BlockFile(multiblock_fname)
+    shards = [list(f.shard(idx, nb_shards)) for idx in range(nb_shards)]
+    f.close()
+    assert sum(shards, []) == lines
@@ -1,12 +1,17 @@
 
 import unittest
 import os
+import numpy
 import pytest
+from types import SimpleNamespace
 from opentapioca.languagemodel import BOWLanguageModel
 from opentapioca.wikidatagraph import WikidataGraph
 from opentapioca.taggerfactory import TaggerFactory
 from opentapioca.tagger import Tagger
 from opentapioca.classifier import SimpleTagClassifier
+from opentapioca.similarities import GeoProximitySimilarity
+from opentapioca.similarities import OneStepSimilarity
+from opentapioca.coordinates import CoordinateStore
 from opentapioca.indexingprofile import IndexingProfile
 from opentapioca.readers.dumpreader import WikidataDumpReader
 from opentapioca.tag import Tag
@@ -83,3 +88,94 @@ class ClassifierTest(unittest.TestCase):
         
 
         
+
+def test_geo_coherence_features(tmpdir):
+    store = CoordinateStore.from_pairs([90, 456, 1891], [[48.856667, 2.352222], [45.758889, 4.841389], [44.967, -103.767]])
+    classifier = SimpleTagClassifier(None, coordinates=store)
+    mentions = [
+        Mention(phrase='Paris', start=0, end=5, tags=[Tag(id='Q90', rank=1, nb_statements=1, nb_sitelinks=1), Tag(id='Q1891', rank=1, nb_statements=1, nb_sitelinks=1)], log_likelihood=1),
+        Mention(phrase='Lyon', start=10, end=14, tags=[Tag(id='Q456', rank=1, nb_statements=1, nb_sitelinks=1), Tag(id='Q5', rank=1, nb_statements=1, nb_sitelinks=1)], log_likelihood=1),
+    ]
+    features = classifier.geo_coherence_features(mentions)
+    assert features[(0, 5, 'Q90')] == pytest.approx(numpy.exp(-392 / 50.), rel=0.01)
+    assert features[(0, 5, 'Q1891')] < 1e-10
+    assert features[(10, 14, 'Q5')] == 0.
+
+    feature_array, tag_key_to_idx = classifier.build_feature_vectors_for_doc(mentions)
+    assert feature_array.shape == (4, 6 * (classifier.nb_steps + 1))
+
+    fname = str(tmpdir.join('classifier.pkl'))
+    classifier.tagger = None
+    classifier.save(fname)
+    loaded = SimpleTagClassifier(None)
+    loaded.load(fname)
+    assert loaded.geo_feature and loaded.coordinates is None
+    with pytest.raises(ValueError):
+        loaded.build_feature_vectors_for_doc(mentions)
+
+def test_geo_proximity_similarity(tmpdir):
+    store = CoordinateStore.from_pairs([90, 456, 1891], [[48.856667, 2.352222], [45.758889, 4.841389], [44.967, -103.767]])
+    with pytest.raises(ValueError):
+        SimpleTagClassifier(None, similarity='geo_proximity')
+    classifier = SimpleTagClassifier(None, similarity='geo_proximity', coordinates=store, max_similarity_distance=100, similarity_smoothing=0.)
+    mentions = [
+        Mention(phrase='Paris', start=0, end=5, tags=[Tag(id='Q90'), Tag(id='Q1891')], log_likelihood=1),
+        Mention(phrase='Lyon', start=10, end=14, tags=[Tag(id='Q456'), Tag(id='Q5')], log_likelihood=1),
+    ]
+    scores = classifier.similarity_method.similarity_matrix(mentions[0].tags, mentions[1].tags)
+    assert scores.shape == (2, 2)
+    assert scores[0, 0] == pytest.approx(numpy.exp(-392 / 50.), rel=0.01)
+    assert scores[1, 0] < 1e-10
+    assert list(scores[:, 1]) == [0., 0.]
+
+    for mention in mentions:
+        classifier.compute_similarities(mention, mentions)
+    assert mentions[0].tags[0].similarities == [{'tag': (0, 5, 'Q90'), 'score': 0.}, {'tag': (10, 14, 'Q456'), 'score': 1.}]
+
+    fname = str(tmpdir.join('classifier.pkl'))
+    classifier.tagger = None
+    classifier.save(fname)
+    loaded = SimpleTagClassifier(None)
+    loaded.load(fname)
+    assert loaded.similarity_method.coordinates is None
+    loaded.set_coordinates(store)
+    assert loaded.similarity_method.compute_similarity(mentions[0].tags[0], mentions[1].tags[0]) == pytest.approx(scores[0, 0])
+
+def test_crossfit_restores_best_parameters(tmpdir, monkeypatch):
+    store = CoordinateStore.from_pairs([90, 456, 1891], [[48.856667, 2.352222], [45.758889, 4.841389], [44.967, -103.767]])
+
+    class FakeTagger(object):
+        def tag_and_rank(self, phrase):
+            return [
+                Mention(phrase='Paris', start=0, end=5, log_likelihood=1, tags=[
+                    Tag(id='Q90', rank=10, nb_statements=100, nb_sitelinks=100),
+                    Tag(id='Q1891', rank=1, nb_statements=10, nb_sitelinks=1)]),
+                Mention(phrase='Lyon', start=10, end=14, log_likelihood=1, tags=[
+                    Tag(id='Q456', rank=8, nb_statements=80, nb_sitelinks=90),
+                    Tag(id='Q5', rank=2, nb_statements=5, nb_sitelinks=2)]),
+            ]
+
+    class Context(object):
+        # a hashable stand-in for a NIF context
+        def __init__(self, uri, mention, phrases):
+            self.uri = uri
+            self.mention = mention
+            self.phrases = phrases
+
+    def context(idx):
+        phrases = [SimpleNamespace(beginIndex=0, endIndex=5, taIdentRef='http://www.wikidata.org/entity/Q90'),
+                   SimpleNamespace(beginIndex=10, endIndex=14, taIdentRef='http://www.wikidata.org/entity/Q456')]
+        return Context(uri='doc{}'.format(idx), mention='Paris and Lyon', phrases=phrases)
+    dataset = SimpleNamespace(contexts=[context(idx) for idx in range(10)])
+
+    monkeypatch.chdir(str(tmpdir))
+    os.mkdir('data')
+    classifier = SimpleTagClassifier(FakeTagger(), coordinates=store)
+    parameters = [{'similarity': 'geo_proximity', 'similarity_smoothing': 0.5},
+                  {'similarity': 'one_step', 'beta': 0.2, 'similarity_smoothing': 0.3}]
+    best_params, best_f1 = classifier.crossfit_model(dataset, parameters)
+    assert best_f1 > 0
+    for param, val in best_params.items():
+        assert getattr(classifier, param) == val
+    expected_method = GeoProximitySimilarity if best_params['similarity'] == 'geo_proximity' else OneStepSimilarity
+    assert isinstance(classifier.similarity_method, expected_method)
@@ -0,0 +1,89 @@
+import os
+import numpy
+import pytest
+
+from opentapioca.coordinates import CoordinateStore
+from opentapioca.coordinates import SpatialIndex
+from opentapioca.coordinates import haversine
+from opentapioca.coordinates import pairwise_distances
+from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.wditem import WikidataItemDocument
+from .test_fixtures import testdir
+
+def place(qid, latitude, longitude):
+    return WikidataItemDocument({'id': qid, 'claims': {'P625': [{'mainsnak': {'datavalue': {'value': {
+        'latitude': latitude, 'longitude': longitude, 'globe': 'http://www.wikidata.org/entity/Q2'}}}}]}})
+
+@pytest.fixture
+def store():
+    return CoordinateStore.from_items([
+        place('Q90', 48.856667, 2.352222),
+        place('Q456', 45.758889, 4.841389),
+        WikidataItemDocument({'id': 'Q5'}),
+        place('Q64', 52.516667, 13.383333),
+    ])
+
+def test_get_coords(store):
+    assert len(store) == 3
+    assert 'Q90' in store
+    assert 'Q5' not in store
+    coords = store.get_coords(['Q456', 'Q5', 'Q90', 'Q1', 'Q100000'])
+    assert coords.dtype == numpy.float32
+    assert coords.shape == (5, 2)
+    assert numpy.allclose(coords[[0, 2]], [[45.758889, 4.841389], [48.856667, 2.352222]])
+    assert numpy.isnan(coords[[1, 3, 4]]).all()
+    assert store.get_coord('Q64') == pytest.approx((52.516667, 13.383333))
+    assert store.get_coord('Q5') is None
+
+def test_empty_store():
+    store = CoordinateStore()
+    assert numpy.isnan(store.get_coords(['Q1'])).all()
+
+def test_save_and_load(store, tmpdir):
+    fname = os.path.join(str(tmpdir), 'wikidata.coords.npy')
+    store.save(fname)
+    assert os.path.exists(os.path.join(str(tmpdir), 'wikidata.coords.qids.npy'))
+    loaded = CoordinateStore.load(fname)
+    assert isinstance(loaded.coords, numpy.memmap)
+    assert numpy.array_equal(loaded.get_coords([90, 456]), store.get_coords(['Q90', 'Q456']))
+
+def test_from_dump(testdir):
+    reader = WikidataDumpReader(os.path.join(testdir, 'data/sample_wikidata_items.json.bz2'))
+    store = CoordinateStore.from_items(reader)
+    assert len(store) == 94
+    assert store.get_coord('Q3941') == pytest.approx((47.233333, 47.233333))
+
+def test_haversine():
+    # Paris - Lyon
+    assert haversine(48.856667, 2.352222, 45.758889, 4.841389) == pytest.approx(392, abs=1)
+    assert haversine(0, 0, 0, 180) == pytest.approx(20015, abs=1)
+    distances = haversine(48.856667, 2.352222, [48.856667, 52.516667], [2.352222, 13.383333])
+    assert distances == pytest.approx([0, 876], abs=1)
+
+def test_distance_to():
+    from wikidataobject import WikidataObject
+    paris = WikidataObject('Q90', coordinates={'latitude': 48.856667, 'longitude': 2.352222})
+    lyon = WikidataObject('Q456', coordinates=(45.758889, 4.841389))
+    assert paris.distance_to(lyon) == pytest.approx(392, abs=1)
+    assert lyon.distance_to(WikidataObject('Q64', coordinates=[52.516667, 13.383333])) == pytest.approx(974, abs=1)
+    assert paris.distance_to(WikidataObject('Q5')) is None
+    assert paris.distance_to(WikidataObject('Q5', coordinates='ERROR_COORDINATES')) is None
+
+def test_pairwise_distances(store):
+    coords = store.get_coords(['Q90', 'Q456', 'Q5'])
+    distances = pairwise_distances(coords)
+    assert distances.shape == (3, 3)
+    assert distances[0, 1] == pytest.approx(392, abs=1)
+    assert distances[1, 0] == distances[0, 1]
+    assert distances[0, 0] == 0
+    assert numpy.isnan(distances[2]).all()
+
+def test_spatial_index(store):
+    index = SpatialIndex(store)
+    qids, distances = index.query_radius(48.8, 2.3, 500)
+    assert list(qids) == [90, 456]
+    assert distances == pytest.approx([7, 389], abs=1)
+    assert len(index.query_radius(0, 0, 100)[0]) == 0
+    qids, distances = index.nearest(52, 13, k=2)
+    assert list(qids) == [64, 90]
+    assert len(SpatialIndex(CoordinateStore()).query_radius(0, 0, 100)[0]) == 0
@@ -1,9 +1,13 @@
 
 
 import unittest
+import bz2
+import gzip
 import os
-import res
+import re
+import tempfile
 from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.readers.dumpreader import RawLineFilter
 
 class WikidataDumpReaderTest(unittest.TestCase):
     @classmethod
@@ -19,3 +23,73 @@ class WikidataDumpReaderTest(unittest.TestCase):
                 count += 1
                 assert entity_ids.match(item.get('id')) is not None
         assert count == 100
+
+    def test_read_lines(self):
+        with WikidataDumpReader(self.dump_fname) as reader:
+            lines = list(reader.lines())
+        assert len(lines) == 100
+        assert all(line.startswith('{') and line.endswith('}') for line in lines)
+
+    def test_resume(self):
+        with WikidataDumpReader(self.dump_fname) as reader:
+            ids = [item.get('id') for item in reader]
+            self.assertIsNone(reader.tell())
+        with WikidataDumpReader(self.dump_fname, seekable=True) as reader:
+            positions = []
+            for item in reader:
+                positions.append(reader.tell())
+        with WikidataDumpReader(self.dump_fname, position=positions[41]) as reader:
+            self.assertEqual(ids[42:], [item.get('id') for item in reader])
+
+    def read_ids(self, reader):
+        with reader:
+            return [item.get('id') for item in reader]
+
+    def test_read_gzip_dump(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'dump.json.gz')
+            with bz2.open(self.dump_fname, 'rb') as source, gzip.open(fname, 'wb') as target:
+                target.write(source.read())
+            self.assertEqual(self.read_ids(WikidataDumpReader(self.dump_fname)),
+                             self.read_ids(WikidataDumpReader(fname)))
+
+    def test_parallel_decompression(self):
+        self.assertEqual(self.read_ids(WikidataDumpReader(self.dump_fname)),
+                         self.read_ids(WikidataDumpReader(self.dump_fname, processes=2)))
+
+    def test_iter_shard(self):
+        ids = self.read_ids(WikidataDumpReader(self.dump_fname))
+        shard_ids = []
+        for idx in range(3):
+            with WikidataDumpReader(self.dump_fname) as reader:
+                shard_ids += [item.get('id') for item in reader.iter_shard(idx, 3)]
+        self.assertEqual(ids, shard_ids)
+
+    def test_prefilter(self):
+        all_items = list(WikidataDumpReader(self.dump_fname))
+        items = list(WikidataDumpReader(self.dump_fname, prefilter=RawLineFilter(id_prefixes='Q')))
+        self.assertEqual([item.get('id') for item in all_items if item.get('id')[0] == 'Q'],
+                         [item.get('id') for item in items])
+
+        items = list(WikidataDumpReader(self.dump_fname, prefilter=RawLineFilter(any_of=['"P2427"', '"P496"'])))
+        self.assertEqual([item.get('id') for item in all_items if 'P2427' in item.get('claims') or 'P496' in item.get('claims')],
+                         [item.get('id') for item in items])
+
+    def test_skip(self):
+        all_ids = self.read_ids(WikidataDumpReader(self.dump_fname))
+        self.assertEqual(all_ids[10:], self.read_ids(WikidataDumpReader(self.dump_fname, skip=10)))
+        # skipped items are counted before the prefilter
+        all_items = list(WikidataDumpReader(self.dump_fname))[10:]
+        items = list(WikidataDumpReader(self.dump_fname, skip=10, prefilter=RawLineFilter(any_of=['"P18"'])))
+        self.assertEqual([item.get('id') for item in all_items if 'P18' in item.get('claims')],
+                         [item.get('id') for item in items])
+
+    def test_raw_line_filter(self):
+        prefilter = RawLineFilter(any_of=['"P31"'], id_prefixes='QP')
+        self.assertTrue(prefilter('{"type": "item", "id": "Q5", "claims": {"P31": []}}'))
+        self.assertFalse(prefilter('{"type":"lexeme","id":"L5","claims":{"P31":[]}}'))
+        self.assertFalse(prefilter('{"type":"item","id":"Q5","claims":{}}'))
+
+    def test_lazy_items(self):
+        self.assertEqual(self.read_ids(WikidataDumpReader(self.dump_fname)),
+                         self.read_ids(WikidataDumpReader(self.dump_fname, lazy=True)))
@@ -1,17 +1,33 @@
 import os
 import pytest
 import json
+import shutil
 import requests_cache
 
 from opentapioca.wditem import WikidataItemDocument
+from opentapioca import httpcache
 
 @pytest.fixture()
-def cache_requests():
+def cache_requests(tmp_path):
+    """
+    Serves the requests to Wikidata from the recorded cache (without
+    ever refreshing it). Set TAPIOCA_HTTP_OFFLINE=1 to make sure that
+    no request is sent.
+
+    The tests use a copy of the recorded cache. To record the responses
+    missing from it, run them with TAPIOCA_HTTP_RECORD=1: the recorded
+    cache itself is then used, and updated.
+    """
     testdir = os.path.dirname(os.path.abspath(__file__))
     location = os.path.join(testdir, 'data/requests_cache')
-    requests_cache.install_cache(cache_name=location)
+    if os.environ.get('TAPIOCA_HTTP_RECORD', '') in ('', '0'):
+        copy = str(tmp_path / 'requests_cache')
+        shutil.copyfile(location + '.sqlite', copy + '.sqlite')
+        location = copy
+    httpcache.configure(cache_name=location, expire_after={'*': requests_cache.NEVER_EXPIRE},
+                        offline=os.environ.get('TAPIOCA_HTTP_OFFLINE', '') not in ('', '0'))
     yield
-    requests_cache.uninstall_cache()
+    httpcache.configure()
 
 @pytest.fixture
 def testdir():
@@ -0,0 +1,83 @@
+import os
+import json
+import pytest
+import requests_mock
+
+from opentapioca import httpcache
+from opentapioca.readers.apireaderbase import APIReaderBase
+from opentapioca.sparqlwikidata import sparql_wikidata
+
+API = 'https://www.wikidata.org/w/api.php'
+
+@pytest.fixture
+def http_cache(tmpdir):
+    location = os.path.join(str(tmpdir), 'http_cache')
+    httpcache.configure(cache_name=location)
+    yield location
+    httpcache.configure()
+
+def entities(revid):
+    return json.dumps({'entities': {'Q123': {'id': 'Q123', 'lastrevid': revid}}})
+
+def test_cached_items(http_cache):
+    with requests_mock.mock() as mocker:
+        mocker.get(API, text=entities(10))
+        reader = APIReaderBase(API)
+        assert reader.fetch_items(['Q123'])[0].get('lastrevid') == 10
+        assert APIReaderBase(API).fetch_items(['Q123'])[0].get('lastrevid') == 10
+        assert mocker.call_count == 1
+
+def test_revision_aware_invalidation(http_cache):
+    reader = APIReaderBase(API)
+    with requests_mock.mock() as mocker:
+        mocker.get(API, text=entities(10))
+        reader.fetch_items(['Q123'])
+    with requests_mock.mock() as mocker:
+        mocker.get(API, text=entities(12))
+        assert reader.fetch_items(['Q123'], revisions={'Q123': 10})[0].get('lastrevid') == 10
+        assert mocker.call_count == 0
+        # the cached response is older than the edit
+        assert reader.fetch_items(['Q123'], revisions={'Q123': 12})[0].get('lastrevid') == 12
+        assert mocker.call_count == 1
+
+def test_cached_sparql(http_cache):
+    response = json.dumps({'results': {'bindings': [{'item': {'value': 'http://www.wikidata.org/entity/Q123'}}]}})
+    with requests_mock.mock() as mocker:
+        mocker.get('https://query.wikidata.org/sparql', text=response)
+        assert len(sparql_wikidata('myquery')['bindings']) == 1
+        assert len(sparql_wikidata('myquery')['bindings']) == 1
+        assert mocker.call_count == 1
+
+def test_offline(http_cache):
+    with requests_mock.mock() as mocker:
+        mocker.get(API, text=entities(10))
+        APIReaderBase(API).fetch_items(['Q123'])
+
+    httpcache.configure(cache_name=http_cache, offline=True)
+    with requests_mock.mock() as mocker:
+        reader = APIReaderBase(API)
+        reader.retries = 1
+        assert reader.fetch_items(['Q123'])[0].get('lastrevid') == 10
+        with pytest.raises(Exception):
+            reader.fetch_items(['Q456'])
+        assert mocker.call_count == 0
+
+def test_backend_from_environment(tmpdir, monkeypatch):
+    monkeypatch.setenv('TAPIOCA_HTTP_CACHE_BACKEND', 'filesystem')
+    location = os.path.join(str(tmpdir), 'http_cache')
+    httpcache.configure(cache_name=location)
+    try:
+        assert httpcache.new_session().cache.__class__.__name__ == 'FileCache'
+        httpcache.configure(cache_name=location, backend='memory')
+        assert httpcache.new_session().cache.__class__.__name__ == 'BaseCache'
+    finally:
+        httpcache.configure()
+
+def test_no_cache():
+    httpcache.configure()
+    with requests_mock.mock() as mocker:
+        mocker.get(API, text=entities(10))
+        reader = APIReaderBase(API)
+        reader.fetch_items(['Q123'])
+        reader.fetch_items(['Q123'])
+        assert mocker.call_count == 2
@@ -4,6 +4,7 @@ import pytest
 import json
 
 from opentapioca.typematcher import TypeMatcher
+from opentapioca.typematcher import QidBitmap
 from opentapioca.indexingprofile import TypeConstraint
 from opentapioca.indexingprofile import IndexingProfile
 from opentapioca.readers.dumpreader import WikidataDumpReader
@@ -17,12 +18,12 @@ class TypeMatcherStub(TypeMatcher):
 
     def __init__(self):
         super(TypeMatcherStub, self).__init__()
-        self.sets['Q5'] = {5}
-        self.sets['Q43229'] = {43229, 3918, 43702}
-        self.sets['Q618123'] = {618123, 43702}
+        self.sets['Q5'] = QidBitmap([5])
+        self.sets['Q43229'] = QidBitmap([43229, 3918, 43702])
+        self.sets['Q618123'] = QidBitmap([618123, 43702])
 
     def prefetch_children(self):
-        raise ValueError('SPARQL queries disabled, use self.sets[parent_qid] = {child_qids}')
+        raise ValueError('SPARQL queries disabled, use self.sets[parent_qid] = QidBitmap(child_ids)')
 
 
 @pytest.fixture
@@ -58,6 +59,13 @@ def test_type_constraint(load_item):
     assert constraint.satisfied(item, TypeMatcherStub())
 
 
+def test_type_constraint_many(load_item):
+    items = [load_item('Q62653454'), load_item('Q31'), load_item('Q8502')]
+    constraint = TypeConstraint(pid='P31', qid='Q5')
+    assert list(constraint.satisfied_many(items, TypeMatcherStub())) == [True, False, False]
+    assert list(constraint.satisfied_many([], TypeMatcherStub())) == []
+
+
 def test_load_indexing_profile(testdir, expected_json):
     indexing_profile = IndexingProfile.load(os.path.join(testdir, 'data', 'indexing_profile.json'))
 
@@ -93,6 +101,13 @@ def test_multiple_types(sample_profile, load_item):
     assert types['Q618123']
     assert types['Q43229']
 
+def test_entities_to_documents(sample_profile, load_item):
+    items = [load_item(qid) for qid in ['Q62653454', 'Q8502', 'Q31']]
+    type_matcher = TypeMatcherStub()
+    docs = sample_profile.entities_to_documents(items, type_matcher)
+    assert docs == [sample_profile.entity_to_document(item, type_matcher) for item in items]
+    assert docs[1] is None
+
 def test_filtered_out_entity(sample_profile, load_item):
     item = load_item('Q8502')
     doc = sample_profile.entity_to_document(item, TypeMatcherStub())
@@ -106,6 +121,15 @@ def test_extra_aliases(sample_profile, load_item):
     assert types['P2427']
     assert set(doc['extra_aliases']) == {'@IRIF_Paris', 'UMR8243'}
 
+def test_raw_prefilter(testdir, sample_profile):
+    type_matcher = TypeMatcherStub()
+    dump_filename = os.path.join(testdir, 'data/sample_wikidata_items.json.bz2')
+    with WikidataDumpReader(dump_filename) as reader:
+        docs = [sample_profile.entity_to_document(item, type_matcher) for item in reader]
+    with WikidataDumpReader(dump_filename, prefilter=sample_profile.raw_prefilter()) as reader:
+        filtered_docs = [sample_profile.entity_to_document(item, type_matcher) for item in reader]
+    assert [doc for doc in docs if doc] == [doc for doc in filtered_docs if doc]
+
 def test_all_items_profile(testdir):
     profile_filename = os.path.join(testdir, 'data/all_items_profile.json')
     profile = IndexingProfile.load(profile_filename)
@@ -114,4 +138,4 @@ def test_all_items_profile(testdir):
     with WikidataDumpReader(dump_filename) as reader:
         for item in reader:
             assert profile.entity_to_document(item, type_matcher) is not None
-
+    assert profile.raw_prefilter() is None
@@ -0,0 +1,37 @@
+import unittest
+
+from opentapioca.revisioncache import RevisionCache
+
+class RevisionCacheTest(unittest.TestCase):
+
+    def test_unchanged_document(self):
+        cache = RevisionCache()
+        doc = {'id': 'Q1', 'revid': 10, 'label': 'universe'}
+        self.assertTrue(cache.update('Q1', doc))
+        # a new revision which does not change any indexed field
+        self.assertFalse(cache.update('Q1', dict(doc, revid=11)))
+        self.assertTrue(cache.update('Q1', dict(doc, revid=12, label='Universe')))
+
+    def test_is_indexed(self):
+        cache = RevisionCache()
+        self.assertFalse(cache.is_indexed('Q1', 10))
+        cache.update('Q1', {'id': 'Q1', 'revid': 10})
+        self.assertTrue(cache.is_indexed('Q1', 9))
+        self.assertTrue(cache.is_indexed('Q1', 10))
+        self.assertFalse(cache.is_indexed('Q1', 11))
+        self.assertFalse(cache.is_indexed('Q1', None))
+
+    def test_excluded_items(self):
+        cache = RevisionCache()
+        self.assertTrue(cache.update('Q2', None, 5))
+        self.assertTrue(cache.is_indexed('Q2', 5))
+        self.assertFalse(cache.update('Q2', None, 6))
+        self.assertTrue(cache.update('Q2', {'id': 'Q2', 'revid': 7}))
+
+    def test_max_size(self):
+        cache = RevisionCache(max_size=2)
+        for idx in range(3):
+            cache.update('Q{}'.format(idx), {'id': 'Q{}'.format(idx), 'revid': 1})
+        self.assertEqual(2, len(cache))
+        self.assertFalse(cache.is_indexed('Q0', 1))
+        self.assertTrue(cache.is_indexed('Q2', 1))
@@ -0,0 +1,91 @@
+import os
+import pytest
+import tempfile
+
+from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.readers.snapshot import SnapshotWriter
+from opentapioca.readers.snapshot import SnapshotReader
+from opentapioca.readers.snapshot import open_dump
+from opentapioca.indexingprofile import IndexingProfile
+from opentapioca.wikidatagraph import WikidataGraph
+from .test_fixtures import testdir
+from .test_indexingprofile import TypeMatcherStub
+
+@pytest.fixture
+def dump_fname(testdir):
+    return os.path.join(testdir, 'data', 'sample_wikidata_items.json.bz2')
+
+@pytest.fixture
+def profile(testdir):
+    return IndexingProfile.load(os.path.join(testdir, 'data', 'indexing_profile.json'))
+
+@pytest.fixture
+def snapshot_dir(dump_fname, profile):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirname = os.path.join(tmpdir, 'sample.snapshot')
+        properties = profile.restrict_properties + [extractor.property for extractor in profile.alias_properties]
+        with WikidataDumpReader(dump_fname) as reader, \
+                SnapshotWriter(dirname, languages=[profile.language], properties=properties) as writer:
+            for item in reader:
+                writer.add(item)
+        yield dirname
+
+def test_snapshot_documents(dump_fname, snapshot_dir, profile):
+    type_matcher = TypeMatcherStub()
+    with WikidataDumpReader(dump_fname) as reader:
+        docs = [profile.entity_to_document(item, type_matcher) for item in reader]
+    with open_dump(snapshot_dir) as reader:
+        reader.check_profile(profile)
+        snapshot_docs = [profile.entity_to_document(item, type_matcher) for item in reader]
+
+    assert len(docs) == len(snapshot_docs) == 100
+    for doc, snapshot_doc in zip(docs, snapshot_docs):
+        if doc is None:
+            assert snapshot_doc is None
+            continue
+        assert set(doc.pop('aliases')) == set(snapshot_doc.pop('aliases'))
+        assert doc == snapshot_doc
+
+def test_small_write_buffers(dump_fname, snapshot_dir, tmpdir):
+    dirname = os.path.join(str(tmpdir), 'buffered.snapshot')
+    with open_dump(snapshot_dir) as reader:
+        languages, properties = reader.languages, sorted(reader.properties)
+    with WikidataDumpReader(dump_fname) as reader, \
+            SnapshotWriter(dirname, languages=languages, properties=properties) as writer:
+        # the columns are written in many chunks
+        writer.buffer_size = 7
+        for item in reader:
+            writer.add(item)
+    assert sorted(os.listdir(dirname)) == sorted(os.listdir(snapshot_dir))
+    with open_dump(snapshot_dir) as expected, open_dump(dirname) as reader:
+        assert [item.row for item in reader] == [item.row for item in expected]
+
+def test_missing_property(snapshot_dir, profile):
+    reader = SnapshotReader(snapshot_dir)
+    profile.language = 'de'
+    with pytest.raises(ValueError):
+        reader.check_profile(profile)
+    with pytest.raises(ValueError):
+        reader.item(0).get_claims('P625')
+
+def test_shards_and_positions(snapshot_dir):
+    reader = SnapshotReader(snapshot_dir)
+    ids = [item.get('id') for item in reader]
+    assert ids == sum([[item.get('id') for item in reader.iter_shard(idx, 3)] for idx in range(3)], [])
+
+    reader = SnapshotReader(snapshot_dir)
+    for idx, item in enumerate(reader):
+        if idx == 41:
+            break
+    resumed = SnapshotReader(snapshot_dir, position=reader.tell())
+    assert [item.get('id') for item in resumed] == ids[42:]
+
+def test_preprocess_snapshot(dump_fname, snapshot_dir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outputs = []
+        for fname in [dump_fname, snapshot_dir]:
+            output_fname = os.path.join(tmpdir, 'graph.tsv')
+            WikidataGraph.preprocess_dump(fname, output_fname)
+            with open(output_fname, 'r') as f:
+                outputs.append(f.read())
+        assert outputs[0] == outputs[1]
@@ -1,9 +1,11 @@
 
 import pytest
 import requests_mock
+import json
 import os
 
 from opentapioca.readers.sparqlreader import SparqlReader
+from opentapioca.sparqlwikidata import iter_bindings
 from .test_fixtures import wbgetentities_response
 from .test_fixtures import testdir
 
@@ -23,3 +25,42 @@ def test_iterate(wbgetentities_response, dummy_sparql_query_response):
             items = list(entered_reader)
 
             assert [item.get('id') for item in items] == ['Q123', 'Q456']
+
+def test_iter_bindings_chunks():
+    response = json.dumps({
+        'head': {'vars': ['item', 'bindings']},
+        'results': {'bindings': [
+            {'item': {'value': 'http://www.wikidata.org/entity/Q{}'.format(idx)}, 'label': {'value': 'Zürich'}}
+            for idx in range(20)
+        ]},
+    }, ensure_ascii=False, indent=1).encode('utf-8')
+    # split in chunks of one byte, including in the middle of characters
+    bindings = list(iter_bindings(response[i:i+1] for i in range(len(response))))
+    assert len(bindings) == 20
+    assert bindings[3] == {'item': {'value': 'http://www.wikidata.org/entity/Q3'}, 'label': {'value': 'Zürich'}}
+
+def test_iter_bindings_truncated():
+    with pytest.raises(ValueError):
+        list(iter_bindings([b'{"results":{"bindings":[{"item":{"value":"http://www.wi']))
+    assert list(iter_bindings([b'{"results":{"bindings":[]}}'])) == []
+
+def test_iterate_many_batches():
+    qids = ['Q{}'.format(idx) for idx in range(1, 231)]
+    response = json.dumps({'results': {'bindings': [
+        {'item': {'value': 'http://www.wikidata.org/entity/' + qid}} for qid in qids
+    ]}})
+
+    def wbgetentities(request, context):
+        ids = request.qs['ids'][0].upper().split('|')
+        return json.dumps({'entities': {qid: {'id': qid} for qid in ids}})
+
+    reader = SparqlReader("mysparqlquery")
+    with requests_mock.mock() as mocker:
+        mocker.get('https://www.wikidata.org/w/api.php', text=wbgetentities)
+        mocker.get('https://query.wikidata.org/sparql?format=json&query=mysparqlquery', text=response)
+
+        with reader as entered_reader:
+            items = list(entered_reader)
+
+        assert [item.get('id') for item in items] == qids
+        assert mocker.call_count == 1 + 5
@@ -1,23 +1,35 @@
 import os
+import time
 import pytest
+import threading
 import requests.exceptions
 import requests_mock
 import json
 
 from pytest_mock import mocker
 from opentapioca.readers.streamreader import WikidataStreamReader
+from opentapioca.readers.streamreader import StreamLog
+from opentapioca.readers.apireaderbase import RateLimiter
 from collections import namedtuple
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
 from .test_fixtures import testdir
 from .test_fixtures import wbgetentities_response
 from opentapioca.wditem import WikidataItemDocument
+from opentapioca.revisioncache import RevisionCache
 
-EventStubBase = namedtuple('EventStubBase', ['data', 'event'])
+EventStubBase = namedtuple('EventStubBase', ['data', 'event', 'id'], defaults=[None])
 
 
-def EventStub(event='message', wiki='wikidatawiki', namespace=0, title='Q123'):
-    return EventStubBase(event=event, data=json.dumps(
-            {'wiki':wiki, 'namespace':namespace, 'title':title}
-            ))
+def EventStub(event='message', wiki='wikidatawiki', namespace=0, title='Q123', revision=None, id=None, timestamp=None):
+    data = {'wiki':wiki, 'namespace':namespace, 'title':title}
+    if revision is not None:
+        data['revision'] = {'new': revision}
+    if timestamp is not None:
+        data['timestamp'] = timestamp
+    return EventStubBase(event=event, data=json.dumps(data), id=id)
 
 
 @pytest.fixture
@@ -84,3 +96,237 @@ def test_iterate(event_stream, wbgetentities_response, mocker):
 
 
 
+
+
+def test_skip_indexed_revisions(mocker):
+    cache = RevisionCache()
+    cache.update('Q123', {'id': 'Q123', 'revid': 12})
+    events = [
+        EventStub(title='Q123', revision=11),
+        EventStub(title='Q456', revision=20),
+        EventStub(title='Q123', revision=12),
+        EventStub(title='Q789'),
+    ]
+    reader = StreamReaderStub(events)
+    reader.revision_cache = cache
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.return_value = []
+
+    with reader as entered_reader:
+        list(entered_reader)
+        method.assert_called_once_with({'Q456', 'Q789'}, {'Q456': 20})
+
+
+def test_coalesce_window(mocker):
+    events = [EventStub(title='Q123', revision=revision) for revision in range(10, 70)]
+    events.append(EventStub(title='Q456', revision=5))
+    reader = StreamReaderStub(events)
+    reader.coalesce_window = 60
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.return_value = []
+
+    with reader as entered_reader:
+        list(entered_reader)
+        # more than batch_size events, but only two distinct items
+        method.assert_called_once_with({'Q123', 'Q456'}, {'Q123': 69, 'Q456': 5})
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """
+    Serves wbgetentities requests with empty items, slowly, asking
+    to retry the first request when the server is throttling.
+    """
+
+    def do_GET(self):
+        server = self.server
+        ids = parse_qs(urlparse(self.path).query)['ids'][0].split('|')
+        with server.lock:
+            server.requests.append(ids)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            throttle = server.throttle
+            server.throttle = False
+        try:
+            if throttle:
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            time.sleep(0.1)
+            body = json.dumps({'entities': {qid: {'id': qid} for qid in ids}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_api():
+    server = ThreadingHTTPServer(('localhost', 0), MockAPIHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.active = 0
+    server.max_active = 0
+    server.throttle = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_fetch(mock_api):
+    reader = WikidataStreamReader(mediawiki_api='http://localhost:{}/w/api.php'.format(mock_api.server_port))
+    qids = ['Q{}'.format(idx) for idx in range(10, 130)]
+
+    items = reader.fetch_items(qids)
+
+    assert [item.get('id') for item in items] == qids
+    assert sorted(len(ids) for ids in mock_api.requests) == [20, 50, 50]
+    assert mock_api.max_active > 1
+
+
+def test_concurrent_stream_batches(mock_api):
+    qids = ['Q{}'.format(idx) for idx in range(10, 210)]
+    reader = StreamReaderStub([EventStub(title=qid) for qid in qids])
+    reader.mediawiki_api = 'http://localhost:{}/w/api.php'.format(mock_api.server_port)
+
+    with reader as entered_reader:
+        items = list(entered_reader)
+
+    assert sorted(item.get('id') for item in items) == sorted(qids)
+    assert [len(ids) for ids in mock_api.requests] == [50, 50, 50, 50]
+    # the batches of the stream are fetched concurrently
+    assert mock_api.max_active > 1
+
+
+def test_fetch_retry_after(mock_api):
+    reader = WikidataStreamReader(mediawiki_api='http://localhost:{}/w/api.php'.format(mock_api.server_port))
+    # the Retry-After header is used instead of this delay
+    reader.delay = 3600
+    mock_api.throttle = True
+
+    items = reader.fetch_items(['Q123', 'Q456'])
+
+    assert [item.get('id') for item in items] == ['Q123', 'Q456']
+    assert len(mock_api.requests) == 2
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(max_rate=50)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_iterate_batches(event_stream, mocker):
+    reader = StreamReaderStub(event_stream * 20)
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.return_value = [WikidataItemDocument({'id':'Q123'})]
+
+    with reader as entered_reader:
+        items = list(entered_reader)
+
+    # 60 matching events, in two batches
+    assert method.call_count == 2
+    assert len(items) == 2
+
+
+def recorded_log(tmpdir, titles):
+    log = StreamLog(str(tmpdir))
+    events = [EventStub(title=title, revision=idx, id='event{}'.format(idx), timestamp=1546300800 + idx)
+              for idx, title in enumerate(titles)]
+    events.append(EventStub(wiki='enwiki', id='last'))
+    log.record(iter(events), WikidataStreamReader().parse_change)
+    return log
+
+
+def test_record_log(tmpdir):
+    log = recorded_log(tmpdir, ['Q123', 'Q456', 'Q123'])
+
+    assert log.load_state() == {'last_event_id': 'last', 'timestamp': 1546300802}
+    assert [change[:2] for change in log.changes()] == [('Q123', 0), ('Q456', 1), ('Q123', 2)]
+
+
+def test_resume_from_log(tmpdir, mocker):
+    titles = ['Q{}'.format(100 + idx) for idx in range(70)]
+    recorded_log(tmpdir, titles)
+    reader = WikidataStreamReader(log_dir=str(tmpdir), follow=False)
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.side_effect = lambda qids, revisions=None: [WikidataItemDocument({'id': qid}) for qid in sorted(qids)]
+
+    with reader:
+        iterator = iter(reader)
+        first_batch = [next(iterator) for _ in range(50)]
+        position = reader.tell()
+    assert len(first_batch) == 50
+
+    reader = WikidataStreamReader(log_dir=str(tmpdir), position=position, follow=False)
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.side_effect = lambda qids, revisions=None: [WikidataItemDocument({'id': qid}) for qid in sorted(qids)]
+    with reader:
+        next_batch = [item.get('id') for item in reader]
+    assert sorted(next_batch) == titles[50:]
+
+
+def test_resume_stream_after_last_event(tmpdir, mocker):
+    recorded_log(tmpdir, ['Q123'])
+    sseclient = mocker.patch('opentapioca.readers.streamreader.SSEClient')
+    sseclient.return_value = iter([EventStub(title='Q456', id='next')])
+    reader = WikidataStreamReader(log_dir=str(tmpdir))
+    with reader:
+        reader.recorder.join()
+
+    sseclient.assert_called_once_with('https://stream.wikimedia.org/v2/stream/recentchange', last_id='last', timeout=30)
+    assert [change[0] for change in StreamLog(str(tmpdir)).changes()] == ['Q123', 'Q456']
+
+
+def test_recording_failure(tmpdir, mocker):
+    def failing_stream():
+        yield EventStub(title='Q123', id='first')
+        raise requests.exceptions.ConnectionError('stream closed')
+    sseclient = mocker.patch('opentapioca.readers.streamreader.SSEClient')
+    sseclient.return_value = failing_stream()
+    reader = WikidataStreamReader(log_dir=str(tmpdir))
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.side_effect = lambda qids, revisions=None: [WikidataItemDocument({'id': qid}) for qid in sorted(qids)]
+
+    # the edits recorded before the failure are read, then the error is raised
+    items = []
+    with reader:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            for item in reader:
+                items.append(item.get('id'))
+        with pytest.raises(requests.exceptions.ConnectionError):
+            reader.join_recorder()
+    assert items == ['Q123']
+
+
+def test_close(tmpdir, mocker):
+    def endless_stream():
+        while True:
+            yield EventStub(title='Q123')
+            time.sleep(0.01)
+    sseclient = mocker.patch('opentapioca.readers.streamreader.SSEClient')
+    sseclient.return_value = endless_stream()
+    reader = WikidataStreamReader(log_dir=str(tmpdir))
+    method = mocker.patch.object(reader, 'fetch_items')
+    method.side_effect = lambda qids, revisions=None: [WikidataItemDocument({'id': qid}) for qid in sorted(qids)]
+
+    with reader:
+        executor = reader._executor('prefetch')
+        next(iter(reader))
+    # the threads fetching items and recording the stream stop
+    assert executor._shutdown
+    assert reader.executors == {}
+    reader.recorder.join(timeout=5)
+    assert not reader.recorder.is_alive()
+    assert reader.record_error is None
@@ -1,12 +1,21 @@
 
 import unittest
 import requests
+import requests_mock
+import json
+import gzip
+import csv
 import os
+import tempfile
 from opentapioca.taggerfactory import TaggerFactory
 from opentapioca.taggerfactory import CollectionAlreadyExists
+from opentapioca.taggerfactory import Checkpoint
 from opentapioca.indexingprofile import IndexingProfile
 from opentapioca.tagger import Tagger
 from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.revisioncache import RevisionCache
+from opentapioca.typematcher import TypeMatcher
+from opentapioca.typematcher import SubclassIndex
 
 class TaggerFactoryTests(unittest.TestCase):
     
@@ -88,4 +97,243 @@ class TaggerFactoryTests(unittest.TestCase):
             self.assertEqual(['startOffset', 16, 'endOffset', 38, 'ids', ['Q24428424']], resp['tags'][0])
         finally:
             self.tf.delete_collection('wd_test_collection')
-            
\ No newline at end of file
+            
+
+def update_payload(request):
+    """
+    Decodes the JSON payload of an update sent to a mocked Solr.
+    """
+    body = b''.join(request.body)
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return json.loads(body.decode('utf-8'))
+
+class ParallelIndexingTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        testdir = os.path.dirname(os.path.abspath(__file__))
+        cls.profile = IndexingProfile.load(os.path.join(testdir, 'data/all_items_profile.json'))
+        cls.dump_fname = os.path.join(testdir, 'data/sample_wikidata_items.json.bz2')
+
+    def test_index_stream_parallel(self):
+        profile = self.profile
+        tf = TaggerFactory('http://localhost:8983/solr/')
+        dump = WikidataDumpReader(self.dump_fname)
+        with requests_mock.Mocker() as mocker:
+            mocker.post('http://localhost:8983/solr/wd_test_collection/update')
+            tf.index_stream_parallel('wd_test_collection', dump, profile,
+                                     batch_size=20, commit_time=2, workers=2, uploaders=2)
+            payloads = [update_payload(request) for request in mocker.request_history]
+            commits = [request.qs['commit'] for request in mocker.request_history]
+
+        ids = [doc['id'] for payload in payloads for doc in payload['add']]
+        self.assertEqual(100, len(ids))
+        self.assertEqual(100, len(set(ids)))
+        self.assertEqual(6, len(payloads))
+        self.assertEqual(['true'], commits[-1])
+        self.assertEqual(3, commits.count(['true']))
+
+    def indexed_ids(self, index, reader, **kwargs):
+        with requests_mock.Mocker() as mocker:
+            mocker.post('http://localhost:8983/solr/wd_test_collection/update')
+            index('wd_test_collection', reader, self.profile, batch_size=20, commit_time=2, **kwargs)
+            payloads = [update_payload(request) for request in mocker.request_history]
+        return [doc['id'] for payload in payloads for doc in payload['add']]
+
+    def test_revision_cache(self):
+        tf = TaggerFactory('http://localhost:8983/solr/')
+        cache = RevisionCache()
+        first_ids = self.indexed_ids(tf.index_stream, WikidataDumpReader(self.dump_fname), revision_cache=cache)
+        self.assertEqual(100, len(first_ids))
+        # the same revisions are not indexed again
+        next_ids = self.indexed_ids(tf.index_stream, WikidataDumpReader(self.dump_fname), revision_cache=cache)
+        self.assertEqual([], next_ids)
+
+    def test_resume_from_checkpoint(self):
+        tf = TaggerFactory('http://localhost:8983/solr/')
+        for index, kwargs in [(tf.index_stream, {}), (tf.index_stream_parallel, {'workers': 2, 'lazy': True})]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+                reader = WikidataDumpReader(self.dump_fname, seekable=True)
+                first_ids = self.indexed_ids(index, reader, max_lines=49, checkpoint=checkpoint, **kwargs)
+                self.assertEqual(50, len(first_ids))
+
+                reader = WikidataDumpReader(self.dump_fname, position=Checkpoint(checkpoint).load())
+                next_ids = self.indexed_ids(index, reader, checkpoint=checkpoint, **kwargs)
+                self.assertEqual(50, len(next_ids))
+                self.assertEqual(set(), set(first_ids) & set(next_ids))
+
+    def test_stop_on_upload_failure(self):
+        with WikidataDumpReader(self.dump_fname) as reader:
+            lines = list(reader.lines())
+        nb_read = 0
+        class RepeatedDump(object):
+            # a long stream made of the sample dump repeated
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+            def lines(self):
+                nonlocal nb_read
+                for i in range(100):
+                    for line in lines:
+                        nb_read += 1
+                        yield line
+
+        tf = TaggerFactory('http://localhost:8983/solr/', retries=0)
+        with requests_mock.Mocker() as mocker:
+            mocker.post('http://localhost:8983/solr/wd_test_collection/update', status_code=400)
+            with self.assertRaises(requests.exceptions.HTTPError):
+                tf.index_stream_parallel('wd_test_collection', RepeatedDump(), self.profile,
+                                         batch_size=10, workers=1, uploaders=1)
+        self.assertLess(nb_read, 1000)
+
+class CheckpointTests(unittest.TestCase):
+
+    def test_save_only_moves_forward(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = Checkpoint(os.path.join(tmpdir, 'checkpoint.json'))
+            for batch_id, position in enumerate([10, 20, 30]):
+                checkpoint.add(batch_id, position)
+            checkpoint.sent(0)
+            checkpoint.sent(1)
+            self.assertEqual((1, 20), checkpoint.last_sent_batch())
+            checkpoint.save(20, 1)
+            # a slower uploader committing an older position
+            checkpoint.save(10, 0)
+            self.assertEqual(20, checkpoint.load())
+            checkpoint.save(30, 2)
+            self.assertEqual(30, checkpoint.load())
+            self.assertEqual(['checkpoint.json'], os.listdir(tmpdir))
+
+class UpdateRetryTests(unittest.TestCase):
+
+    update_url = 'http://localhost:8983/solr/wd_test_collection/update'
+    docs = {'Q1': {'id': 'Q1', 'label': 'universe'}, 'Q2': None}
+
+    def test_compressed_update(self):
+        tf = TaggerFactory('http://localhost:8983/solr/', compress=True)
+        with requests_mock.Mocker() as mocker:
+            mocker.post(self.update_url)
+            tf._push_documents(self.docs, 'wd_test_collection', True)
+            request = mocker.request_history[0]
+            self.assertEqual('gzip', request.headers['Content-Encoding'])
+            self.assertEqual({'add': [self.docs['Q1']], 'delete': ['Q2']}, update_payload(request))
+            self.assertEqual(['true'], request.qs['commit'])
+
+    def test_retry(self):
+        tf = TaggerFactory('http://localhost:8983/solr/', retry_delay=0)
+        with requests_mock.Mocker() as mocker:
+            mocker.post(self.update_url, [{'status_code': 503}, {'exc': requests.exceptions.ConnectionError}, {'status_code': 200}])
+            tf._push_documents(self.docs, 'wd_test_collection')
+            self.assertEqual(3, mocker.call_count)
+            self.assertEqual(['Q2'], update_payload(mocker.request_history[-1])['delete'])
+
+    def test_failure_without_dead_letter(self):
+        tf = TaggerFactory('http://localhost:8983/solr/', retries=2, retry_delay=0)
+        with requests_mock.Mocker() as mocker:
+            mocker.post(self.update_url, status_code=500)
+            with self.assertRaises(requests.exceptions.HTTPError):
+                tf._push_documents(self.docs, 'wd_test_collection')
+            self.assertEqual(3, mocker.call_count)
+
+    def test_dead_letter_and_replay(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dead_letter = os.path.join(tmpdir, 'failed.jsonl')
+            tf = TaggerFactory('http://localhost:8983/solr/', retry_delay=0, dead_letter=dead_letter)
+            with requests_mock.Mocker() as mocker:
+                # client errors are not retried
+                mocker.post(self.update_url, status_code=400)
+                tf._push_documents(self.docs, 'wd_test_collection', True)
+                self.assertEqual(1, mocker.call_count)
+
+            with requests_mock.Mocker() as mocker:
+                mocker.post(self.update_url)
+                self.assertEqual(1, TaggerFactory('http://localhost:8983/solr/').replay_dead_letters(dead_letter))
+                request = mocker.request_history[0]
+                self.assertEqual({'add': [self.docs['Q1']], 'delete': ['Q2']}, update_payload(request))
+                self.assertEqual(['true'], request.qs['commit'])
+
+class ExportTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        testdir = os.path.dirname(os.path.abspath(__file__))
+        cls.profile = IndexingProfile.load(os.path.join(testdir, 'data/all_items_profile.json'))
+        cls.dump_fname = os.path.join(testdir, 'data/sample_wikidata_items.json.bz2')
+
+    def test_export_jsonl(self):
+        tf = TaggerFactory()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = tf.export_documents(self.dump_fname, tmpdir, self.profile, shards=3)
+            self.assertEqual(3, len(fnames))
+            self.assertEqual(sorted(fnames), sorted(os.path.join(tmpdir, f) for f in os.listdir(tmpdir)))
+            docs = []
+            for fname in fnames:
+                with gzip.open(fname, 'rt') as f:
+                    docs += [json.loads(line) for line in f]
+
+            with requests_mock.Mocker() as mocker:
+                mocker.post('http://localhost:8983/solr/wd_test_collection/update/json/docs')
+                mocker.post('http://localhost:8983/solr/wd_test_collection/update')
+                tf.ingest_documents('wd_test_collection', fnames)
+                uploads = mocker.request_history[:-1]
+                self.assertEqual(3, len(uploads))
+                self.assertNotIn('Content-Encoding', uploads[0].headers)
+                self.assertEqual(['true'], mocker.request_history[-1].qs['commit'])
+                uploaded = [json.loads(line) for upload in uploads for line in b''.join(upload.body).decode('utf-8').splitlines()]
+                self.assertEqual(sorted(doc['id'] for doc in docs), sorted(doc['id'] for doc in uploaded))
+
+            with requests_mock.Mocker() as mocker:
+                mocker.post('http://localhost:8983/solr/wd_test_collection/update/json/docs')
+                mocker.post('http://localhost:8983/solr/wd_test_collection/update')
+                TaggerFactory(compress=True).ingest_documents('wd_test_collection', fnames)
+                self.assertEqual('gzip', mocker.request_history[0].headers['Content-Encoding'])
+
+        ids = [doc['id'] for doc in docs]
+        self.assertEqual(100, len(ids))
+        self.assertEqual(100, len(set(ids)))
+        expected = self.profile.entity_to_document(next(iter(WikidataDumpReader(self.dump_fname))), tf.type_matcher)
+        self.assertIn(expected, docs)
+
+    def test_export_csv(self):
+        tf = TaggerFactory()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = tf.export_documents(self.dump_fname, tmpdir, self.profile, fmt='csv')
+            with gzip.open(fnames[0], 'rt', newline='') as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(100, len(rows))
+        first = self.profile.entity_to_document(next(iter(WikidataDumpReader(self.dump_fname))), tf.type_matcher)
+        self.assertEqual(first['id'], rows[0]['id'])
+        self.assertEqual(first['aliases'], rows[0]['aliases'].split('\x1f'))
+
+    def test_export_with_subclass_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_fname = os.path.join(tmpdir, 'subclasses.npz')
+            SubclassIndex(children=[3918], parents=[43229]).save(index_fname, roots=['Q43229'])
+            tf = TaggerFactory(type_matcher=TypeMatcher(subclass_index=index_fname))
+            # the type matcher is sent to the worker processes
+            fnames = tf.export_documents(self.dump_fname, os.path.join(tmpdir, 'docs'), self.profile, shards=2)
+            count = 0
+            for fname in fnames:
+                with gzip.open(fname, 'rt') as f:
+                    count += sum(1 for line in f)
+        self.assertEqual(100, count)
+
+    def test_merge_collections(self):
+        tf = TaggerFactory('http://localhost:8983/solr/')
+        status = {'cluster': {'collections': {
+            name: {'shards': {'shard1': {'replicas': {'core_node2': {'core': name + '_shard1_replica_n1'}}}}}
+            for name in ['target', 'part0', 'part1']
+        }}}
+        with requests_mock.Mocker() as mocker:
+            mocker.get('http://localhost:8983/solr/admin/collections', json=status)
+            mocker.get('http://localhost:8983/solr/admin/cores')
+            mocker.post(requests_mock.ANY)
+            tf.merge_collections('target', ['part0', 'part1'])
+            merge = [request for request in mocker.request_history if request.path.endswith('/cores')][0]
+            self.assertEqual(['target_shard1_replica_n1'], merge.qs['core'])
+            self.assertEqual(['part0_shard1_replica_n1', 'part1_shard1_replica_n1'], merge.qs['srccore'])
+            deleted = [request.qs['name'] for request in mocker.request_history if request.qs.get('action') == ['delete']]
+            self.assertEqual([['part0'], ['part1']], deleted)
@@ -2,7 +2,10 @@ import os
 import unittest
 import requests_mock
 import re
+import tempfile
 from opentapioca.typematcher import TypeMatcher
+from opentapioca.typematcher import SubclassIndex
+from opentapioca.typematcher import QidBitmap
 from .test_fixtures import cache_requests
 
 def test_typematcher(cache_requests):
@@ -25,4 +28,45 @@ def test_reflexive(cache_requests):
     Any type is a subclass of itself
     """
     t = TypeMatcher()
-    assert t.is_subclass('Q43229', 'Q43229')
\ No newline at end of file
+    assert t.is_subclass('Q43229', 'Q43229')
+
+def sample_subclass_index():
+    # university (Q3918) < educational institution (Q2385804) < organization (Q43229)
+    # foundation (Q157031) < organization (Q43229)
+    return SubclassIndex(children=[3918, 2385804, 157031, 5],
+                         parents=[2385804, 43229, 43229, 215627])
+
+def test_subclass_index():
+    index = sample_subclass_index()
+    assert list(index.closure('Q43229')) == [3918, 43229, 157031, 2385804]
+    assert list(index.closure('Q3918')) == [3918]
+    # classes without any subclass edge
+    assert list(index.closure('Q618123')) == [618123]
+
+def test_save_subclass_index():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'subclasses.npz')
+        sample_subclass_index().save(fname, roots=['Q43229'])
+        index = SubclassIndex.load(fname)
+        assert 'Q43229' in index.closures
+        assert list(index.closure('Q43229')) == [3918, 43229, 157031, 2385804]
+        assert list(index.closure('Q215627')) == [5, 215627]
+
+def test_typematcher_with_subclass_index():
+    t = TypeMatcher(subclass_index=sample_subclass_index())
+    with requests_mock.Mocker() as mocker:
+        mocker.get(re.compile('.*'), status_code=500)
+        assert t.is_subclass('Q3918', 'Q43229')
+        assert t.is_subclass('Q43229', 'Q43229')
+        assert not t.is_subclass('Q5', 'Q43229')
+        assert list(t.are_subclasses([3918, 5, 157031], 'Q43229')) == [True, False, True]
+
+def test_qid_bitmap():
+    bitmap = QidBitmap([43229, 3918, 7, 3918])
+    assert len(bitmap) == 3
+    assert 3918 in bitmap
+    assert 3917 not in bitmap
+    assert 10**9 not in bitmap
+    assert list(bitmap.contains_many([7, 8, 43229, -1, 10**9])) == [True, False, True, False, False]
+    assert list(bitmap.to_array()) == [7, 3918, 43229]
+    assert len(QidBitmap([]).contains_many([1, 2])) == 2
@@ -1,8 +1,11 @@
 import unittest
 import os
 import json
+import bz2
 from opentapioca.wditem import WikidataItemDocument
+from opentapioca.wditem import LazyWikidataItemDocument
 from .test_fixtures import load_item
+from .test_fixtures import testdir
 
 def test_parse_item(load_item):
     item = load_item('Q30264236')
@@ -21,6 +24,39 @@ def test_language_fallback(load_item):
     assert item.get_default_label('en') == 'Elisabeth Hauterive'
     assert item.get_default_label('fr') == 'Elisabeth Hauterive'
     
+def test_lazy_item(testdir):
+    with open(os.path.join(testdir, 'data', 'Q30264236.json'), 'r') as f:
+        item = LazyWikidataItemDocument(f.read())
+    assert item.get_nb_statements() == 9
+    assert item.get_nb_sitelinks() == 0
+    assert item.get_types() == ['Q31855']
+    assert item.fields.keys() == {'"P31"'}
+    assert set(item.get_outgoing_edges()) == {31855, 148, 530471, 9384257, 185684}
+    assert str(item) == '<WikidataItemDocument Q30264236>'
+
+def test_lazy_items_from_dump(testdir):
+    with bz2.open(os.path.join(testdir, 'data', 'sample_wikidata_items.json.bz2'), 'rt') as f:
+        lines = [line.rstrip().rstrip(',') for line in f if line.startswith('{')]
+    for line in lines:
+        item = WikidataItemDocument(json.loads(line))
+        lazy_item = LazyWikidataItemDocument(line)
+        assert lazy_item.get('id') == item.get('id')
+        assert lazy_item.get('lastrevid') == item.get('lastrevid')
+        for pid in ['P31', 'P17', 'P580', 'P248']:
+            assert lazy_item.get_claims(pid) == item.get_claims(pid)
+        assert lazy_item.get_nb_statements() == item.get_nb_statements()
+        assert lazy_item.get_nb_sitelinks() == item.get_nb_sitelinks()
+        assert lazy_item.get_all_terms() == item.get_all_terms()
+        assert lazy_item.get_outgoing_edges() == item.get_outgoing_edges()
+        assert lazy_item.get('missing_field', 3) == 3
+
+def test_coordinates(load_item):
+    assert load_item('Q31').get_coordinates() == (51, 5)
+    assert load_item('Q8502').get_coordinates() is None
+    on_mars = WikidataItemDocument({'id': 'Q1', 'claims': {'P625': [{'mainsnak': {'datavalue': {'value': {
+        'latitude': 4.5, 'longitude': 137.4, 'globe': 'http://www.wikidata.org/entity/Q111'}}}}]}})
+    assert on_mars.get_coordinates() is None
+
 
 if __name__ == '__main__':
     item = load_item('Q30264236')
@@ -1,6 +1,15 @@
 import unittest
 import os
+import bz2
+import json
+import math
+import numpy
+import tempfile
 from opentapioca.wikidatagraph import WikidataGraph
+from opentapioca.wikidatagraph import ParallelTransposedProduct
+from opentapioca.wikidatagraph import IncrementalPageRank
+from opentapioca.typematcher import SubclassIndex
+from opentapioca.coordinates import CoordinateStore
 
 class WikidataGraphTest(unittest.TestCase):
     @classmethod
@@ -17,10 +26,222 @@ class WikidataGraphTest(unittest.TestCase):
         graph = WikidataGraph()
         graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
         graph.mat.check_format()
-        self.assertEqual(graph.shape, 3942)
+        # only the items present in the dump or pointed to get a row
+        self.assertEqual(graph.shape, 558)
+        self.assertEqual(graph.qids[-1], 3941)
+        self.assertEqual(list(graph.qid_to_index([graph.qids[10], 2, 10**9])), [10, -1, -1])
+
+    def test_save_compact_graph(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        graph.compute_pagerank()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            graph.save_matrix(os.path.join(tmpdir, 'graph.npz'))
+            graph.save_pagerank(os.path.join(tmpdir, 'graph.pgrank.npy'))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'graph.qids.npy')))
+
+            loaded = WikidataGraph()
+            loaded.load_from_matrix(os.path.join(tmpdir, 'graph.npz'))
+            self.assertEqual(list(loaded.qids), list(graph.qids))
+            loaded.load_pagerank(os.path.join(tmpdir, 'graph.pgrank.npy'))
+            self.assertIsInstance(loaded.pagerank, numpy.memmap)
+            self.assertEqual(loaded.pagerank.dtype, numpy.float32)
+            self.assertAlmostEqual(loaded.get_pagerank('Q45'), graph.get_pagerank('Q45'), delta=1e-9)
+            # Q2 is not in the sample dump: it gets the rank of an item without
+            # incoming edges, which is of the order of 1/N
+            self.assertAlmostEqual(loaded.get_pagerank('Q2'), float(numpy.min(loaded.pagerank)))
+            self.assertTrue(0.5/len(graph.qids) < loaded.get_pagerank('Q2') <= 1./len(graph.qids))
         
     def test_compute_pagerank(self):
         graph = WikidataGraph()
         graph.load_from_matrix(os.path.join(self.testdir, 'data/sample_wikidata_items.npz'))
         graph.compute_pagerank()
-        self.assertTrue(graph.get_pagerank('Q45') > 0.0003 and graph.get_pagerank('Q45') < 0.0004)
\ No newline at end of file
+        self.assertTrue(graph.get_pagerank('Q45') > 0.0003 and graph.get_pagerank('Q45') < 0.0004)
+        # the residual is logged when the iteration limit is reached
+        with self.assertLogs('opentapioca.wikidatagraph', level='WARNING') as logs:
+            graph.compute_pagerank(max_iterations=2)
+        self.assertIn('did not converge in 2 iterations', logs.output[0])
+
+    def test_compute_pagerank_float32(self):
+        graph = WikidataGraph()
+        graph.load_from_matrix(os.path.join(self.testdir, 'data/sample_wikidata_items.npz'))
+        graph.compute_pagerank(dtype=numpy.float32, num_threads=3)
+        self.assertEqual(graph.pagerank.dtype, numpy.float32)
+        self.assertAlmostEqual(graph.pagerank.sum(), 1., places=4)
+        self.assertTrue(graph.get_pagerank('Q45') > 0.0003 and graph.get_pagerank('Q45') < 0.0004)
+        # converged before the iteration limit
+        self.assertTrue(len(graph.pagerank_timings) < 16)
+
+    def test_parallel_transposed_product(self):
+        graph = WikidataGraph()
+        graph.load_from_matrix(os.path.join(self.testdir, 'data/sample_wikidata_items.npz'))
+        product = ParallelTransposedProduct(graph.mat, num_threads=4)
+        try:
+            v = numpy.random.rand(graph.mat.shape[0])
+            numpy.testing.assert_allclose(product.dot(v), graph.mat.T.dot(v))
+        finally:
+            product.close()
+
+    def test_load_legacy_pagerank(self):
+        graph = WikidataGraph()
+        graph.load_pagerank(os.path.join(self.testdir, 'data/sample_wikidata_items.pgrank.npy'))
+        self.assertEqual(graph.pagerank.shape, (3942,))
+        self.assertIsNone(graph.qids)
+        self.assertTrue(graph.get_pagerank('Q45') > 0.0003 and graph.get_pagerank('Q45') < 0.0004)
+        self.assertEqual(graph.get_pagerank('Q5000'), float(numpy.min(graph.pagerank)))
+
+    def test_get_log_ranks(self):
+        graph = WikidataGraph()
+        graph.load_pagerank(os.path.join(self.testdir, 'data/sample_wikidata_items.pgrank.npy'))
+        rank_shift = graph.get_pagerank('Q9999999999')
+        log_ranks = graph.get_log_ranks(numpy.array([45, 31, 10**10]))
+        self.assertAlmostEqual(log_ranks[0], math.log(graph.get_pagerank('Q45')) - math.log(rank_shift))
+        self.assertAlmostEqual(log_ranks[1], math.log(graph.get_pagerank('Q31')) - math.log(rank_shift))
+        self.assertEqual(log_ranks[2], 0.)
+
+    def test_personalized_pagerank(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        graph.compute_pagerank(teleport_sets={'portugal': numpy.array([45])})
+        personalized = graph.personalized['portugal']
+        self.assertAlmostEqual(personalized.sum(), 1.)
+        self.assertTrue(personalized[graph.qid_to_index(45)] > 0.15)
+        # the global pagerank is not affected by the personalized ones
+        self.assertAlmostEqual(graph.pagerank.sum(), 1.)
+        self.assertTrue(graph.get_pagerank('Q45') < 0.01)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'graph.pgrank.npy')
+            graph.save_pagerank(fname)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'graph.pgrank.portugal.npy')))
+            loaded = WikidataGraph()
+            loaded.load_pagerank(fname, profiles=['portugal'])
+            log_ranks = loaded.get_log_ranks(numpy.array([45]), profile='portugal')
+            self.assertTrue(log_ranks[0] > loaded.get_log_ranks(numpy.array([45]))[0])
+
+    def test_instances_of(self):
+        city = {'mainsnak': {'datavalue': {'value': {'id': 'Q515', 'numeric-id': 515}}}}
+        items = [
+            {'id': 'Q585', 'type': 'item', 'claims': {'P31': [city]}},
+            {'id': 'Q515', 'type': 'item', 'claims': {}},
+            {'id': 'Q3918', 'type': 'item', 'claims': {'P279': [city]}},
+            # born in a city (P19), which does not make it a city
+            {'id': 'Q1339', 'type': 'item', 'claims': {'P19': [city]}},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dump_fname = os.path.join(tmpdir, 'dump.json.bz2')
+            with bz2.open(dump_fname, 'wt') as f:
+                f.write('[\n' + ',\n'.join(json.dumps(item) for item in items) + '\n]\n')
+            instances_fname = os.path.join(tmpdir, 'dump.instances.npy')
+            WikidataGraph.preprocess_dump(dump_fname, os.path.join(tmpdir, 'dump.unsorted.tsv'), instances_fname=instances_fname)
+            self.assertEqual(list(WikidataGraph.instances_of([515], instances_fname)), [515, 585])
+            # the subclasses of the class are given by the closure
+            self.assertEqual(list(WikidataGraph.instances_of([515, 3918], instances_fname)), [515, 585, 3918])
+
+    def test_incremental_pagerank(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        graph.compute_pagerank()
+        before = graph.get_pagerank('Q31')
+
+        # Q45 (Portugal) now only points to Q31 (Belgium), twice
+        self.assertTrue(graph.update_edges('Q45', [31, 31, 10**8]))
+        self.assertFalse(graph.update_edges('Q10000000', [31]))
+        graph.refresh_pagerank(max_iterations=100, tol=1e-10)
+        self.assertTrue(graph.get_pagerank('Q31') > before)
+
+        # same result as a full computation on the edited matrix
+        incremental = graph.pagerank
+        graph.merge_overlay()
+        self.assertEqual(list(graph.mat[graph.qid_to_index(45)].indices), [graph.qid_to_index(31)])
+        graph.compute_pagerank(max_iterations=100, tol=1e-10)
+        numpy.testing.assert_allclose(incremental, graph.pagerank, atol=1e-8)
+
+    def test_reload_pagerank(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        graph.compute_pagerank()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'graph.pgrank.npy')
+            graph.save_pagerank(fname)
+            server = WikidataGraph()
+            server.load_pagerank(fname)
+            server.reload_interval = 0
+            self.assertFalse(server.reload_pagerank_if_changed())
+
+            updater = IncrementalPageRank(graph, fname)
+            graph.update_edges('Q45', [31])
+            updater.refresh()
+            self.assertTrue(server.reload_pagerank_if_changed())
+            self.assertAlmostEqual(server.get_pagerank('Q31'), graph.get_pagerank('Q31'), delta=1e-9)
+
+    def test_merge_and_save_overlay(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        graph.compute_pagerank()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'graph.pgrank.npy')
+            updater = IncrementalPageRank(graph, fname, max_overlay=2)
+            graph.update_edges('Q45', [31])
+            updater.refresh()
+            self.assertEqual(1, len(graph.overlay))
+            self.assertFalse(os.path.exists(updater.matrix_fname))
+
+            graph.update_edges('Q31', [45])
+            updater.refresh()
+            self.assertEqual({}, graph.overlay)
+            self.assertEqual(os.path.join(tmpdir, 'graph.pgrank.graph.npz'), updater.matrix_fname)
+
+            # the edits are kept when the matrix is loaded again
+            restarted = WikidataGraph()
+            restarted.load_from_matrix(updater.matrix_fname)
+            self.assertEqual(list(restarted.mat[restarted.qid_to_index(45)].indices), [restarted.qid_to_index(31)])
+            self.assertEqual(list(restarted.mat[restarted.qid_to_index(31)].indices), [restarted.qid_to_index(45)])
+
+    def test_neighbours(self):
+        graph = WikidataGraph()
+        graph.load_from_preprocessed_dump(os.path.join(self.testdir, 'data/sample_wikidata_items.tsv'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'graph.npz')
+            graph.save_matrix(fname)
+            mapped = WikidataGraph()
+            mapped.load_from_matrix(fname, mmap=True)
+            self.assertFalse(mapped.mat.indices.flags.owndata)
+
+            # Q585 (Oslo) is an instance of Q515 (city)
+            self.assertIn(515, mapped.neighbours('Q585'))
+            self.assertEqual(list(mapped.neighbours('Q585')), list(graph.neighbours('Q585')))
+            self.assertTrue(mapped.has_edge('Q585', 'Q515'))
+            self.assertFalse(mapped.has_edge('Q515', 'Q585'))
+            self.assertFalse(mapped.has_edge('Q2', 'Q515'))
+            self.assertIn(515, mapped.common_neighbours('Q585', 'Q586'))
+            self.assertEqual(len(mapped.neighbours('Q2')), 0)
+
+            # edits recorded in the overlay are taken into account
+            mapped.update_edges('Q585', [586])
+            self.assertEqual(list(mapped.neighbours('Q585')), [586])
+
+    def test_preprocess_subclasses(self):
+        items = [
+            {'id': 'Q3918', 'type': 'item', 'claims': {'P279': [
+                {'mainsnak': {'datavalue': {'value': {'id': 'Q2385804', 'numeric-id': 2385804}}}}]}},
+            {'id': 'Q2385804', 'type': 'item', 'claims': {'P279': [
+                {'mainsnak': {'datavalue': {'value': {'id': 'Q43229', 'numeric-id': 43229}}}}]}},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dump_fname = os.path.join(tmpdir, 'dump.json.bz2')
+            with bz2.open(dump_fname, 'wt') as f:
+                f.write('[\n' + ',\n'.join(json.dumps(item) for item in items) + '\n]\n')
+            subclass_fname = os.path.join(tmpdir, 'dump.subclasses.npy')
+            WikidataGraph.preprocess_dump(dump_fname, os.path.join(tmpdir, 'dump.unsorted.tsv'), subclass_fname=subclass_fname)
+            index = SubclassIndex.load(subclass_fname)
+            self.assertEqual(list(index.closure('Q43229')), [3918, 43229, 2385804])
+
+    def test_preprocess_coordinates(self):
+        dump_fname = os.path.join(self.testdir, 'data/sample_wikidata_items.json.bz2')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            coords_fname = os.path.join(tmpdir, 'dump.coords.npy')
+            WikidataGraph.preprocess_dump(dump_fname, os.path.join(tmpdir, 'dump.unsorted.tsv'), coords_fname=coords_fname)
+            store = CoordinateStore.load(coords_fname)
+            self.assertEqual(94, len(store))
+            self.assertAlmostEqual(47.233333, store.get_coord('Q3941')[0], places=4)
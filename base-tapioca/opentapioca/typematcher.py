@@ -1,15 +1,142 @@
+import numpy
+from scipy import sparse
+from scipy.sparse.csgraph import breadth_first_order
+
 from .utils import to_q
 from .sparqlwikidata import sparql_wikidata
 
+class SubclassIndex(object):
+    """
+    The subclass hierarchy extracted from a dump (the "subclass of" (P279)
+    edges collected by `tapioca preprocess`), used to compute the children
+    of classes locally instead of querying SPARQL.
+
+    It is saved as a .npz file holding the edges and the precomputed
+    children of some root classes, as sorted arrays of numeric ids.
+    """
+
+    def __init__(self, children, parents, closures=None):
+        """
+        :param children: numeric ids of the subclasses
+        :param parents: numeric ids of their parent classes (same length)
+        :param closures: a mapping from qids to precomputed closures
+        """
+        self.children = numpy.asarray(children)
+        self.parents = numpy.asarray(parents)
+        self.closures = closures if closures is not None else {}
+        self.nodes = None
+        self.graph = None
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Loads the edges saved by `tapioca preprocess` (.npy) or an
+        index saved with `save` (.npz). The file is read entirely and closed,
+        so that the index can be pickled (to be sent to worker processes).
+        """
+        loaded = numpy.load(fname)
+        if isinstance(loaded, numpy.ndarray):
+            return cls(loaded[0], loaded[1])
+        with loaded:
+            arrays = {key: loaded[key] for key in loaded.files}
+        children = arrays.pop('children')
+        parents = arrays.pop('parents')
+        return cls(children, parents, closures=arrays)
+
+    def save(self, fname, roots=()):
+        """
+        Saves the edges and the closures of the given root classes.
+        """
+        arrays = {qid: self.closure(qid) for qid in roots}
+        numpy.savez(fname, children=self.children, parents=self.parents, **arrays)
+
+    def closure(self, qid):
+        """
+        Returns the numeric ids of all the subclasses of the class,
+        including itself, as a sorted array.
+        """
+        if qid in self.closures:
+            return self.closures[qid]
+
+        if self.graph is None:
+            # edges from parents to children, indexed by position in self.nodes
+            self.nodes = numpy.unique(numpy.concatenate([self.children, self.parents]))
+            rows = numpy.searchsorted(self.nodes, self.parents)
+            cols = numpy.searchsorted(self.nodes, self.children)
+            self.graph = sparse.csr_matrix(
+                (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)),
+                shape=(len(self.nodes), len(self.nodes)))
+
+        id = int(qid[1:])
+        idx = numpy.searchsorted(self.nodes, id)
+        if idx >= len(self.nodes) or self.nodes[idx] != id:
+            return numpy.array([id], dtype=self.nodes.dtype)
+        order = breadth_first_order(self.graph, idx, directed=True, return_predecessors=False)
+        return numpy.sort(self.nodes[order])
+
+class QidBitmap(object):
+    """
+    A set of numeric ids, stored as a dense bit array indexed
+    by id: one bit per id up to the largest one in the set.
+    This is much more compact than a Python set of ints for the
+    large subclass closures (a few MB for the whole id range of
+    Wikidata), and supports vectorized membership checks.
+    """
+
+    def __init__(self, ids):
+        """
+        :param ids: the numeric ids in the set
+        """
+        ids = numpy.unique(numpy.asarray(ids, dtype=numpy.int64))
+        ids = ids[ids >= 0]
+        self.count = len(ids)
+        nb_bytes = (int(ids[-1]) >> 3) + 1 if self.count else 0
+        self.bits = numpy.zeros(nb_bytes, dtype=numpy.uint8)
+        numpy.bitwise_or.at(self.bits, ids >> 3, (1 << (ids & 7)).astype(numpy.uint8))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return 0 <= byte < len(self.bits) and bool((self.bits[byte] >> (id & 7)) & 1)
+
+    def contains_many(self, ids):
+        """
+        Vectorized membership check.
+
+        :param ids: an array of numeric ids
+        :returns: a boolean array of the same length
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        byte_idx = ids >> 3
+        valid = (ids >= 0) & (byte_idx < len(self.bits))
+        result = numpy.zeros(len(ids), dtype=bool)
+        result[valid] = (self.bits[byte_idx[valid]] >> (ids[valid] & 7)) & 1
+        return result
+
+    def to_array(self):
+        """
+        Returns the ids in the set, as a sorted array.
+        """
+        return numpy.flatnonzero(numpy.unpackbits(self.bits, bitorder='little'))
+
 class TypeMatcher(object):
     """
     Interface that caches the subclasses of parent classes.
-    Cached in memory.
+    Cached in memory, as QidBitmap objects.
     """
 
-    def __init__(self, subclass_pid='P279'):
+    def __init__(self, subclass_pid='P279', subclass_index=None):
+        """
+        :param subclass_index: the filename of a SubclassIndex (or the index itself)
+            to compute the subclasses from, instead of querying SPARQL
+        """
         self.subclass_pid = subclass_pid
         self.sets = {}
+        if isinstance(subclass_index, str):
+            subclass_index = SubclassIndex.load(subclass_index)
+        self.subclass_index = subclass_index
 
     def is_subclass(self, qid_1, qid_2):
         """
@@ -27,14 +154,30 @@ class TypeMatcher(object):
             self.prefetch_children(qid_2)
         return int(qid_1[1:]) in self.sets[qid_2]
 
+    def are_subclasses(self, ids, qid_2):
+        """
+        Vectorized version of is_subclass, for many
+        classes (given by numeric ids) at once.
+
+        :returns: a boolean array
+        """
+        if not qid_2 in self.sets:
+            self.prefetch_children(qid_2)
+        return self.sets[qid_2].contains_many(ids)
+
     def prefetch_children(self, qid, force=False):
         """
-        Prefetches (in Redis) all the children of a given class
+        Prefetches (in memory) all the children of a given class,
+        from the subclass index if any, or via SPARQL otherwise.
         """
 
         if qid in self.sets:
             return # children are already prefetched
 
+        if self.subclass_index is not None:
+            self.sets[qid] = QidBitmap(self.subclass_index.closure(qid))
+            return
+
         sparql_query = """
         PREFIX wd: <http://www.wikidata.org/entity/>
         PREFIX wdt: <http://www.wikidata.org/prop/direct/>
@@ -42,12 +185,10 @@ class TypeMatcher(object):
         """ % (self.subclass_pid, qid)
         results = sparql_wikidata(sparql_query)
 
-        new_set = set()
+        child_ids = []
         for result in results["bindings"]:
             child_qid = to_q(result["child"]["value"])
             if child_qid: # this can fail if the entity is a property, lexeme…
-                new_set.add(int(child_qid[1:]))
-
-        self.sets[qid] = new_set
-
+                child_ids.append(int(child_qid[1:]))
 
+        self.sets[qid] = QidBitmap(child_ids)
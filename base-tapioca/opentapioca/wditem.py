@@ -1,4 +1,10 @@
 
+import re
+import json
+
+# the globe of coordinates on Earth
+EARTH = 'http://www.wikidata.org/entity/Q2'
+
 class WikidataItemDocument(object):
     def __init__(self, json):
         self.json = json
@@ -7,7 +13,7 @@ class WikidataItemDocument(object):
         return self.json.get(field, default_value)
     
     def __repr__(self):
-        return '<WikidataItemDocument {}>'.format(self.json.get('id') or '(unknown qid)')
+        return '<WikidataItemDocument {}>'.format(self.get('id') or '(unknown qid)')
 
     def __iter__(self):
         return self.json.__iter__()
@@ -54,11 +60,17 @@ class WikidataItemDocument(object):
         """
         return len(self.get('sitelinks', []))
 
+    def get_claims(self, pid):
+        """
+        The statements of the item for a given property
+        """
+        return self.get('claims', {}).get(pid, [])
+
     def get_types(self, pid='P31'):
         """
         Values of P31 claims
         """
-        type_claims = self.get('claims', {}).get(pid, [])
+        type_claims = self.get_claims(pid)
         type_qids = [
             claim.get('mainsnak', {}).get('datavalue', {}).get('value', {}).get('id')
             for claim in type_claims
@@ -103,7 +115,7 @@ class WikidataItemDocument(object):
 
     def get_identifiers(self, pid):
         # Fetch GRID
-        id_claims = self.get('claims', {}).get(pid, [])
+        id_claims = self.get_claims(pid)
         ids = [
             claim.get('mainsnak', {}).get('datavalue', {}).get('value', {})
             for claim in id_claims
@@ -111,8 +123,105 @@ class WikidataItemDocument(object):
         valid_ids = [ id for id in ids if id ]
         return valid_ids
 
+    def get_coordinates(self, pid='P625'):
+        """
+        The (latitude, longitude) of the first coordinates
+        of the item on Earth, or None if it has none.
+        """
+        for value in self.get_identifiers(pid):
+            if not isinstance(value, dict) or value.get('latitude') is None or value.get('longitude') is None:
+                continue
+            if value.get('globe', EARTH) == EARTH:
+                return value['latitude'], value['longitude']
+        return None
+
+# decodes JSON values in the middle of a string
+_decoder = json.JSONDecoder()
+_field_res = {}
+_list_start_re = re.compile(r'\s*:\s*(?=\[)')
+
+class LazyWikidataItemDocument(WikidataItemDocument):
+    """
+    A WikidataItemDocument built from the raw JSON representation
+    of an item (as found in dumps), which only decodes its fields
+    (labels, claims…) when they are first accessed. The statements
+    and sitelinks are counted without decoding them.
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.fields = {}
+        self._json = None
+
+    @property
+    def json(self):
+        """
+        The entire representation of the item, decoded.
+        """
+        if self._json is None:
+            self._json = json.loads(self.line)
+        return self._json
+
+    def get(self, field, default_value=None):
+        if self._json is not None:
+            return self._json.get(field, default_value)
+        if field not in self.fields:
+            self.fields[field] = self._decode_field(field)
+        value = self.fields[field]
+        return default_value if value is None else value
+
+    def _decode_field(self, field):
+        """
+        Decodes the value of a top-level field (None if the field is missing).
+        """
+        if field not in _field_res:
+            _field_res[field] = re.compile(r'"{}"\s*:\s*'.format(re.escape(field)))
+        match = _field_res[field].search(self.line)
+        if match is None:
+            return None
+        # fields which also appear in nested objects (such as "id") are
+        # only found this way if they come before any nested object
+        first_object = self.line.find('{', 1)
+        if field in ('id', 'type') and 0 <= first_object < match.start():
+            return self.json.get(field)
+        return _decoder.raw_decode(self.line, match.end())[0]
+
+    def get_claims(self, pid):
+        """
+        The statements for a property are decoded on their own if
+        the claims were not decoded yet: the property can also appear
+        as the key of qualifiers or references, but only the lists of
+        statements (of the claims) contain objects with a "mainsnak".
+        """
+        if self._json is not None or 'claims' in self.fields:
+            return super(LazyWikidataItemDocument, self).get_claims(pid)
+        key = '"{}"'.format(pid)
+        if key not in self.fields:
+            claims = []
+            pos = self.line.find(key)
+            while pos != -1:
+                match = _list_start_re.match(self.line, pos + len(key))
+                if match:
+                    values = _decoder.raw_decode(self.line, match.end())[0]
+                    if values and isinstance(values[0], dict) and 'mainsnak' in values[0]:
+                        claims = values
+                        break
+                pos = self.line.find(key, pos + len(key))
+            self.fields[key] = claims
+        return self.fields[key]
+
+    def get_nb_statements(self):
+        if self._json is not None or 'claims' in self.fields:
+            return super(LazyWikidataItemDocument, self).get_nb_statements()
+        return self.line.count('"mainsnak":')
+
+    def get_nb_sitelinks(self):
+        if self._json is not None or 'sitelinks' in self.fields:
+            return super(LazyWikidataItemDocument, self).get_nb_sitelinks()
+        return self.line.count('"site":')
+
+
 import os
-import json
 
 if __name__ == '__main__':
     qid = 'Q8502'
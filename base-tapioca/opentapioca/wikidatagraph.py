@@ -1,7 +1,82 @@
+import os
+import time
 import numpy
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from scipy import sparse
-from opentapioca.readers.dumpreader import WikidataDumpReader
+from opentapioca.readers.snapshot import open_dump
+from opentapioca.readers.dumpreader import RawLineFilter
+
+logger = logging.getLogger(__name__)
+
+# numeric ids of Wikidata items (without the leading Q)
+QID_DTYPE = numpy.int32
+MAX_QID = numpy.iinfo(QID_DTYPE).max
+
+class ParallelTransposedProduct(object):
+    """
+    Computes products of the transpose of a sparse matrix with dense
+    vectors. The transposed matrix is built once and split in blocks of
+    rows holding a similar number of non-zero entries, which are multiplied
+    in separate threads (scipy releases the GIL during sparse products).
+    """
+
+    def __init__(self, mat, dtype=numpy.float64, num_threads=None):
+        self.num_threads = max(1, num_threads or os.cpu_count() or 1)
+        mat_t = mat.T.tocsr()
+        mat_t.sort_indices()
+        data = mat_t.data.astype(dtype, copy=False)
+        self.shape = mat_t.shape
+
+        # split rows so that every block gets the same number of edges
+        targets = numpy.linspace(0, mat_t.nnz, self.num_threads+1)
+        bounds = numpy.searchsorted(mat_t.indptr, targets[1:-1]).clip(0, self.shape[0])
+        bounds = numpy.unique(numpy.concatenate([[0], bounds, [self.shape[0]]]))
+        self.blocks = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            lo, hi = mat_t.indptr[start], mat_t.indptr[end]
+            block = sparse.csr_matrix(
+                (data[lo:hi], mat_t.indices[lo:hi], mat_t.indptr[start:end+1] - lo),
+                shape=(end - start, self.shape[1]), copy=False)
+            self.blocks.append((start, end, block))
+        self.executor = None
+        if len(self.blocks) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.blocks))
+
+    def dot(self, v, out=None):
+        """
+        Returns mat.T @ v, written in out if provided.
+        """
+        if out is None:
+            out = numpy.empty((self.shape[0],) + v.shape[1:], dtype=numpy.result_type(v, self.blocks[0][2].dtype))
+
+        def multiply(block):
+            start, end, mat = block
+            out[start:end] = mat.dot(v)
+
+        if self.executor is None:
+            for block in self.blocks:
+                multiply(block)
+        else:
+            for future in [self.executor.submit(multiply, block) for block in self.blocks]:
+                future.result()
+        return out
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def save_atomically(fname, array):
+    """
+    Saves a numpy array (.npy) by replacing the target file atomically,
+    so that readers never see a partially written file.
+    """
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        numpy.save(f, array)
+    os.replace(tmp_fname, fname)
 
 class WikidataGraph(object):
     """
@@ -13,24 +88,68 @@ class WikidataGraph(object):
       the list of ids this item points to, and the number of occurences of such links.
     - second, this dump must be externally sorted (for instance with GNU sort). Doing
       the sorting externally is more efficient than doing it inside Python itself.
-    - third, the sorted dump is converted into a Numpy sparse adjacency matrix (.npz)
+    - third, the sorted dump is converted into a Numpy sparse adjacency matrix (.npz,
+      with its raw arrays in .indptr.npy, .indices.npy and .data.npy files which can
+      be memory-mapped) indexed by the position of items in a sorted array of qids (.qids.npy)
     - fourth, we can compute the pagerank from the Numpy sparse matrix and store
-      it as a dense matrix (.npy)
+      it as a flat float32 vector (.npy), along with the same array of qids.
+      This vector is memory-mapped when loaded, so that processes serving
+      requests share the same copy in the page cache.
 
     This slightly convoluted setup makes it possible to process entire dumps on
     a machine with little memory (8GB).
     """
+
+    def __init__(self):
+        self.mat = None
+        self.shape = None
+        self.pagerank = None
+        # cached by default_pagerank, reset when the pagerank changes
+        self._default_pagerank = None
+        # personalized pageranks, by name of their teleport set
+        self.personalized = {}
+        # sorted numeric ids of the items in the graph,
+        # or None if rows are indexed by QID number
+        self.qids = None
+        # edited rows which are not merged in the matrix yet: row -> (columns, weights)
+        self.overlay = {}
+        self._product = None
+        # file the pagerank was loaded from, to reload it when it is replaced
+        self.pagerank_fname = None
+        self.reload_interval = 60
+        self._pagerank_stat = None
+        self._last_reload_check = 0.
+
     @classmethod
-    def preprocess_dump(cls, fname, output_fname):
+    def preprocess_dump(cls, fname, output_fname, subclass_fname=None, processes=None, coords_fname=None,
+                        instances_fname=None):
         """
-        Compresses a JSON Wikidata dump in a custom, smaller format
+        Compresses a JSON Wikidata dump (or a snapshot) in a custom, smaller format
         that only stores the edges and their weights. This file should
         then be sorted (for instance with GNU sort) before being loaded
         as a pre-processed dump.
+
+        :param subclass_fname: if provided, the "subclass of" (P279) edges
+            are saved in this file (.npy) as an array of two rows: children
+            and parents. It can be loaded as a SubclassIndex.
+        :param processes: the number of processes decompressing the dump
+        :param coords_fname: if provided, the coordinates (P625) of the items
+            are saved in this file (.npy), to be loaded as a CoordinateStore
+        :param instances_fname: if provided, the "instance of" (P31) edges
+            are saved in this file (.npy) as an array of two rows: items and
+            classes. It is used to build teleport sets (see instances_of).
         """
         output_file = open(output_fname, 'w')
-
-        with WikidataDumpReader(fname) as reader:
+        children = []
+        parents = []
+        instances = []
+        classes = []
+        located = []
+        coords = []
+
+        # only items are part of the graph
+        prefilter = RawLineFilter(id_prefixes='Q')
+        with open_dump(fname, processes=processes, prefilter=prefilter) as reader:
             counter = 0
             for item in reader:
                 qid = item.get('id')
@@ -41,6 +160,23 @@ class WikidataGraph(object):
                 if counter % 10000 == 0:
                     print('\rstep : ' + str(counter), end='', flush=True)
 
+                for parent in item.get_types('P279'):
+                    if parent[0] == 'Q':
+                        children.append(rowid)
+                        parents.append(int(parent[1:]))
+
+                if instances_fname is not None:
+                    for cls_qid in item.get_types('P31'):
+                        if cls_qid[0] == 'Q':
+                            instances.append(rowid)
+                            classes.append(int(cls_qid[1:]))
+
+                if coords_fname is not None:
+                    coordinates = item.get_coordinates()
+                    if coordinates is not None:
+                        located.append(rowid)
+                        coords.append(coordinates)
+
                 edges = item.get_outgoing_edges()
                 nb_edges = len(edges)
                 if not nb_edges:
@@ -58,129 +194,668 @@ class WikidataGraph(object):
                 ]
                 output_file.write('\t'.join(fields)+'\n')
                 counter = counter + 1
+        output_file.close()
+
+        if subclass_fname is not None:
+            numpy.save(subclass_fname, numpy.array([children, parents], dtype=QID_DTYPE).reshape(2, -1))
+
+        if instances_fname is not None:
+            numpy.save(instances_fname, numpy.array([instances, classes], dtype=QID_DTYPE).reshape(2, -1))
+
+        if coords_fname is not None:
+            from opentapioca.coordinates import CoordinateStore
+            CoordinateStore.from_pairs(located, coords).save(coords_fname)
 
     def load_from_preprocessed_dump(self, fname, batch_size=1000000):
         """
         Loads the pre-processed dump in a sparse matrix. The dump must be sorted.
-        !!!returns a weighted adjacency matrix
-        !!!hence rows summing to 1
-        !!!number of rows is the QID of the last item in the dump --> many empty rows
+        This returns a weighted adjacency matrix, whose rows sum to 1
+        (or 0 for items without outgoing edges).
 
-        :param batch_size: number of rows to process before stacking them in the sparse matrix
-        """
-        data_lst = []
-        indices_lst = []
-        indptr = [0]
-        nonempty_indices = []
-        row_offset = 0
-        block_matrices = []
+        Rows and columns are not indexed by QID number (which would leave
+        many empty rows for deleted or non-item ids) but by the position of
+        the QID in the sorted array self.qids, which contains all the items
+        of the dump and the items they point to.
 
-        # First, read the last qid
+        :param batch_size: number of rows to process before converting them to arrays
+        """
+        # First, check that the dump is sorted and collect all the qids
         with open(fname, 'r') as f:
             last_qid = 0
+            sources = []
+            targets = []
+            node_batches = []
             for line in f:
-                qid = int(line.split('\t')[0])
+                fields = line.split('\t')
+                qid = int(fields[0])
                 if qid <= last_qid:
                     raise ValueError('The dump "{}" is not sorted : {} and {}.'.format(fname,qid,last_qid))
                 last_qid = qid
+                sources.append(qid)
+                targets += json.loads(fields[1])
+                if len(sources) >= batch_size:
+                    node_batches.append(numpy.unique(numpy.array(sources + targets, dtype=QID_DTYPE)))
+                    sources = []
+                    targets = []
+            node_batches.append(numpy.array(sources + targets, dtype=QID_DTYPE))
         print('Last QID: Q%d' % last_qid)
 
-        with open(fname, 'r') as f:
+        qids = numpy.unique(numpy.concatenate(node_batches))
+        qids = qids[qids <= last_qid]
+        del node_batches, sources, targets
+
+        row_lengths = numpy.zeros(len(qids), dtype=numpy.int64)
+        data_batches = []
+        indices_batches = []
+        rows = []
+        data_lst = []
+        indices_lst = []
+        nb_nonempty = 0
+
+        def flush():
+            if rows:
+                row_idx = numpy.searchsorted(qids, rows)
+                lengths = [len(row) for row in indices_lst]
+                row_lengths[row_idx] = lengths
+                indices_batches.append(numpy.searchsorted(qids, numpy.concatenate(indices_lst)).astype(numpy.int32))
+                data_batches.append(numpy.concatenate(data_lst))
+                rows.clear()
+                data_lst.clear()
+                indices_lst.clear()
 
+        with open(fname, 'r') as f:
             for line in f:
                 fields = line.strip().split('\t')
                 qid = int(fields[0])
-                indices = json.loads(fields[1])
-                counts = json.loads(fields[2])
-
-                # pad with empty rows so that we stay in sync
-                while row_offset + len(indptr) <= qid:
-                    indptr.append(len(data_lst))
-
-                idx_counts = [(idx, count) for idx, count in zip(indices, counts) if idx <= last_qid ]
-
-                if idx_counts:
-                    nonempty_indices.append(qid)
-                    counts = [count for idx, count in idx_counts]
-                    indices = [idx for idx, count in idx_counts]
-                    sum_counts = float(sum(counts))
-                    weights = [count / sum_counts for count in counts]
-                    data_lst += weights
-                    indices_lst += indices
-                    indptr.append(len(data_lst))
-
-                if len(nonempty_indices) % batch_size == 0 or qid == last_qid:
+                indices = numpy.array(json.loads(fields[1]), dtype=QID_DTYPE)
+                counts = numpy.array(json.loads(fields[2]), dtype=numpy.float64)
+
+                kept = indices <= last_qid
+                if not kept.any():
+                    continue
+                counts = counts[kept]
+                nb_nonempty += 1
+                rows.append(qid)
+                indices_lst.append(indices[kept])
+                data_lst.append(counts / counts.sum())
+
+                if len(rows) >= batch_size:
+                    flush()
                     print('\rNon-empty indices in the sparse matrix : ',
-                          len(nonempty_indices),
+                          nb_nonempty,
                           end='',
                           flush=True)
-                    mat = sparse.csr_matrix((data_lst, indices_lst, indptr), shape=(len(indptr)-1,last_qid+1))
-                    mat.check_format(full_check=True)
-                    block_matrices.append(mat)
-                    row_offset += len(indptr) - 1
-                    data_lst = []
-                    indices_lst = []
-                    indptr = [0]
-
-
-        self.mat = sparse.vstack(block_matrices)
-        self.N = len(nonempty_indices)
+            flush()
+
+        indptr = numpy.zeros(len(qids)+1, dtype=numpy.int64)
+        numpy.cumsum(row_lengths, out=indptr[1:])
+        if indptr[-1] <= numpy.iinfo(numpy.int32).max:
+            indptr = indptr.astype(numpy.int32)
+        data = numpy.concatenate(data_batches) if data_batches else numpy.zeros(0)
+        indices = numpy.concatenate(indices_batches) if indices_batches else numpy.zeros(0, dtype=numpy.int32)
+
+        self.mat = sparse.csr_matrix((data, indices, indptr), shape=(len(qids), len(qids)))
+        self.mat.check_format(full_check=True)
+        self.qids = qids
+        self.N = nb_nonempty
         self.shape = self.mat.shape[1]
 
+    def load_from_matrix(self, fname, mmap=False):
+        """
+        Loads an adjacency matrix saved with save_matrix, with the
+        mapping from rows to qids stored alongside it if any.
 
-    def load_from_matrix(self, fname):
-        self.mat = sparse.load_npz(fname)
+        :param mmap: map the raw arrays of the matrix in memory (read-only)
+            instead of reading the .npz file. Neighbour queries are then
+            fast even when the matrix is much larger than the available memory.
+        """
+        if mmap:
+            arrays = {
+                name: numpy.load(self.array_filename(fname, name), mmap_mode='r')
+                for name in ['indptr', 'indices', 'data']
+            }
+            N = len(arrays['indptr']) - 1
+            self.mat = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                         shape=(N, N), copy=False)
+        else:
+            self.mat = sparse.load_npz(fname)
+            if not self.mat.has_sorted_indices:
+                self.mat.sort_indices()
         self.shape = self.mat.shape[1]
+        self.qids = self._load_qids(fname, mmap_mode='r' if mmap else None)
 
     def save_matrix(self, fname):
-        sparse.save_npz(fname, self.mat)
+        """
+        Saves the adjacency matrix as a .npz file, and its raw CSR arrays
+        next to it (see array_filename) so that it can be memory-mapped.
+        """
+        self.merge_overlay()
+        self.mat.sort_indices()
+        # replaced atomically, as it can be saved while indexing (see IncrementalPageRank)
+        tmp_fname = os.path.splitext(fname)[0] + '.tmp.npz'
+        sparse.save_npz(tmp_fname, self.mat)
+        os.replace(tmp_fname, fname)
+        for name in ['indptr', 'indices', 'data']:
+            save_atomically(self.array_filename(fname, name), getattr(self.mat, name))
+        self._save_qids(fname)
+
+    @staticmethod
+    def array_filename(fname, name):
+        """
+        Name of the file storing one of the raw arrays (indptr, indices, data)
+        of a matrix: wikidata-graph.npz -> wikidata-graph.indptr.npy
+        """
+        return '{}.{}.npy'.format(os.path.splitext(fname)[0], name)
 
-    def compute_pagerank(self):
-        N = self.mat.shape[0]
-        print(self.mat.shape)
+    def _row_indices(self, qid):
+        """
+        Column indices of the outgoing edges of an item, or None
+        if the item is not in the graph.
+        """
+        row = self._qid_index(qid)
+        if row < 0:
+            return None
+        if row in self.overlay:
+            return self.overlay[row][0]
+        return self.mat.indices[self.mat.indptr[row]:self.mat.indptr[row+1]]
 
-        # initialisation :create uniform vector v
-        data = [1./N] * N
-        rows = [0]*N
-        cols = list(range(N))
-        v = sparse.csr_matrix((data, (rows, cols)), shape=(1,N))
+    def _index_to_qid(self, idx):
+        return self.qids[idx] if self.qids is not None else idx
 
-        max_iterations = 16
+    def neighbours(self, qid):
+        """
+        Returns the numeric ids (without the leading Q) of the items
+        the given item points to, sorted.
+        """
+        cols = self._row_indices(qid)
+        if cols is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.asarray(self._index_to_qid(cols), dtype=numpy.int64)
+
+    def has_edge(self, qid_a, qid_b):
+        """
+        Does the first item point to the second?
+        """
+        cols = self._row_indices(qid_a)
+        target = self._qid_index(qid_b)
+        if cols is None or target < 0:
+            return False
+        pos = numpy.searchsorted(cols, target)
+        return bool(pos < len(cols) and cols[pos] == target)
+
+    def common_neighbours(self, qid_a, qid_b):
+        """
+        Returns the numeric ids of the items both items point to, sorted.
+        """
+        cols_a = self._row_indices(qid_a)
+        cols_b = self._row_indices(qid_b)
+        if cols_a is None or cols_b is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        common = numpy.intersect1d(cols_a, cols_b, assume_unique=True)
+        return numpy.asarray(self._index_to_qid(common), dtype=numpy.int64)
+
+    @staticmethod
+    def qids_filename(fname):
+        """
+        Name of the file storing the sorted qids of a matrix or
+        pagerank file: wikidata-graph.npz -> wikidata-graph.qids.npy
+        """
+        return os.path.splitext(fname)[0] + '.qids.npy'
+
+    def _save_qids(self, fname):
+        if self.qids is not None:
+            save_atomically(self.qids_filename(fname), self.qids)
+
+    def _load_qids(self, fname, mmap_mode=None):
+        """
+        Matrices computed before the compact indexing was introduced
+        have no qids file: their rows are indexed by QID number.
+        """
+        qids_fname = self.qids_filename(fname)
+        if os.path.exists(qids_fname):
+            return numpy.load(qids_fname, mmap_mode=mmap_mode)
+        return None
+
+    def qid_to_index(self, ids):
+        """
+        Converts numeric ids (without the leading Q) to row indices,
+        vectorised over arrays. Ids which are not in the graph get -1.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if self.qids is None:
+            return numpy.where((ids >= 0) & (ids < self.nb_nodes()), ids, -1)
+        if not len(self.qids):
+            return numpy.full(ids.shape, -1)
+        idx = numpy.searchsorted(self.qids, ids)
+        found = (idx < len(self.qids)) & (self.qids[numpy.minimum(idx, len(self.qids)-1)] == ids)
+        return numpy.where(found, idx, -1)
+
+    def _qid_index(self, qid):
+        """
+        Row index of a single qid (such as 'Q42'), or -1 if it is not in the graph.
+        """
+        if not qid or qid[0] != 'Q':
+            return -1
+        id = int(qid[1:])
+        return int(self.qid_to_index(id)) if id <= MAX_QID else -1
+
+    def nb_nodes(self):
+        """
+        Number of items in the graph (or in the pagerank vector)
+        """
+        if self.pagerank is not None:
+            return len(self.pagerank)
+        return self.mat.shape[0]
+
+    def compute_pagerank(self, max_iterations=16, tol=1e-6, damping=1., dtype=numpy.float64, num_threads=None,
+                         teleport_sets=None, personalized_damping=0.85):
+        """
+        Computes the pagerank of the graph by power iteration, on a dense
+        vector. The transpose of the adjacency matrix is computed once and split
+        in row blocks which are multiplied with the rank vector in parallel.
+
+        The mass lost in rows without outgoing edges (and by damping) is
+        redistributed uniformly over all items.
+
+        Personalized pageranks can be computed in the same pass: their lost
+        mass is redistributed over their teleport set only. They are stored
+        in self.personalized.
+
+        :param max_iterations: the maximum number of power iterations
+        :param tol: stop iterating when the L1 norm of the update (of a vector
+            summing to 1) falls below this value. Much lower values are below
+            the rounding noise of the sums over millions of items.
+        :param damping: probability of following an edge rather than teleporting
+        :param dtype: numpy.float64 or numpy.float32 (halves the memory needed)
+        :param num_threads: number of threads for the sparse products (defaults to the number of CPUs)
+        :param teleport_sets: a dictionary from names to arrays of numeric ids, the teleport sets of
+            the personalized pageranks to compute
+        :param personalized_damping: the damping used for the personalized pageranks
+        """
+        N = self.mat.shape[0]
+        teleport_sets = teleport_sets or {}
+        names = list(teleport_sets)
+        k = 1 + len(names)
+
+        # teleport sets of the personalized pageranks, as row indices
+        teleport = []
+        for name in names:
+            idx = self.qid_to_index(teleport_sets[name])
+            idx = numpy.unique(idx[idx >= 0])
+            if not len(idx):
+                raise ValueError('The teleport set "{}" contains no item of the graph.'.format(name))
+            teleport.append(idx)
+        dampings = numpy.array([damping] + [personalized_damping]*(k-1), dtype=dtype)
+
+        logger.info('Computing {} PageRank vector(s) on a {}x{} matrix with {} edges'.format(
+            k, N, self.mat.shape[1], self.mat.nnz))
+        product = ParallelTransposedProduct(self.mat, dtype=dtype, num_threads=num_threads)
+
+        v = numpy.zeros((N, k), dtype=dtype)
+        v[:,0] = 1./N
+        for j, idx in enumerate(teleport):
+            v[idx, j+1] = 1./len(idx)
+        try:
+            v = self._power_iterate(product, v, teleport, dampings, max_iterations, tol)
+        finally:
+            product.close()
+        self.pagerank = numpy.ascontiguousarray(v[:,0])
+        self._default_pagerank = None
+        self.personalized = {
+            name: numpy.ascontiguousarray(v[:,j+1])
+            for j, name in enumerate(names)
+        }
+
+    def _power_iterate(self, product, v, teleport, dampings, max_iterations, tol, correction=None):
+        """
+        Runs power iterations from the given N x k matrix of rank vectors,
+        the first of which teleports uniformly, the others uniformly over
+        the rows listed in teleport (one array of row indices for each).
+        Returns the updated rank vectors.
+
+        :param correction: a sparse matrix added to the adjacency matrix
+            (to account for edits which have not been merged in it)
+        """
+        N = v.shape[0]
+        k = v.shape[1]
+        nv = numpy.empty_like(v)
+        diff = numpy.empty_like(v)
+        self.pagerank_timings = []
+        l1_change = float('nan')
         for i in range(max_iterations):
-            print('\r---- %d ----' % i, end='', flush=True)
-            
-            # nv: Updated vector in each iteration.
-            nv = v.dot(self.mat)
+            start_time = time.perf_counter()
+            product.dot(v, out=nv)
+            if correction is not None:
+                nv += correction.T.dot(v)
+            nv *= dampings
 
             # loss compensation
-            l1norm = nv.sum()
-            comp = sparse.csr_matrix(([(1. - l1norm)/N]*N, (rows, cols)),
-                                     shape=(1,N))
-            nv += comp
+            lost = 1. - nv.sum(axis=0)
+            nv[:,0] += lost[0] / N
+            for j, idx in enumerate(teleport or []):
+                nv[idx, j+1] += lost[j+1] / len(idx)
 
             # convergence control
-            diff = nv - v
-            div = diff.multiply(diff.sign()).sum()
-            print('convergence control :',div)
+            numpy.subtract(nv, v, out=diff)
+            numpy.abs(diff, out=diff)
+            l1_change = float(diff.sum(axis=0).max())
+            v, nv = nv, v
+
+            elapsed = time.perf_counter() - start_time
+            self.pagerank_timings.append(elapsed)
+            logger.info('PageRank iteration {}: L1 change {:.3e} ({:.2f}s)'.format(i, l1_change, elapsed))
+            if l1_change < tol:
+                break
+        else:
+            logger.warning('PageRank did not converge in {} iterations: L1 change {:.3e} (tolerance {:.3e})'.format(
+                max_iterations, l1_change, tol))
+        return v
+
+    def update_edges(self, qid, edges):
+        """
+        Records the new outgoing edges of an item (as returned by
+        WikidataItemDocument.get_outgoing_edges) in an overlay of the
+        adjacency matrix. Items which are not in the graph are ignored:
+        they only get a row when the matrix is compiled again.
+
+        :returns: True if the item is in the graph
+        """
+        row = self._qid_index(qid)
+        if row < 0:
+            return False
+        cols = self.qid_to_index(numpy.array(edges, dtype=numpy.int64))
+        cols, counts = numpy.unique(cols[cols >= 0], return_counts=True)
+        self.overlay[row] = (cols, counts / counts.sum() if len(counts) else counts.astype(numpy.float64))
+        return True
+
+    def _overlay_correction(self):
+        """
+        Returns the sparse matrix D such that self.mat + D is
+        the adjacency matrix where the rows of the overlay are replaced.
+        """
+        N = self.mat.shape[0]
+        rows = numpy.array(sorted(self.overlay), dtype=numpy.int64)
+        if not len(rows):
+            return sparse.csr_matrix((N, self.mat.shape[1]))
+        cols = [self.overlay[row][0] for row in rows]
+        lengths = [len(c) for c in cols]
+        new_rows = sparse.csr_matrix(
+            (numpy.concatenate([self.overlay[row][1] for row in rows]),
+             (numpy.repeat(rows, lengths), numpy.concatenate(cols))),
+            shape=self.mat.shape)
+        former = self.mat[rows].tocoo()
+        former_rows = sparse.csr_matrix((former.data, (rows[former.row], former.col)), shape=self.mat.shape)
+        return new_rows - former_rows
+
+    def refresh_pagerank(self, max_iterations=20, tol=1e-6, damping=1., num_threads=None):
+        """
+        Updates the global pagerank to account for the edits recorded with
+        update_edges, by power iterations starting from the current pagerank,
+        which converge in a few steps when few rows have changed.
+        Personalized pageranks are not updated.
+        """
+        if self._product is None:
+            self._product = ParallelTransposedProduct(self.mat, num_threads=num_threads)
+        v = numpy.array(self.pagerank, dtype=numpy.float64).reshape(-1, 1)
+        v = self._power_iterate(self._product, v, None, numpy.array([damping]),
+                                max_iterations, tol, correction=self._overlay_correction())
+        self.pagerank = numpy.ascontiguousarray(v[:,0])
+        self._default_pagerank = None
+
+    def merge_overlay(self):
+        """
+        Merges the edits recorded with update_edges in the adjacency matrix.
+        """
+        if not self.overlay:
+            return
+        self.mat = (self.mat + self._overlay_correction()).tocsr()
+        self.mat.eliminate_zeros()
+        self.overlay = {}
+        if self._product is not None:
+            self._product.close()
+            self._product = None
+
+    @staticmethod
+    def instances_of(class_ids, instances):
+        """
+        Returns the numeric ids of the instances (P31) of the given classes,
+        as well as the classes themselves. This is used to build teleport
+        sets from type constraints.
+
+        :param class_ids: numeric ids of the classes (typically a subclass closure)
+        :param instances: the "instance of" (P31) edges extracted by preprocess_dump,
+            as an array of two rows (items and classes), or the .npy file storing them
+        """
+        if isinstance(instances, str):
+            instances = numpy.load(instances, mmap_mode='r')
+        class_ids = numpy.unique(numpy.asarray(list(class_ids), dtype=numpy.int64))
+        items = numpy.asarray(instances[0])[numpy.isin(instances[1], class_ids)]
+        return numpy.union1d(items.astype(numpy.int64), class_ids)
+
+    def load_pagerank(self, fname, mmap=True, profiles=()):
+        """
+        Loads a pagerank vector saved with save_pagerank.
+
+        :param mmap: map the file in memory (read-only) instead of reading it
+        :param profiles: names of the personalized pageranks to load as well
+        """
+        mmap_mode = 'r' if mmap else None
+        self.pagerank_fname = fname
+        self._pagerank_profiles = list(profiles)
+        self._pagerank_stat = self._file_signature(fname)
+        pagerank = numpy.load(fname, mmap_mode=mmap_mode)
+        # vectors saved as 1xN matrices by former versions
+        self.pagerank = pagerank.reshape(-1)
+        self._default_pagerank = None
+        self.qids = self._load_qids(fname, mmap_mode=mmap_mode)
+        self.personalized = {}
+        for name in profiles:
+            personalized = numpy.load(self.personalized_filename(fname, name), mmap_mode=mmap_mode)
+            if personalized.shape != self.pagerank.shape:
+                raise ValueError('The personalized pagerank "{}" does not match the pagerank {}'.format(name, fname))
+            self.personalized[name] = personalized
+
+    def save_pagerank(self, fname, dtype=numpy.float32):
+        """
+        Saves the pagerank as a flat vector (.npy), and the personalized
+        pageranks next to it (see personalized_filename).
+
+        :param dtype: the type of the stored values (float32 is precise enough for ranking)
+        """
+        self._save_qids(fname)
+        for name, personalized in self.personalized.items():
+            save_atomically(self.personalized_filename(fname, name), personalized.astype(dtype, copy=False))
+        save_atomically(fname, numpy.ravel(self.pagerank).astype(dtype, copy=False))
 
-            # update
-            v = nv
-        self.pagerank = v.todense()
+    @staticmethod
+    def _file_signature(fname):
+        stat = os.stat(fname)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
-    def load_pagerank(self, fname):
-        self.pagerank = numpy.load(fname)
+    def reload_pagerank_if_changed(self):
+        """
+        Reloads the pagerank if its file has been replaced since it was
+        loaded (for instance by an incremental update). The file is checked
+        at most every reload_interval seconds. The new vectors are swapped
+        in place of the former ones without interrupting lookups.
 
-    def save_pagerank(self, fname):
-        numpy.save(fname, self.pagerank)
+        :returns: True if the pagerank was reloaded
+        """
+        if self.pagerank_fname is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_reload_check < self.reload_interval:
+            return False
+        self._last_reload_check = now
+        try:
+            signature = self._file_signature(self.pagerank_fname)
+        except OSError as e:
+            logger.warning('Could not check the pagerank file: {}'.format(e))
+            return False
+        if signature == self._pagerank_stat:
+            return False
+        logger.info('Reloading the pagerank from {}'.format(self.pagerank_fname))
+        self.load_pagerank(self.pagerank_fname, mmap=isinstance(self.pagerank, numpy.memmap),
+                           profiles=self._pagerank_profiles)
+        return True
+
+    @staticmethod
+    def personalized_filename(fname, name):
+        """
+        Name of the file storing a personalized pagerank:
+        wikidata-graph.pgrank.npy -> wikidata-graph.pgrank.<name>.npy
+        """
+        return '{}.{}.npy'.format(os.path.splitext(fname)[0], name)
 
     def get_pagerank(self, qid):
-        id = int(qid[1:])
-        if id < self.pagerank.shape[1]:
-            return self.pagerank[(0,int(qid[1:]))]
+        idx = self._qid_index(qid)
+        if idx >= 0:
+            return float(self.pagerank[idx])
         else:
             # if the qid is not in the graph, return a small value
-            # print(self.pagerank.shape[1]) returns N = 123578005
-            return 0.01/self.pagerank.shape[1]
+            return self.default_pagerank()
+
+    def default_pagerank(self):
+        """
+        The pagerank assumed for items which are not in the graph. Items
+        without any edge are not in the graph but would only get the mass
+        redistributed uniformly (as the items without incoming edges,
+        which have the lowest pagerank), so they get this minimum.
+        """
+        if self._default_pagerank is None:
+            self._default_pagerank = float(numpy.min(self.pagerank))
+            if self._default_pagerank <= 0:
+                # some items are never reached (without redistributed mass)
+                self._default_pagerank = 0.01/len(self.pagerank)
+        return self._default_pagerank
+
+    def get_log_ranks(self, ids, profile=None):
+        """
+        Returns log(pagerank) - log(default pagerank) for an array of
+        numeric ids (without the leading Q), in one vectorised lookup.
+        Items which are not in the graph get 0.
+
+        :param profile: the name of a personalized pagerank to use instead
+            of the global one, if it has been loaded
+        """
+        pagerank = self.personalized.get(profile, self.pagerank) if profile else self.pagerank
+        idx = self.qid_to_index(ids)
+        default = self.default_pagerank()
+        ranks = numpy.full(idx.shape, default, dtype=numpy.float64)
+        found = idx >= 0
+        ranks[found] = pagerank[idx[found]]
+        if pagerank is not self.pagerank:
+            # items that the personalized walk never reaches
+            numpy.maximum(ranks, default, out=ranks)
+        return numpy.log(ranks) - numpy.log(default)
+
+
+class IncrementalPageRank(object):
+    """
+    Keeps a pagerank file up to date with a stream of edited items:
+    their new edges are recorded in the overlay of the graph and the
+    pagerank is refreshed and saved every refresh_interval seconds.
+    Servers which loaded the pagerank file pick up the new version
+    with WikidataGraph.reload_pagerank_if_changed.
+
+    Once it holds max_overlay items, the overlay is merged in the
+    adjacency matrix, which is saved next to the pagerank (see
+    matrix_filename), so that the edits are kept when indexing
+    restarts. This is also done when the stream is closed: only the
+    edits since the last merge are lost if the process is killed.
+    """
+
+    def __init__(self, graph, pagerank_fname, refresh_interval=600, max_iterations=20, tol=1e-6,
+                 max_overlay=100000, matrix_fname=None):
+        """
+        :param max_overlay: the number of edited items above which the
+            overlay is merged in the matrix
+        :param matrix_fname: where the matrix is saved after merging the
+            overlay (matrix_filename(pagerank_fname) by default)
+        """
+        self.graph = graph
+        self.pagerank_fname = pagerank_fname
+        self.max_overlay = max_overlay
+        self.matrix_fname = matrix_fname or self.matrix_filename(pagerank_fname)
+        self.refresh_interval = refresh_interval
+        self.max_iterations = max_iterations
+        self.tol = tol
+        self.nb_pending = 0
+        self.last_refresh = time.monotonic()
+
+    def add_item(self, item):
+        """
+        Records the edges of an edited item, refreshing the pagerank if needed.
+        """
+        if self.graph.update_edges(item.get('id'), item.get_outgoing_edges()):
+            self.nb_pending += 1
+        if self.nb_pending and time.monotonic() - self.last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Refreshes the pagerank and replaces its file.
+        """
+        logger.info('Refreshing the pagerank after {} edits'.format(self.nb_pending))
+        self.graph.refresh_pagerank(max_iterations=self.max_iterations, tol=self.tol)
+        self.graph.save_pagerank(self.pagerank_fname)
+        self.nb_pending = 0
+        self.last_refresh = time.monotonic()
+        if len(self.graph.overlay) >= self.max_overlay:
+            self.save_matrix()
+
+    @staticmethod
+    def matrix_filename(pagerank_fname):
+        """
+        Name of the updated matrix stored next to a pagerank:
+        wikidata-graph.pgrank.npy -> wikidata-graph.pgrank.graph.npz
+        """
+        return os.path.splitext(pagerank_fname)[0] + '.graph.npz'
+
+    def save_matrix(self):
+        """
+        Merges the overlay in the adjacency matrix and saves it.
+        """
+        logger.info('Saving the adjacency matrix with {} edited items to {}'.format(
+            len(self.graph.overlay), self.matrix_fname))
+        self.graph.save_matrix(self.matrix_fname)
+
+    def wrap(self, stream):
+        """
+        Returns a stream of items that behaves like the given one,
+        recording every item it yields.
+        """
+        return PageRankUpdatingStream(self, stream)
+
+class PageRankUpdatingStream(object):
+    """
+    Wraps a stream of items (for instance a WikidataStreamReader)
+    to feed an IncrementalPageRank with them.
+    """
+
+    def __init__(self, updater, stream):
+        self.updater = updater
+        self.stream = stream
+        self.reader = None
+
+    def __enter__(self):
+        self.reader = self.stream.__enter__()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self.updater.nb_pending:
+            self.updater.refresh()
+        if self.updater.graph.overlay:
+            self.updater.save_matrix()
+        return self.stream.__exit__(*args, **kwargs)
+
+    def __iter__(self):
+        for item in self.reader:
+            self.updater.add_item(item)
+            yield item
+
+    def tell(self):
+        return self.reader.tell() if hasattr(self.reader, 'tell') else None
 
 
 if __name__ == '__main__':
@@ -6,5 +6,11 @@ SOLR_COLLECTION = 'frenchtapioca4'
 LANGUAGE_MODEL_PATH='data/all-french.bow.pkl'
 # The path to the pagerank Numpy vector, computed with "tapioca compute-pagerank"
 PAGERANK_PATH='data/wikidata/wikidata-graph.pgrank.npy'
+# The name of the indexing profile whose personalized pagerank should be used
+# (computed with "tapioca compute-pagerank --profile"), or None for the global one
+PAGERANK_PROFILE=None
 # The path to the trained classifier, obtained from "tapioca train-classifier"
 CLASSIFIER_PATH='data/latest_classifier.pkl'
+# The path to the coordinates of the items (from "tapioca preprocess"),
+# needed by classifiers trained with "tapioca train-classifier --coordinates"
+COORDINATES_PATH=None
@@ -89,6 +89,8 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage', 'pytest'],
+        'zstd': ['zstandard'],
+        'fast': ['orjson'],
     },
 
     # If there are data files included in your packages that need to be
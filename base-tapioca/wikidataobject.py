@@ -1,6 +1,8 @@
-import requests
 import json
-from geopy.distance import distance
+import numpy
+from opentapioca.httpcache import get_session
+from opentapioca.readers.apireaderbase import APIReaderBase
+from opentapioca.coordinates import haversine
 
 class WikidataObject :
 
@@ -24,7 +26,7 @@ class WikidataObject :
         
         try:
             url = f'https://www.wikidata.org/wiki/Special:EntityData/{self.uri}.json'
-            response = requests.get(url)
+            response = get_session().get(url)
             data = response.json()
             
             if store:
@@ -59,16 +61,46 @@ class WikidataObject :
 
         return self.coordinates
     
+    @staticmethod
+    def get_coords(qids, store=None, mediawiki_api='https://www.wikidata.org/w/api.php'):
+        """
+        Returns the coordinates of many items at once, as an array
+        of (latitude, longitude) rows (NaN for items without coordinates)
+        - from a CoordinateStore if any (see `tapioca preprocess`)
+        - from batched requests to the Wikidata API otherwise
+        """
+        if store is not None:
+            return store.get_coords(qids)
+        found = {
+            item.get('id'): item.get_coordinates()
+            for item in APIReaderBase(mediawiki_api).fetch_items(qids)
+        }
+        coords = numpy.full((len(qids), 2), numpy.nan, dtype=numpy.float32)
+        for idx, qid in enumerate(qids):
+            if found.get(qid) is not None:
+                coords[idx] = found[qid]
+        return coords
+
+    @staticmethod
+    def _lat_lon(coordinates):
+        """
+        Returns the (latitude, longitude) of coordinates given either
+        as a Wikidata globe coordinate value or as a (latitude, longitude)
+        pair, or None if there are none
+        """
+        if isinstance(coordinates, dict):
+            return coordinates['latitude'], coordinates['longitude']
+        if isinstance(coordinates, (tuple, list, numpy.ndarray)) and len(coordinates) == 2:
+            return tuple(coordinates)
+        return None
+
     # method to compute a distance to another WikidataObject
     def distance_to(self, other):
         """
         Returns the distance between the coordinates of self and other
         """
-        if self.coordinates and other.coordinates:
-            d = distance(self.coordinates, other.coordinates).km
-            return d
-        else:
+        a = self._lat_lon(self.coordinates)
+        b = self._lat_lon(other.coordinates)
+        if a is None or b is None:
             return None
-    
-        
-    
+        return float(haversine(a[0], a[1], b[0], b[1]))